@@ -439,11 +439,14 @@ class LicWindow(QMainWindow):
         
         self.undoStack = QUndoStack()
         self.connect(self.undoStack, SIGNAL("cleanChanged(bool)"), lambda isClean: self.setWindowModified(not isClean))
+        self.connect(self.undoStack, SIGNAL("indexChanged(int)"), lambda index: LicLayout.LayoutScheduler.flush())
+        self.connect(self.undoStack, SIGNAL("indexChanged(int)"), lambda index: self.scene.catchUpNumbers())
 
         self.glWidget = QGLWidget(LicGLHelpers.getGLFormat(), self)
         self.treeWidget = LicTreeWidget(self)
         self.scene = LicGraphicsWidget.LicGraphicsScene(self)
         self.scene.undoStack = self.undoStack  # Make undo stack easy to find for everything
+        self.connect(self.undoStack, SIGNAL("indexChanged(int)"), lambda index: self.scene.clearPreviewCache())
         self.copySettingsToScene()
 
         self.graphicsView = LicGraphicsWidget.LicGraphicsView(self)
@@ -547,6 +550,11 @@ class LicWindow(QMainWindow):
         if self.instructions.mainModel:
             LicCleanupAssistant(self.instructions.mainModel.getPageList() ,self.graphicsView).show()
 
+    def mergeIdenticalCallouts(self):
+        if self.instructions.mainModel:
+            count = self.instructions.mainModel.mergeIdenticalCallouts()
+            self.notificationArea.setText("Merged %d set%s of identical Callouts" % (count, "" if count == 1 else "s"))
+
     def showHideRules(self):
         if not isinstance(self.hRuler, Ruler):
             self.hRuler = Ruler(Qt.Horizontal,self.graphicsView)
@@ -847,18 +855,20 @@ class LicWindow(QMainWindow):
         self.exportToPDFAction = self.makeAction("Generate &PDF", self.exportToPDFExecutor, QKeySequence("Ctrl+E"), "Create a PDF from this instruction book")
         self.exportToPOVAction = self.makeAction("NYI - Generate Images with Pov-&Ray", lambda: thread.start_new_thread(self.exportToPOV,()), None, "Use Pov-Ray to generate images of each page in this Instruction book")
         self.exportToMPDAction = self.makeAction("Generate &MPD", self.exportToMPD, None, "Generate an LDraw MPD file from the parts & steps in this Instruction book")
-        self.addActions(self.exportMenu, (self.exportToImagesAction, self.exportToPDFAction, self.exportToPOVAction, None, self.exportToMPDAction))
+        self.exportToCSVAction = self.makeAction("Generate Part List &CSV", self.exportToCSV, None, "Generate a CSV bill of materials listing every part & colour in this Instruction book")
+        self.addActions(self.exportMenu, (self.exportToImagesAction, self.exportToPDFAction, self.exportToPOVAction, None, self.exportToMPDAction, self.exportToCSVAction))
 
         # Model Manu
         self.modelMenu = menu.addMenu("&Model")
         applyLayout = self.makeAction("Apply &Layout to Pages", self.changeLayoutSignal, None, "Apply chosen layout to selected pages")
         toggleAssistant = self.makeAction("Toggle &Assistant", lambda: self.showAssistant(), QKeySequence.HelpContents ,"Show or hide the list of keyboard shortcuts and license information")
         runCleanup = self.makeAction("Run &Clean-up", self.runCleanup, Qt.Key_F2, "Run clean-up utility")
+        mergeCallouts = self.makeAction("&Merge Identical Callouts", self.mergeIdenticalCallouts, None, "Merge every set of matching callouts on the same step, throughout this Instruction book")
         restoreOrginal = self.makeAction("Restore &Orginal", self.restoreModel, None ,"Restore model from this Instruction book")
         cacheFolder = self.makeAction("&Explore Cache", lambda: startfile( config.modelCachePath() ), Qt.Key_F4, "Opens cache directory for this Instruction")
         checkUpdates= self.makeAction("Check for Library &Updates...", self.checkUpdates, None, "Checking repository for latest updated files")
         
-        modelAction = (applyLayout, None, toggleAssistant, runCleanup, None, restoreOrginal, cacheFolder, None, checkUpdates)
+        modelAction = (applyLayout, None, toggleAssistant, runCleanup, mergeCallouts, None, restoreOrginal, cacheFolder, None, checkUpdates)
         self.addActions(self.modelMenu, modelAction)
 
     def zoom(self, factor = 0.0):
@@ -1381,6 +1391,14 @@ class LicWindow(QMainWindow):
             fh.close()
             self.notificationArea.setText ("MPD - Export Done. Check %s" % filename)
 
+    def exportToCSV(self):
+        f = self.filename if self.filename else self.instructions.getModelName()
+        f = os.path.splitext(f)[0] + "_parts.csv"
+        filename = unicode(QFileDialog.getSaveFileName(self, "Create Part List CSV File", f, "CSV files (*.csv)"))
+        if filename:
+            self.instructions.mainModel.bom.exportToCSV(filename)
+            self.notificationArea.setText ("CSV - Export Done. Check %s" % filename)
+
 def setupExceptionLogger():
 
     def myExceptHook(*args):
@@ -1426,6 +1444,7 @@ if __name__ == '__main__':
     app.setOrganizationName("BugEyedMonkeys Inc.")
     app.setOrganizationDomain("bugeyedmonkeys.com")
     app.setApplicationName("LICreator")
+    LicGLHelpers.loadGLCapabilities()  # Before any GL context exists, so a cached software backend applies
     window = LicWindow()
 
     try:
@@ -1437,6 +1456,9 @@ if __name__ == '__main__':
     window.show()
     window.raise_()  # Work around bug in OSX Qt where app launches behind all other windows.  Harmless on other platforms.
 
+    window.glWidget.makeCurrent()
+    LicGLHelpers.probeGLCapabilities()
+
     if window.needPathConfiguration:
         window.configurePaths(True)
 
@@ -539,7 +539,7 @@ class LicPlacementAssistant(QWidget):
                     wt = Page.PageSize.width()
                     ht = Page.PageSize.height()
                     mx = int(PLI.margin.x()/2)
-                    bufferManager = LicGLHelpers.FrameBufferManager(wt, ht)
+                    bufferManager = LicGLHelpers.renderTargetPool.acquire(wt, ht)
                     try:
                         bufferManager.bindMSFB()
                         LicGLHelpers.initFreshContext(True)                                   
@@ -565,7 +565,7 @@ class LicPlacementAssistant(QWidget):
                         #saveResult
                         image.save(filename,"PNG")
                         #cleanUp
-                        bufferManager.cleanup()
+                        LicGLHelpers.renderTargetPool.release(bufferManager)
                         os.remove(temp_name)
                 else:        
                     image = QImage(filename,"LA")
@@ -253,6 +253,8 @@ def __readSubmodel(stream, instructions, createMainmodel = False):
     for unused in range(stream.readInt32()):
         page = __readPage(stream, submodel, instructions)
         submodel.pages.append(page)
+        page.attachNumbering(submodel.pageShifts)
+    ModelIndex.pagesChanged()
 
     submodel.submodelNames = []
     for unused in range(stream.readInt32()):
@@ -261,6 +263,7 @@ def __readSubmodel(stream, instructions, createMainmodel = False):
             model = partDict[filename]
             model.used = True
             submodel.submodels.append(model)
+            ModelIndex.pagesChanged()
         else:
             submodel.submodelNames.append(str(stream.readQString()))
 
@@ -328,6 +331,7 @@ def __readAbstractPart(stream, createSubmodel = False, createMainmodel = False):
     for unused in range(stream.readInt32()):
         p = __readPart(stream)
         part.parts.append(p)
+    ModelIndex.partsChanged()
     return part
 
 def __readPrimitive(stream):
@@ -651,6 +655,7 @@ def __linkModelPartNames(model):
         newSubmodel = partDict[modelName]
         newSubmodel.used = True
         model.submodels.append(newSubmodel)
+        ModelIndex.pagesChanged()
 
     for m in model.submodels:
         __linkModelPartNames(m)
@@ -17,13 +17,14 @@
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
-from LicHelpers import LicColor
+from LicHelpers import LicColor, ShiftNumbered
+from RectanglePacker import CygonRectanglePacker
 from LicModel import *
 from LicTreeModel import *
 from LicUndoActions import *
 
 
-class Page(PageTreeManager, GraphicsRoundRectItem):
+class Page(ShiftNumbered, PageTreeManager, GraphicsRoundRectItem):
     """ A single page in an instruction book.  Contains one or more Steps. """
 
     itemClassName = "Page"
@@ -87,9 +88,21 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
         return r
 
     def _setNumber(self, number):
+        if number == self._number:
+            return
         self._number = number
+        ModelIndex.pagesChanged()
+        self.numberItem.setText("%d" % self._number)
+
+    def numberShifted(self):
         self.numberItem.setText("%d" % self._number)
 
+    def catchUpNumbers(self):
+        """ Apply any renumbering still pending in the submodel's shift logs to this page & its steps. """
+        self._number
+        for step in self.steps:
+            step._number
+
     def _getNumber(self):
         return self._number
 
@@ -136,13 +149,23 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
     def getPage(self):
         return self
     
+    def __getNeighbours(self):
+        modelIndex = self.submodel.getModelIndex()
+        return modelIndex.getNeighbours(self) if modelIndex else None
+
     def prevPage(self):
+        neighbours = self.__getNeighbours()
+        if neighbours is not None:
+            return neighbours[0]
         i = self.submodel.pages.index(self)
         if i == 0:
             return None
         return self.submodel.pages[i - 1]
 
     def nextPage(self):
+        neighbours = self.__getNeighbours()
+        if neighbours is not None:
+            return neighbours[1]
         i = self.submodel.pages.index(self)
         if i == len(self.submodel.pages) - 1:
             return None
@@ -153,8 +176,10 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
 
     def addStep(self, step):
 
+        step.attachNumbering(self.submodel.stepShifts if isinstance(self.submodel, Submodel) else None)
         self.steps.append(step)
         self.steps.sort(key = lambda x: x._number)
+        ModelIndex.stepsChanged()
         step.setParentItem(self)
 
         i = 0
@@ -206,6 +231,7 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
             parent.steps.remove(step)
             step.setParentItem(self)
             self.steps.append(step)
+            ModelIndex.stepsChanged()
 
         self.children.insert(row, step)
         self.scene().emit(SIGNAL("layoutChanged()"))
@@ -229,6 +255,8 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
     def removeStep(self, step):
         self.scene().removeItem(step)
         self.steps.remove(step)
+        step.attachNumbering(None)
+        ModelIndex.stepsChanged()
         self.children.remove(step)
         self.submodel.updateStepNumbers(step.number, -1)
 
@@ -371,6 +399,16 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
 
         # Check if we should shrink submodel image
         label = "Scaling " + os.path.basename(self.submodel.name) + " preview to "
+        if self.submodelItem.scaling <= 0.5 or not self.checkForLayoutOverlaps():
+            return
+
+        newScale = self.getSubmodelFitScale()
+        if newScale is not None:  # Render the preview once, at the scale that fits
+            yield label + str(newScale)
+            self.submodelItem.changeScale(newScale)
+            self.initLayout()
+            return
+
         while self.submodelItem.scaling > 0.5 and self.checkForLayoutOverlaps():
 
             # Scale submodel down and try again
@@ -378,7 +416,68 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
             yield label + str(newScale)
             self.submodelItem.changeScale(newScale)
             self.initLayout()
-    
+
+    def getSubmodelFitScale(self, lowest = 0.4, iterations = 8):
+        """
+        The largest submodel preview scale, down to lowest, that leaves every step on this page without
+        overlaps.  The scale that exactly frees the room the steps need is tried first, then bisected from.
+        Only StepLayoutPlans and the preview's getScaledRect are used, so nothing is rendered or moved.
+        Returns None if any step can't be planned.
+        """
+        plans = [StepLayoutPlan(step) for step in self.steps]
+        if not all(plan.canPlan for plan in plans):
+            return None
+
+        preview = self.submodelItem
+        pageRect, insetRect = self.rect(), self.insetRect()
+
+        def fits(scale):
+            fixedRects = [preview.getScaledRect(scale)] + [None] * len(plans)
+            destRects = []
+            for rowRects, unused in self.layout.getGridRects(insetRect, fixedRects):
+                destRects += rowRects
+            return all(plan.fits(destRect, pageRect) for plan, destRect in zip(plans, destRects[1:]))
+
+        high = preview.scaling
+        if not fits(lowest):
+            return lowest  # Won't fit at all: shrink as far as we would have anyway
+
+        guess = self.__getSubmodelFreeScale(plans, lowest, high)
+        if fits(guess):
+            low = guess
+        else:
+            low, high = lowest, guess
+
+        for i in range(iterations):
+            scale = (low + high) / 2.0
+            if fits(scale):
+                low = scale
+            else:
+                high = scale
+
+        return max(lowest, math.floor(low * 100) / 100.0)
+
+    def __getSubmodelFreeScale(self, plans, lowest, highest):
+        """
+        Closed form guess at the preview scale that fits: the preview's row in the grid may use whatever
+        the other rows don't need, and the preview's extent is linear in its scale.
+        """
+        preview, layout = self.submodelItem, self.layout
+        oID = not layout.orientation  # Rows are stacked along this axis
+        rows, cols = layout.getRowColCount([preview] + plans)
+        if layout.orientation == Vertical:
+            rows, cols = cols, rows
+
+        need = max(plan.minimumRect().getOrientedSize(oID) for plan in plans) + (layout.margin * 2)
+        free = self.insetRect().getOrientedSize(oID) - (need * (rows - 1)) - (layout.margin * 2)
+
+        current = preview.getScaledRect(highest).getOrientedSize(oID)
+        perScale = (current - preview.getScaledRect(highest / 2.0).getOrientedSize(oID)) / (highest / 2.0)
+        if perScale <= 0.0:
+            return highest
+
+        return min(highest, max(lowest, highest - ((current - free) / perScale)))
+
     def scaleImages(self):
         for step in self.steps:
             if step.hasPLI():
@@ -455,7 +554,7 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
         try:
             w = Page.PageSize.width()
             h = Page.PageSize.height()
-            bufferManager = LicGLHelpers.FrameBufferManager(w, h)
+            bufferManager = LicGLHelpers.renderTargetPool.acquire(w, h)
             exportedFilename = self.getGLImageFilename()
 
             bufferManager.bindMSFB()
@@ -469,10 +568,30 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
             image = image.transpose(Image.FLIP_TOP_BOTTOM)
             image.save(exportedFilename)
         finally:
-            bufferManager.cleanup()
+            LicGLHelpers.renderTargetPool.release(bufferManager)
             if self.scene().parent():
                 self.scene().parent().notificationArea.setText("Saved to: %s" % exportedFilename)
         
+    def createPreviewImage(self, scale):
+        """ Render this page's GL items offscreen at reduced size, as a stand-in while the view is zoomed or scrolled. """
+
+        w = int(Page.PageSize.width() * scale)
+        h = int(Page.PageSize.height() * scale)
+        bufferManager = LicGLHelpers.renderTargetPool.acquire(w, h)
+        try:
+            bufferManager.bindMSFB()
+            LicGLHelpers.initFreshContext(True)
+
+            self.drawGLItemsOffscreen(QRectF(0, 0, w, h), scale)
+            bufferManager.blitMSFB()
+            data = bufferManager.readFB()
+        finally:
+            LicGLHelpers.renderTargetPool.release(bufferManager)
+
+        image = Image.fromstring("RGBA", (w, h), data)
+        image = image.transpose(Image.FLIP_TOP_BOTTOM)
+        return QImage(image.tostring("raw", "BGRA"), w, h, QImage.Format_ARGB32).copy()
+
     def drawGLItems(self, rect):
         
         LicGLHelpers.pushAllGLMatrices()
@@ -484,8 +603,8 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
         for glItem in self.glItemIterator():
             if rect.intersects(glItem.mapToScene(glItem.rect()).boundingRect()):
                 glItem.paintGL(f)
-            elif hasattr(glItem, "isDirty") and glItem.isDirty:
-                glItem.paintGL(f)
+            elif hasattr(glItem, "isDirty") and glItem.isDirty and not self.scene().interacting:
+                glItem.paintGL(f)  # Off screen dirty items regenerate now, unless the user is busy zooming or scrolling
 
         LicGLHelpers.popAllGLMatrices()
 
@@ -499,6 +618,12 @@ class Page(PageTreeManager, GraphicsRoundRectItem):
             
         LicGLHelpers.popAllGLMatrices()
 
+    def releaseGLItems(self):
+        """ Free the GL display lists held by this page's CSIs; they are rebuilt the next time they're drawn. """
+        for glItem in self.glItemIterator():
+            if hasattr(glItem, "releaseGLDisplayList"):
+                glItem.releaseGLDisplayList()
+
     def glItemIterator(self):
         if self.submodelItem:
             if self.submodelItem.isSubAssembly:
@@ -819,31 +944,56 @@ class PartListPLI(PLI):
         for item in self.pliItems:
             item.initLayout()
     
-        partList = list(self.pliItems)
-        partList.sort(key = lambda x: (x.color.sortKey() if (x.color) else LicColor.red().sortKey(), x.rect().width()))
-        
-        columnWidth = 0
-        mx, my = PLI.margin.x(), PLI.margin.y() 
-        x, y = mx, my
-        
-        for item in partList:
-            
-            newHeight = item.rect().height() + my
+        partList = PartListPLI.sortItems(self.pliItems)
+        pageList, overflowList = PartListPLI.packPages(partList, self.rect().width(), self.rect().height(), 1)
+        for item, x, y in pageList[0]:
+            item.setPos(x, y)
 
-            if y + newHeight > self.rect().height():  # Start new column
-                x += columnWidth + (mx * 2)
-                y = my
-                columnWidth = item.rect().width()
-                
-            if x + item.rect().width() > self.rect().width():  # This item overflowed the right edge of page - abort
-                index = partList.index(item)
-                return partList[index:]
+        return overflowList
 
-            item.setPos(x, y)
-            y += newHeight
-            columnWidth = max(columnWidth, item.rect().width())
+    @staticmethod
+    def sortItems(itemList):
+        """ Part lists read by colour, then by width """
+        return sorted(itemList, key = lambda x: (x.color.sortKey() if (x.color) else LicColor.red().sortKey(), x.rect().width()))
+
+    @staticmethod
+    def packPages(itemList, width, height, maxPages = None):
+        """
+        Pack PLIItems onto as few width x height pages as possible, without moving anything.  Each item,
+        in the order given, goes on the earliest page with room for it: the order mostly survives, while gaps
+        left on a full page are filled by smaller parts further down the list.
+        Returns a list of [(item, x, y)] for each page, and the items that didn't fit on maxPages pages.
+        """
+        mx, my = PLI.margin.x(), PLI.margin.y()
+        packerList = []  # [packer, [(item, x, y)], free area, smallest (w, h) that didn't fit]
+        overflowList = []
 
-        return []  # All items fit on this page
+        for item in itemList:
+            w, h = item.rect().width() + mx, item.rect().height() + my
+
+            for page in packerList:
+                packer, positions, freeArea, rejected = page
+                if w * h > freeArea or (rejected and w >= rejected[0] and h >= rejected[1]):
+                    continue  # Can't possibly fit here
+                point = packer.TryPack(w, h)
+                if point:
+                    positions.append((item, mx + point.x, my + point.y))
+                    page[2] -= w * h
+                    break
+                if not rejected or (w <= rejected[0] and h <= rejected[1]):
+                    page[3] = (w, h)
+            else:
+                if maxPages is not None and len(packerList) >= maxPages:
+                    overflowList.append(item)
+                    continue
+                packer = CygonRectanglePacker(width - mx, height - my)
+                point = packer.TryPack(w, h)
+                if point is None:  # Bigger than a whole page: give it a page to itself
+                    packerList.append([packer, [(item, mx, my)], 0.0, None])
+                else:
+                    packerList.append([packer, [(item, mx + point.x, my + point.y)], (width - mx) * (height - my) - (w * h), None])
+
+        return [page[1] for page in packerList], overflowList
 
 class PartListPage(PartListPageTreeManager, Page):
     
@@ -859,10 +1009,6 @@ class PartListPage(PartListPageTreeManager, Page):
         self.numberItem._row = 0
         self.pli = PartListPLI(self)
 
-    def initFullPartList(self):
-        for part in self.submodel.getFullPartList():
-            self.pli.addPart(part)
-
     def initPartialItemList(self, itemList):
         self.pli.pliItems = itemList
         for item in itemList:
@@ -909,18 +1055,62 @@ class PartListPage(PartListPageTreeManager, Page):
             menu.addAction("Show Design numbers" ,self.numbering)
         menu.exec_(event.screenPos())
 
-    def updatePartList(self):
-
-        self.pli.removeAllParts()
-        self.initFullPartList()
-        pageList = [self]
-        overflowList = self.doOverflowLayout()
-
-        while overflowList != []:
-            page = PartListPage(self.instructions, pageList[-1]._number + 1, pageList[-1]._row + 1)
-            page.initPartialItemList(overflowList)
-            pageList.append(page)
-            overflowList = page.doOverflowLayout()
+    def updatePartList(self, pageList = None):
+        """
+        Bring this part list (this page, followed by the rest of pageList) up to date with the model's parts.
+        Existing PLIItems and pages are reused; new ones are only made for new parts and extra pages, and
+        left over pages are removed from the scene.  Returns the new list of part list pages.
+        """
+        pageList = pageList or [self]
+
+        # Every part in the model, from its bill of materials
+        partDict, countDict = {}, {}
+        for abstractPart, color, count in self.submodel.bom.getItemList():
+            key = BillOfMaterials.getKey(abstractPart, color)
+            countDict[key] = count
+            partDict[key] = (abstractPart, color)
+
+        # Update the PLIItems we already have, and drop any whose part is gone
+        itemDict = {}
+        for page in pageList:
+            for item in page.pli.pliItems:
+                key = BillOfMaterials.getKey(item.abstractPart, item.color)
+                if key in countDict and key not in itemDict:
+                    itemDict[key] = item
+                    if item.quantity != countDict[key]:
+                        item.setQuantity(countDict[key])
+                        item.initLayout()
+                else:
+                    self.scene().removeItem(item)
+                    item.setParentItem(None)
+
+        for key, count in countDict.items():
+            if key not in itemDict:
+                abstractPart, color = partDict[key]
+                item = PLIItem(self.pli, abstractPart, color, count)
+                item.initLayout()
+                itemDict[key] = item
+
+        self.pli.resetRect()
+        pli = self.pli.rect()
+        packedPages, unused = PartListPLI.packPages(PartListPLI.sortItems(itemDict.values()), pli.width(), pli.height())
+
+        # Reuse as many existing pages as we can, add new ones as needed & remove the rest
+        while len(pageList) < len(packedPages):
+            pageList.append(PartListPage(self.instructions, pageList[-1]._number + 1, pageList[-1]._row + 1))
+        for page in pageList[max(1, len(packedPages)):]:
+            self.scene().removeItem(page)
+        pageList = pageList[:max(1, len(packedPages))]
+
+        for page in pageList:
+            page.pli.pliItems = []
+        for page, positions in zip(pageList, packedPages):
+            page.pli.resetRect()
+            for item, x, y in positions:
+                if item.parentItem() is not page.pli:
+                    item.setParentItem(page.pli)
+                item.setPos(x, y)
+                page.pli.pliItems.append(item)
 
         return pageList
 
@@ -945,7 +1135,7 @@ class PartListPage(PartListPageTreeManager, Page):
     def createPartListPages(instructions):
 
         page = PartListPage(instructions)
-        return page.updatePartList()
+        return page.updatePartList([page])
 
 class EditableTextItem(QGraphicsSimpleTextItem):
     
@@ -1131,7 +1321,7 @@ class TitlePage(TitlePageTreeManager, Page):
             self.labels.append(label)
 
     def addPartCountLabel(self, useUndo = False):
-        text = "%d pcs." % len(self.submodel.getFullPartList())
+        text = "%d pcs." % sum(self.submodel.bom.getTotals().values())
         self.addNewLabel(None, None, text, useUndo)
         self.setPartCountLabelPos(self.labels[-1])
 
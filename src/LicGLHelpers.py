@@ -14,15 +14,34 @@
     along with this program.  If not, see http://creativecommons.org/licenses/by-sa/3.0/
 """
 
+import collections
+import ctypes
+import math
+import os
+import re
+import sys
+import time
+
 import Image, ImageChops
 from OpenGL.GL import *
 from OpenGL.GL.EXT.framebuffer_blit import *
 from OpenGL.GL.EXT.framebuffer_multisample import *
 from OpenGL.GL.EXT.framebuffer_object import *
 from OpenGL.GLU import *
-from PyQt4.QtCore import QPointF
+from PyQt4.QtCore import QPointF, QSettings
 from PyQt4.QtOpenGL import QGLFormat, QGL
 from LicHelpers import writeLogAccess
+import config
+
+try:
+    from OpenGL.raw.GL.VERSION.GL_1_0 import glReadPixels as _rawReadPixels  # PyOpenGL 3.1+
+except ImportError:
+    from OpenGL.raw.GL import glReadPixels as _rawReadPixels
+
+try:
+    import numpy
+except ImportError:
+    numpy = None  # Optional - without it, parts are sized by rendering them and reading the pixels back
 
 
 # Optimization: turn off PyOpenGL error checking, which is a major source of slowdown
@@ -37,9 +56,160 @@ def IdentityMatrix():
             0.0, 0.0, 1.0, 0.0,
             0.0, 0.0, 0.0, 1.0]
 
+class GLCapabilities(object):
+    """
+    What this machine's OpenGL offers, and the render path chosen for it.  Lic only has a display
+    list renderer, so the choice is between the hardware driver and Mesa's software rasterizer
+    (llvmpipe), plus the multisample count and whether pixels are read back through PBOs.
+    """
+
+    def __init__(self):
+        self.vendor = self.renderer = self.version = ""
+        self.extensions = set()
+        self.hasFBO = self.hasMultisampleFBO = self.hasPBO = True
+        self.maxSamples = 8
+        self.isSoftware = False
+
+        self.backend = 'hardware'  # Or 'software'
+        self.samples = 8
+        self.usePBO = True
+        self.retryingHardware = False  # True if the cached backend is software, but this run tries the hardware driver again
+
+    def signature(self):
+        return "%s | %s | %s" % (self.vendor, self.renderer, self.version)
+
+glCapabilities = GLCapabilities()
+HardwareRetryInterval = 10  # Starts on the software backend between tries of the hardware driver
+
+def getGLProbeSettings():
+    return QSettings(os.path.join(config.rootCachePath(), 'glprobe.ini'), QSettings.IniFormat)
+
+def loadGLCapabilities():
+    """
+    Restore the render path cached by a previous probeGLCapabilities.  Must run before any GL context
+    is created, since the software backend only takes effect for contexts created afterwards.
+    """
+    settings = getGLProbeSettings()
+    glCapabilities.backend = str(settings.value("GL/Backend", 'hardware').toString())
+    glCapabilities.samples = settings.value("GL/Samples", 8).toInt()[0]
+    glCapabilities.usePBO = settings.value("GL/UsePBO", True).toBool()
+
+    if glCapabilities.backend != 'software':
+        return
+
+    # Drivers get fixed & upgraded, so every so often give the hardware driver another chance
+    retryIn = settings.value("GL/HardwareRetryIn", HardwareRetryInterval).toInt()[0] - 1
+    if retryIn <= 0:
+        glCapabilities.retryingHardware = True
+        settings.setValue("GL/HardwareRetryIn", HardwareRetryInterval)
+    else:
+        settings.setValue("GL/HardwareRetryIn", retryIn)
+        os.environ['LIBGL_ALWAYS_SOFTWARE'] = '1'  # Ask Mesa for llvmpipe
+
+def probeGLCapabilities():
+    """
+    Record the current context's GL version, extensions, multisample and FBO support, then pick the
+    sample count and readback path.  The first time a GL driver is seen, a short benchmark settles
+    the choice; after that the cached result is reused.  Assumes the main GL widget's context is current.
+    """
+    caps = glCapabilities
+    caps.vendor = glGetString(GL_VENDOR) or ""
+    caps.renderer = glGetString(GL_RENDERER) or ""
+    caps.version = glGetString(GL_VERSION) or ""
+    caps.extensions = set((glGetString(GL_EXTENSIONS) or "").split())
+
+    caps.hasFBO = 'GL_EXT_framebuffer_object' in caps.extensions and bool(glGenFramebuffersEXT)
+    caps.hasMultisampleFBO = caps.hasFBO and 'GL_EXT_framebuffer_multisample' in caps.extensions and 'GL_EXT_framebuffer_blit' in caps.extensions
+    versionNumber = [int(x) for x in re.findall(r"\d+", caps.version)[:2]]
+    caps.hasPBO = pixelBufferObjectsSupported() and ('GL_ARB_pixel_buffer_object' in caps.extensions or versionNumber >= [2, 1])
+    caps.maxSamples = int(glGetIntegerv(GL_MAX_SAMPLES_EXT)) if caps.hasMultisampleFBO else 0
+    caps.isSoftware = any(name in caps.renderer.lower() for name in ['llvmpipe', 'softpipe', 'software', 'gdi generic'])
+
+    settings = getGLProbeSettings()
+    if str(settings.value("GL/Signature").toString()) == caps.signature():
+        caps.samples = min(settings.value("GL/Samples").toInt()[0], caps.maxSamples)
+        caps.usePBO = caps.hasPBO and settings.value("GL/UsePBO").toBool()
+    elif caps.hasFBO:
+        caps.samples, caps.usePBO = _benchmarkRenderPaths(caps)
+    else:
+        caps.samples, caps.usePBO = 0, False
+
+    # Sizing, export & previews all need FBOs.  Mesa's llvmpipe always has them, so use it from the next start on.
+    # Only a probe of the hardware driver can tell, so a software context leaves the cached backend alone.
+    if not caps.isSoftware:
+        if caps.hasFBO:
+            caps.backend = 'hardware'
+        elif sys.platform.startswith('linux'):
+            caps.backend = 'software'
+            settings.setValue("GL/HardwareRetryIn", HardwareRetryInterval)
+
+    settings.setValue("GL/Signature", caps.signature())
+    settings.setValue("GL/Backend", caps.backend)
+    settings.setValue("GL/Samples", caps.samples)
+    settings.setValue("GL/UsePBO", caps.usePBO)
+
+    writeLogAccess("OpenGL: %s\nFBO: %s, multisample FBO: %s (max %d samples), PBO: %s\nUsing %s backend%s, %d samples, %s readback" %
+                   (caps.signature(), caps.hasFBO, caps.hasMultisampleFBO, caps.maxSamples, caps.hasPBO,
+                    caps.backend, " (hardware driver retried this run)" if caps.retryingHardware else "",
+                    caps.samples, "PBO" if caps.usePBO else "synchronous"))
+    return caps
+
+def _benchmarkRenderPaths(caps, size = 512, frames = 8):
+    """
+    Render & read back a few frames of a test sphere for each candidate path.  Returns (samples, usePBO):
+    the faster readback path, and the most samples costing at most twice a single sample render.
+    """
+    dispID = glGenLists(1)
+    glNewList(dispID, GL_COMPILE)
+    gluSphere(gluNewQuadric(), size / 3.0, 48, 48)
+    glEndList()
+
+    def timeFrames(samples, usePBO):
+        target = FrameBufferManager(size, size, samples)
+        if not target.isComplete:
+            target.cleanup()
+            return None
+        readback = PixelReadback(size, size, "RGBA", usePBO = usePBO)
+        start = time.time()
+        for unused in range(frames):
+            target.bindMSFB()
+            clear([1.0, 1.0, 1.0, 1.0])
+            adjustGLViewport(0, 0, size, size)
+            glCallList(dispID)
+            target.blitMSFB()
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, target.frameBuffer)
+            readback.queueRead(lambda img: img.getbbox())
+        readback.flush()
+        glFinish()
+        elapsed = time.time() - start
+        readback.cleanup()
+        target.cleanup()
+        return elapsed
+
+    pushAllGLMatrices()
+    try:
+        syncTime = timeFrames(0, False)
+        pboTime = timeFrames(0, True) if caps.hasPBO else None
+        usePBO = pboTime is not None and (syncTime is None or pboTime < syncTime)
+        baseTime = pboTime if usePBO else syncTime
+
+        samples = 0
+        for candidate in [8, 4, 2]:
+            if candidate <= caps.maxSamples:
+                elapsed = timeFrames(candidate, usePBO)
+                if elapsed is not None and baseTime is not None and elapsed <= baseTime * 2.0:
+                    samples = candidate
+                    break
+    finally:
+        popAllGLMatrices()
+        glDeleteLists(dispID, 1)
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+
+    return samples, usePBO
+
 def getGLFormat():
-    format = QGLFormat(QGL.SampleBuffers)
-    format.setSamples(8)
+    format = QGLFormat(QGL.SampleBuffers if glCapabilities.samples > 0 else QGL.NoSampleBuffers)
+    format.setSamples(max(glCapabilities.samples, 1))
     return format
 
 def drawCoordLines(length = 20.0):
@@ -114,13 +284,18 @@ def clear(clearColor):
     glClearColor(*clearColor)
     glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
     
-def initFreshContext(doClear):
+def initFreshContext(doClear, lowDetail = False):
+    """ lowDetail skips multisampling and line smoothing, for cheap previews while zooming or scrolling. """
     global __LIC_GL_LINE_THICKNESS
     
     glLightModeli(GL_LIGHT_MODEL_LOCAL_VIEWER, 0)
     glShadeModel(GL_SMOOTH)
-    glEnable(GL_MULTISAMPLE)
-    glEnable(GL_LINE_SMOOTH)
+    if lowDetail:
+        glDisable(GL_MULTISAMPLE)
+        glDisable(GL_LINE_SMOOTH)
+    else:
+        glEnable(GL_MULTISAMPLE)
+        glEnable(GL_LINE_SMOOTH)
 
     setupLighting()
     setupMaterial()
@@ -187,9 +362,89 @@ def popAllGLMatrices():
     glPopMatrix()
     glPopAttrib()
 
+def pixelBufferObjectsSupported():
+    return bool(glGenBuffers) and bool(glMapBuffer)
+
+class PixelReadback(object):
+    """
+    Reads back w x h pixels of the bound read frame buffer through a ring of pixel buffer objects.
+    queueRead starts the transfer and returns immediately; consumers are only called once the ring
+    is full (or on flush), so the GPU renders the next image while the previous one is copied out.
+    Consumers get a PIL image, or with asArray a numpy array, mapped directly onto the buffer's
+    memory, and must not keep it after they return.  Without PBO support, every read is synchronous.
+    """
+
+    def __init__(self, w, h, mode = "RGBA", depth = 2, usePBO = None):
+        self.w, self.h, self.mode = w, h, mode
+        self.glFormat = GL_RGBA if mode == "RGBA" else GL_RGB
+        self.byteCount = w * h * len(mode)
+        self.pending = collections.deque()  # (pbo, consumer, flip, asArray), oldest first
+        self.free = []
+
+        self.usePBO = pixelBufferObjectsSupported() and (glCapabilities.usePBO if usePBO is None else usePBO)
+        if self.usePBO:
+            for unused in range(depth):
+                pbo = int(glGenBuffers(1))
+                glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+                glBufferData(GL_PIXEL_PACK_BUFFER, self.byteCount, None, GL_STREAM_READ)
+                self.free.append(pbo)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+
+    def __image(self, data, flip, asArray):
+        if asArray:
+            pixels = _pixelArray(data, self.w, self.h)
+            return pixels[::-1] if flip else pixels
+        # GL rows run bottom to top; a -1 orientation flips them in the mapping itself, without a copy
+        return Image.frombuffer(self.mode, (self.w, self.h), data, "raw", self.mode, 0, -1 if flip else 1)
+
+    def queueRead(self, consumer, flip = False, asArray = False):
+        """
+        Start reading the bound read frame buffer.  consumer(image) is called later, from queueRead or flush.
+        With asArray (needs numpy), consumer gets an (h, w, bands) uint8 array instead of a PIL image.
+        """
+        if not self.usePBO:
+            data = glReadPixels(0, 0, self.w, self.h, self.glFormat, GL_UNSIGNED_BYTE)
+            consumer(self.__image(data, flip, asArray))
+            return
+
+        if not self.free:
+            self.__consumeOldest()
+
+        pbo = self.free.pop()
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        _rawReadPixels(0, 0, self.w, self.h, self.glFormat, GL_UNSIGNED_BYTE, ctypes.c_void_p(0))
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+        self.pending.append((pbo, consumer, flip, asArray))
+
+    def __consumeOldest(self):
+        pbo, consumer, flip, asArray = self.pending.popleft()
+        glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+        address = glMapBuffer(GL_PIXEL_PACK_BUFFER, GL_READ_ONLY)
+        if not isinstance(address, (int, long)):
+            address = ctypes.cast(address, ctypes.c_void_p).value
+        try:
+            consumer(self.__image((ctypes.c_ubyte * self.byteCount).from_address(address), flip, asArray))
+        finally:
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, pbo)
+            glUnmapBuffer(GL_PIXEL_PACK_BUFFER)
+            glBindBuffer(GL_PIXEL_PACK_BUFFER, 0)
+            self.free.append(pbo)
+
+    def flush(self, keep = 0):
+        """ Hand pending reads to their consumers, leaving the newest keep reads in flight. """
+        while len(self.pending) > keep:
+            self.__consumeOldest()
+
+    def cleanup(self):
+        self.flush()
+        for pbo in self.free:
+            glDeleteBuffers(1, [pbo])
+        self.free = []
+
 class FrameBufferManager(object):
 
-    def __init__(self, w, h):
+    def __init__(self, w, h, samples = -1):
+        """ samples: -1 uses the probed sample count (see probeGLCapabilities); 0 builds a single sample buffer only. """
 
         # Create non-multisample FBO that we can call glReadPixels on
         self.w, self.h = w, h
@@ -209,35 +464,49 @@ class FrameBufferManager(object):
         glFramebufferRenderbufferEXT(GL_FRAMEBUFFER_EXT, GL_COLOR_ATTACHMENT0_EXT, GL_RENDERBUFFER_EXT, self.colorBuffer);
         glFramebufferRenderbufferEXT(GL_FRAMEBUFFER_EXT, GL_DEPTH_ATTACHMENT_EXT, GL_RENDERBUFFER_EXT, self.depthBuffer);
 
-        # Setup multisample framebuffer
-        self.multisampleFrameBuffer = glGenFramebuffersEXT(1)
-        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.multisampleFrameBuffer)
+        self.requestedSamples = samples
+        self.samples = min(glCapabilities.samples, glCapabilities.maxSamples) if samples < 0 else samples
+        self.isComplete = glCheckFramebufferStatusEXT(GL_FRAMEBUFFER_EXT) == GL_FRAMEBUFFER_COMPLETE_EXT
+        self.multisampleFrameBuffer = None
+
+        if self.samples > 0:
+            # Setup multisample framebuffer
+            self.multisampleFrameBuffer = glGenFramebuffersEXT(1)
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.multisampleFrameBuffer)
 
-        # multisample color & depth buffers
-        maxSamples = glGetIntegerv(GL_MAX_SAMPLES_EXT)
-        self.multisampleColorBuffer = glGenRenderbuffersEXT(1)
-        glBindRenderbufferEXT(GL_RENDERBUFFER_EXT, self.multisampleColorBuffer)
-        glRenderbufferStorageMultisampleEXT(GL_RENDERBUFFER_EXT, maxSamples, GL_RGBA, w, h)
+            # multisample color & depth buffers
+            self.multisampleColorBuffer = glGenRenderbuffersEXT(1)
+            glBindRenderbufferEXT(GL_RENDERBUFFER_EXT, self.multisampleColorBuffer)
+            glRenderbufferStorageMultisampleEXT(GL_RENDERBUFFER_EXT, self.samples, GL_RGBA, w, h)
 
-        self.multisampleDepthBuffer = glGenRenderbuffersEXT(1)
-        glBindRenderbufferEXT(GL_RENDERBUFFER_EXT, self.multisampleDepthBuffer)
-        glRenderbufferStorageMultisampleEXT(GL_RENDERBUFFER_EXT, maxSamples, GL_DEPTH_COMPONENT, w, h)
+            self.multisampleDepthBuffer = glGenRenderbuffersEXT(1)
+            glBindRenderbufferEXT(GL_RENDERBUFFER_EXT, self.multisampleDepthBuffer)
+            glRenderbufferStorageMultisampleEXT(GL_RENDERBUFFER_EXT, self.samples, GL_DEPTH_COMPONENT, w, h)
 
-        # bind multisample color & depth buffers
-        glFramebufferRenderbufferEXT(GL_FRAMEBUFFER_EXT, GL_COLOR_ATTACHMENT0_EXT, GL_RENDERBUFFER_EXT, self.multisampleColorBuffer);
-        glFramebufferRenderbufferEXT(GL_FRAMEBUFFER_EXT, GL_DEPTH_ATTACHMENT_EXT, GL_RENDERBUFFER_EXT, self.multisampleDepthBuffer);
+            # bind multisample color & depth buffers
+            glFramebufferRenderbufferEXT(GL_FRAMEBUFFER_EXT, GL_COLOR_ATTACHMENT0_EXT, GL_RENDERBUFFER_EXT, self.multisampleColorBuffer);
+            glFramebufferRenderbufferEXT(GL_FRAMEBUFFER_EXT, GL_DEPTH_ATTACHMENT_EXT, GL_RENDERBUFFER_EXT, self.multisampleDepthBuffer);
 
-        # Make sure multisample fbo is fully initialized
-        status = glCheckFramebufferStatusEXT(GL_FRAMEBUFFER_EXT);
-        if status != GL_FRAMEBUFFER_COMPLETE_EXT:
+            # Make sure multisample fbo is fully initialized
+            self.isComplete = self.isComplete and glCheckFramebufferStatusEXT(GL_FRAMEBUFFER_EXT) == GL_FRAMEBUFFER_COMPLETE_EXT
+
+        if not self.isComplete:
             print "Error in framebuffer activation - cannot generate images"
 
+        self.readbacks = {}  # {PIL mode: PixelReadback}, created on first use
+
+    def byteSize(self):
+        """ Rough GPU memory used by this manager: RGBA color plus depth, per sample, plus readback buffers. """
+        return self.w * self.h * 8 * (1 + self.samples) + sum(r.byteCount * 2 for r in self.readbacks.values())
+
     def bindMSFB(self):
-        """ Bind multisampled FBO for writing."""
-        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.multisampleFrameBuffer)
+        """ Bind multisampled FBO for writing, or the regular FBO if this manager has no multisampling."""
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.multisampleFrameBuffer or self.frameBuffer)
 
     def blitMSFB(self):
         """ Bind multisampled FBO for reading, regular FBO for writing then blit away."""
+        if self.multisampleFrameBuffer is None:
+            return
         glBindFramebufferEXT(GL_READ_FRAMEBUFFER_EXT, self.multisampleFrameBuffer);
         glBindFramebufferEXT(GL_DRAW_FRAMEBUFFER_EXT, self.frameBuffer);
         glBlitFramebufferEXT(0, 0, self.w, self.h, 0, 0, self.w, self.h, GL_COLOR_BUFFER_BIT, GL_NEAREST);
@@ -248,15 +517,115 @@ class FrameBufferManager(object):
         data = glReadPixels(0, 0, self.w, self.h, GL_RGBA, GL_UNSIGNED_BYTE)
         return data
 
+    def getReadback(self, mode = "RGBA"):
+        if mode not in self.readbacks:
+            self.readbacks[mode] = PixelReadback(self.w, self.h, mode)
+        return self.readbacks[mode]
+
+    def queueReadFB(self, consumer, flip = True):
+        """ Bind the normal FBO for reading, then queue an asynchronous read of it.  See PixelReadback. """
+        glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, self.frameBuffer)
+        self.getReadback().queueRead(consumer, flip)
+
+    def flushReads(self):
+        for readback in self.readbacks.values():
+            readback.flush()
+
     def cleanup(self):
         """ Clean up all internal framebuffers - essential for recovering main glWidget's state."""
+        for readback in self.readbacks.values():
+            readback.cleanup()
+        self.readbacks = {}
+
         glDeleteFramebuffersEXT(1, [self.frameBuffer])
         glDeleteRenderbuffersEXT(1, [self.colorBuffer])
         glDeleteRenderbuffersEXT(1, [self.depthBuffer])
 
-        glDeleteFramebuffersEXT(1, [self.multisampleFrameBuffer])
-        glDeleteRenderbuffersEXT(1, [self.multisampleDepthBuffer])
-        glDeleteRenderbuffersEXT(1, [self.multisampleColorBuffer])
+        if self.multisampleFrameBuffer is not None:
+            glDeleteFramebuffersEXT(1, [self.multisampleFrameBuffer])
+            glDeleteRenderbuffersEXT(1, [self.multisampleDepthBuffer])
+            glDeleteRenderbuffersEXT(1, [self.multisampleColorBuffer])
+
+class RenderTargetPool(object):
+    """
+    Keeps FrameBufferManagers alive between uses, keyed by (width, height, samples), so sizing,
+    pixmap resets and exports stop allocating GPU buffers on every call.  Least recently used
+    targets are freed once the pool grows past maxBytes, or when a new target cannot be created.
+    All targets belong to the main GL widget's context, which must be current when using the pool.
+    """
+
+    def __init__(self, maxBytes = 256 * 1024 * 1024):
+        self.maxBytes = maxBytes
+        self.targets = collections.OrderedDict()  # {(w, h, samples): FrameBufferManager}, oldest first
+        self.inUse = set()  # keys of targets currently acquired - never freed
+
+    def acquire(self, w, h, samples = -1):
+        key = (w, h, samples)
+        target = self.targets.pop(key, None)
+        if target is None:
+            target = FrameBufferManager(w, h, samples)
+            if not target.isComplete and len(self.targets) > len(self.inUse):
+                target.cleanup()  # Likely out of GPU memory - drop everything idle and try again
+                self.clear()
+                target = FrameBufferManager(w, h, samples)
+
+        self.targets[key] = target
+        self.inUse.add(key)
+        self.trim()
+        return target
+
+    def release(self, target, rebind = True):
+        """ Hand target back to the pool, and rebind the GL widget's own frame buffer unless rebind is False. """
+        self.inUse.discard((target.w, target.h, target.requestedSamples))
+        if rebind:
+            glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, 0)
+
+    def trim(self):
+        total = sum(t.byteSize() for t in self.targets.values())
+        for key, target in self.targets.items():
+            if total <= self.maxBytes:
+                break
+            if key not in self.inUse:
+                total -= target.byteSize()
+                target.cleanup()
+                del self.targets[key]
+
+    def clear(self):
+        """ Free every target that is not currently acquired. """
+        for key, target in self.targets.items():
+            if key not in self.inUse:
+                target.cleanup()
+                del self.targets[key]
+
+renderTargetPool = RenderTargetPool()
+
+AtlasSize = 2048  # Largest buffer ever allocated for sizing; atlases are always this big
+MaxTiledSize = 8192  # Largest virtual buffer initTiledImgSize will piece together from AtlasSize windows
+
+def beginOffscreenSizing(size):
+    """
+    Bind a pooled, single sample size x size target for initImgSize, saving every bit of
+    GL state sizing touches.  Must be paired with endOffscreenSizing.  Sizes beyond AtlasSize
+    bind an AtlasSize target, which initImgSize then renders in tiles.
+    """
+    size = min(size, AtlasSize)
+    target = renderTargetPool.acquire(size, size, 0)
+    target.previousFrameBuffer = int(glGetIntegerv(GL_FRAMEBUFFER_BINDING_EXT))
+    target.bindMSFB()
+
+    glPushAttrib(GL_ENABLE_BIT | GL_CURRENT_BIT | GL_COLOR_BUFFER_BIT | GL_LINE_BIT)
+    pushAllGLMatrices()
+    glDisable(GL_LIGHTING)
+    glDisable(GL_DEPTH_TEST)
+    glDisable(GL_MULTISAMPLE)
+    glLineWidth(1.0)
+    return target
+
+def endOffscreenSizing(target):
+    popAllGLMatrices()
+    glPopAttrib()
+    renderTargetPool.release(target, False)
+    glBindFramebufferEXT(GL_FRAMEBUFFER_EXT, target.previousFrameBuffer)
 
 def _checkImgBounds(top, bottom, left, right, size):
     if (top == 0) or (bottom == size):
@@ -266,23 +635,23 @@ def _checkImgBounds(top, bottom, left, right, size):
     return False
 
 _imgWhite = (255, 255, 255)
-def _getLeftInset(data, width, top):
+def _getLeftInset(data, width, top, white = _imgWhite):
     for x in range(0, width):
-        if (data[x, top] != _imgWhite):
+        if (data[x, top] != white):
             return x
     print "Error: left inset not found!! w: %d, t: %d" % (width, top)
     return 0
 
-def _getBottomInset(data, height, left):
+def _getBottomInset(data, height, left, white = _imgWhite):
     for y in range(0, height):
-        if (data[left, y] != _imgWhite):
+        if (data[left, y] != white):
             return y
     print "Error: bottom inset not found!! h: %d, l: %d" % (height, left)
     return 0
 
 bgCache = {}
 
-def _getBounds(size, glDispID, filename, scale, rotation, partRotation):
+def _drawForBounds(size, glDispID, scale, rotation, partRotation):
     
     # Clear the drawing buffer with white
     glClearColor(1.0, 1.0, 1.0, 1.0)
@@ -296,28 +665,90 @@ def _getBounds(size, glDispID, filename, scale, rotation, partRotation):
 
     glCallList(glDispID)
 
+def _getImageBounds(img, size):
+
     # Use PIL to find the image's bounding box (sweet)
-    pixels = glReadPixels(0, 0, size, size, GL_RGB,  GL_UNSIGNED_BYTE)
-    img = Image.fromstring("RGB", (size, size), pixels)
-    
-    bg = bgCache.setdefault(size, Image.new("RGB", img.size, (255, 255, 255)))
+    white = (255,) * len(img.getbands())
+    bg = bgCache.setdefault((size, img.mode), Image.new(img.mode, img.size, white))
     box = ImageChops.difference(img, bg).getbbox()
 
     if box is None:
         return (0, 0, 0, 0, 0, 0)  # Rendered entirely out of frame
 
+    # Find the bottom left corner inset, used for placing PLIItem quantity labels
+    data = img.load()
+    leftInset = _getLeftInset(data, size, box[1], white)
+    bottomInset = _getBottomInset(data, size, box[0], white)
+    return box + (leftInset - box[0], bottomInset - box[1])
+
+def _pixelArray(data, w, h):
+    """ View raw glReadPixels or pixel buffer data as an (h, w, bands) uint8 array, without copying. """
+    if isinstance(data, ctypes.Array):
+        data = numpy.ctypeslib.as_array(data)
+    return numpy.frombuffer(data, numpy.uint8).reshape(h, w, -1)
+
+def _getMaskBounds(drawn):
+    """
+    numpy equivalent of _getImageBounds, for a whole (n, size, size) stack of drawn pixel masks at once.
+    Returns a list of n (left, top, right, bottom, leftInset, bottomInset) tuples.
+    """
+    count, size = drawn.shape[0], drawn.shape[1]
+    rows, cols = drawn.any(2), drawn.any(1)
+    top, bottom = rows.argmax(1), size - rows[:, ::-1].argmax(1)
+    left, right = cols.argmax(1), size - cols[:, ::-1].argmax(1)
+
+    # Find the bottom left corner inset, used for placing PLIItem quantity labels
+    images = numpy.arange(count)
+    leftInset = drawn[images, top, :].argmax(1) - left
+    bottomInset = drawn[images, :, left].argmax(1) - top
+    empty = ~rows.any(1)
+
+    boundsList = []
+    for i in range(count):
+        if empty[i]:
+            boundsList.append((0, 0, 0, 0, 0, 0))  # Rendered entirely out of frame
+        else:
+            boundsList.append(tuple(int(v[i]) for v in (left, top, right, bottom, leftInset, bottomInset)))
+    return boundsList
+
+def _getArrayBounds(pixels):
+    """ _getImageBounds for a square (size, size, bands) pixel array. """
+    drawn = (pixels[:, :, :3] != 255).any(2)
+    return _getMaskBounds(drawn[numpy.newaxis])[0]
+
+def _getBounds(size, glDispID, filename, scale, rotation, partRotation):
+
+    _drawForBounds(size, glDispID, scale, rotation, partRotation)
+    pixels = glReadPixels(0, 0, size, size, GL_RGB,  GL_UNSIGNED_BYTE)
+    if numpy is not None:
+        return _getArrayBounds(_pixelArray(pixels, size, size))
+
+    img = Image.fromstring("RGB", (size, size), pixels)
+
 #    if filename:
 #        import os
 #        rawFilename = os.path.splitext(os.path.basename(filename))[0]
 #        img.save("C:\\lic\\tmp\\%s_%dx%d.png" % (rawFilename, box[2] - box[0], box[3] - box[1]))
 #        print filename + "box: " + str(box if box else "No box = shit")
 
-    # Find the bottom left corner inset, used for placing PLIItem quantity labels
-    data = img.load()
-    leftInset = _getLeftInset(data, size, box[1])
-    bottomInset = _getBottomInset(data, size, box[0])
-    return box + (leftInset - box[0], bottomInset - box[1])
+    return _getImageBounds(img, size)
+
+def _imgSizeFromBounds(bounds, size):
+    
+    left, top, right, bottom, leftInset, bottomInset = bounds
+    
+    if _checkImgBounds(top, bottom, left, right, size):
+        return None  # Drew at least one edge out of bounds - try next buffer size
+    
+    imgWidth = right - left + 1
+    imgHeight = bottom - top
     
+    w = (left + (imgWidth/2)) - (size/2)
+    h = (top + (imgHeight/2)) - (size/2)
+    imgCenter = QPointF(-w, h - 1)
+
+    return (imgWidth, imgHeight, imgCenter, leftInset, bottomInset)
+
 def initImgSize(size, glDispID, filename, scale, rotation, partRotation):
     """
     Draw this piece to the already initialized GL Frame Buffer Object, in order to calculate
@@ -335,17 +766,244 @@ def initImgSize(size, glDispID, filename, scale, rotation, partRotation):
         Otherwise, returns the (width, height, centerPoint, leftInset, bottomInset) parameters of this image.
     """
     
+    if size > AtlasSize:
+        return initTiledImgSize(size, glDispID, scale, rotation, partRotation)
+
     # Draw piece to frame buffer, then calculate bounding box
-    left, top, right, bottom, leftInset, bottomInset = _getBounds(size, glDispID, filename, scale, rotation, partRotation)
-    
-    if _checkImgBounds(top, bottom, left, right, size):
-        return None  # Drew at least one edge out of bounds - try next buffer size
-    
-    imgWidth = right - left + 1
-    imgHeight = bottom - top
-    
-    w = (left + (imgWidth/2)) - (size/2)
-    h = (top + (imgHeight/2)) - (size/2)
-    imgCenter = QPointF(-w, h - 1)
+    bounds = _getBounds(size, glDispID, filename, scale, rotation, partRotation)
+    return _imgSizeFromBounds(bounds, size)
 
-    return (imgWidth, imgHeight, imgCenter, leftInset, bottomInset)
+def initTiledImgSize(size, glDispID, scale, rotation, partRotation):
+    """
+    initImgSize for pieces too big for any real buffer: draw the piece one AtlasSize window of a
+    size x size virtual buffer at a time, then bound the pieced together drawing.
+    size must be a multiple of AtlasSize, and an AtlasSize buffer must be bound.
+    """
+    half = size / 2
+    if numpy is not None:
+        drawn = numpy.zeros((size, size), bool)
+    else:
+        img = Image.new("RGB", (size, size), _imgWhite)
+
+    glViewport(0, 0, AtlasSize, AtlasSize)
+    for y in range(0, size, AtlasSize):
+        for x in range(0, size, AtlasSize):
+
+            glClearColor(1.0, 1.0, 1.0, 1.0)
+            glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+            glColor3f(0, 0, 0)
+
+            # Same view as adjustGLViewport(0, 0, size, size), cropped to this window
+            glMatrixMode(GL_PROJECTION)
+            glLoadIdentity()
+            glOrtho(x - half, x + AtlasSize - half, y - half, y + AtlasSize - half, -3000, 3000)
+            glMatrixMode(GL_MODELVIEW)
+            glLoadIdentity()
+            rotateToView(rotation, scale)
+            rotateView(*partRotation)
+            glCallList(glDispID)
+
+            pixels = glReadPixels(0, 0, AtlasSize, AtlasSize, GL_RGB, GL_UNSIGNED_BYTE)
+            if numpy is not None:
+                drawn[y:y + AtlasSize, x:x + AtlasSize] = (_pixelArray(pixels, AtlasSize, AtlasSize) != 255).any(2)
+            else:
+                img.paste(Image.fromstring("RGB", (AtlasSize, AtlasSize), pixels), (x, y))
+
+    bounds = _getMaskBounds(drawn[numpy.newaxis])[0] if numpy is not None else _getImageBounds(img, size)
+    return _imgSizeFromBounds(bounds, size)
+
+def projectedHalfSize(vertices, scale, rotation, partRotation):
+    """
+    Half the width of the smallest square, centered buffer that holds every (x, y, z) vertex
+    once drawn the way initImgSize draws it.  Plain Python, for a handful of bounding box corners.
+    """
+    # rotateView applies z, then y, then x rotation to each vertex; partRotation goes first
+    steps = []
+    for x, y, z in (partRotation, rotation):
+        steps += [(math.radians(z), 0, 1), (math.radians(y), 2, 0), (math.radians(x), 1, 2)]
+    steps = [(math.cos(a), math.sin(a), i, j) for a, i, j in steps if a]
+
+    half = 0.0
+    for vertex in vertices:
+        p = list(vertex)
+        for c, s, i, j in steps:
+            p[i], p[j] = c * p[i] - s * p[j], s * p[i] + c * p[j]
+        half = max(half, abs(p[0]), abs(p[1]))
+    return half * scale
+
+def predictImgSize(halfSize, smallest):
+    """
+    Buffer size to size a piece of the given projectedHalfSize in: the smallest power of two from
+    smallest up that keeps the drawing off the buffer's edge.  May be bigger than AtlasSize.
+    """
+    size = smallest
+    while size < (halfSize + 2) * 2 and size < MaxTiledSize:
+        size *= 2
+    return size
+
+def sizeLadder(size):
+    """ Buffer sizes initImgSize should try, from a predicted size doubling up to MaxTiledSize. """
+    while size <= MaxTiledSize:
+        yield size
+        size *= 2
+
+def atlasTileCount(tileSize):
+    """ Number of tileSize x tileSize tiles that fit in one atlas. """
+    return (AtlasSize // tileSize) ** 2
+
+def _getAtlasBounds(pixels, tileSize, count):
+    """
+    _getImageBounds for each of the first count tiles of an atlas, tiled left to right, bottom to top.
+    pixels is a numpy array when numpy is available, a PIL image otherwise.
+    """
+    columns = AtlasSize // tileSize
+    if numpy is None:
+        boundsList = []
+        for i in range(count):
+            x, y = (i % columns) * tileSize, (i // columns) * tileSize
+            boundsList.append(_getImageBounds(pixels.crop((x, y, x + tileSize, y + tileSize)), tileSize))
+        return boundsList
+
+    # Split the atlas into a (count, tileSize, tileSize) stack of drawn pixel masks, then bound every tile at once
+    drawn = (pixels[:, :, :3] != 255).any(2)
+    drawn = drawn.reshape(columns, tileSize, columns, tileSize).transpose(0, 2, 1, 3).reshape(-1, tileSize, tileSize)
+    return _getMaskBounds(drawn[:count])
+
+def queueAtlasImgSizes(readback, tileSize, viewList, consumer):
+    """
+    Batched initImgSize: draw each view into its own tileSize square of the bound AtlasSize buffer,
+    and queue the whole atlas on readback, so dozens of pieces cost one clear and one read.
+
+    Parameters:
+        readback: An AtlasSize x AtlasSize RGBA PixelReadback, see FrameBufferManager.getReadback.
+        tileSize: Width & height of each tile, in pixels.  Must divide AtlasSize.
+        viewList: (glDispID, scale, rotation, partRotation) to draw, at most atlasTileCount(tileSize) of them.
+        consumer: Called once readback gets to the atlas, with a list holding what initImgSize would
+                  have returned for each view.  None means the view needs a bigger tile.
+    """
+    columns = AtlasSize // tileSize
+
+    glClearColor(1.0, 1.0, 1.0, 1.0)
+    glClear(GL_COLOR_BUFFER_BIT | GL_DEPTH_BUFFER_BIT)
+    glColor3f(0, 0, 0)
+
+    # Scissor each tile, so a piece that overflows its tile can't mark its neighbours
+    glPushAttrib(GL_ENABLE_BIT | GL_SCISSOR_BIT)
+    glEnable(GL_SCISSOR_TEST)
+    for i, (glDispID, scale, rotation, partRotation) in enumerate(viewList):
+        x, y = (i % columns) * tileSize, (i // columns) * tileSize
+        glScissor(x, y, tileSize, tileSize)
+        adjustGLViewport(x, y, tileSize, tileSize)
+        rotateToView(rotation, scale)
+        rotateView(*partRotation)
+        glCallList(glDispID)
+    glPopAttrib()
+
+    count = len(viewList)
+    readback.queueRead(lambda pixels: consumer([_imgSizeFromBounds(b, tileSize) for b in _getAtlasBounds(pixels, tileSize, count)]),
+                       asArray = numpy is not None)
+
+def analyticSizingAvailable():
+    return numpy is not None
+
+def createEdgeArray(edgeList):
+    """ Convert a list of ((x, y, z), (x, y, z)) edges to the (n, 2, 3) array analyticImgSize works on. """
+    return numpy.array(edgeList, dtype = float).reshape(-1, 2, 3)
+
+def transformEdges(edges, matrix):
+    """ Apply a column-major GL matrix, as stored in Part.matrix, to an (n, 2, 3) edge array. """
+    if not matrix or not len(edges):
+        return edges
+    m = numpy.array(matrix, dtype = float).reshape(4, 4).T
+    return edges.dot(m[:3, :3].T) + m[:3, 3]
+
+def _rotationMatrix(x, y, z):
+    """ numpy equivalent of rotateView(x, y, z). """
+    def rotation(angle, i, j):
+        r = numpy.identity(3)
+        c, s = numpy.cos(numpy.radians(angle)), numpy.sin(numpy.radians(angle))
+        r[i, i], r[i, j], r[j, i], r[j, j] = c, -s, s, c
+        return r
+    return rotation(x, 1, 2).dot(rotation(y, 2, 0)).dot(rotation(z, 0, 1))
+
+def _clippedMin(a, b, lo, hi):
+    """ Smallest a coordinate of any (n, 2) edge, once each edge is clipped to the band lo <= b <= hi. """
+    a0, a1, b0, b1 = a[:, 0], a[:, 1], b[:, 0], b[:, 1]
+    db = b1 - b0
+    flat = db == 0
+    t0 = (lo - b0) / numpy.where(flat, 1.0, db)
+    t1 = (hi - b0) / numpy.where(flat, 1.0, db)
+    tmin = numpy.where(flat, 0.0, numpy.clip(numpy.minimum(t0, t1), 0.0, 1.0))
+    tmax = numpy.where(flat, 1.0, numpy.clip(numpy.maximum(t0, t1), 0.0, 1.0))
+    valid = numpy.where(flat, (b0 >= lo) & (b0 <= hi), (numpy.maximum(t0, t1) >= 0.0) & (numpy.minimum(t0, t1) <= 1.0))
+    if not valid.any():
+        return None
+    da = a1 - a0
+    return numpy.minimum(a0 + da * tmin, a0 + da * tmax)[valid].min()
+
+def analyticImgSize(edges, scale, rotation, partRotation):
+    """
+    CPU equivalent of initImgSize: project every edge the way rotateToView & rotateView would, and take
+    bounds, center and insets from the projected silhouette instead of from rendered pixels.  Needs
+    neither a GL context nor a size ladder - the virtual buffer is always made big enough.
+
+    Parameters:
+        edges: (n, 2, 3) array of every line and polygon side to size, see createEdgeArray.
+        scale, rotation, partRotation: As for initImgSize.
+
+    Returns:
+        None if there is nothing to draw, otherwise the same (width, height, centerPoint, leftInset, bottomInset) as initImgSize.
+    """
+    if not len(edges):
+        return None
+
+    # rotateToView looks down +z with a 180 degree roll: screen x is model x, screen y is model -y
+    m = scale * _rotationMatrix(*rotation).dot(_rotationMatrix(*partRotation))
+    points = edges.reshape(-1, 3).dot(m.T)
+    half = int(numpy.ceil(numpy.abs(points[:, :2]).max())) + 2
+    x = (points[:, 0] + half).reshape(-1, 2)
+    y = (-points[:, 1] + half).reshape(-1, 2)
+
+    # Same conventions as the pixel bounding box of _getBounds: right & bottom are exclusive
+    left, right = int(numpy.floor(x.min())), int(numpy.floor(x.max())) + 1
+    top, bottom = int(numpy.floor(y.min())), int(numpy.floor(y.max())) + 1
+
+    # Insets: leftmost point of the silhouette in its first row, and lowest point in its first column
+    leftInset = int(numpy.floor(_clippedMin(x, y, top, top + 1.0))) - left
+    bottomInset = int(numpy.floor(_clippedMin(y, x, left, left + 1.0))) - top
+
+    return _imgSizeFromBounds((left, top, right, bottom, leftInset, bottomInset), half * 2)
+
+def rotateEdges(edges, glRotations):
+    """ Apply glRotatef style (angle, x, y, z) axis rotations, listed in the order they'd be called, to an edge or point array. """
+    r = numpy.identity(3)
+    for angle, x, y, z in glRotations:
+        r = r.dot(_rotationMatrix(angle * x, angle * y, angle * z))
+    return edges.dot(r.T)
+
+def analyticExtent(points, scale, rotation, partRotation):
+    """
+    Screen extent (xMin, yMin, xMax, yMax) of an (n, 3) point array drawn the way initImgSize draws,
+    in pixels from the buffer's center with y running down.  None if there are no points.
+    Extents of pieces drawn into one image combine with unionExtents.
+    """
+    if not len(points):
+        return None
+    m = scale * _rotationMatrix(*rotation).dot(_rotationMatrix(*partRotation))
+    p = points.reshape(-1, 3).dot(m.T)
+    return (float(p[:, 0].min()), float(-p[:, 1].max()), float(p[:, 0].max()), float(-p[:, 1].min()))
+
+def unionExtents(a, b):
+    if a is None:
+        return b
+    if b is None:
+        return a
+    return (min(a[0], b[0]), min(a[1], b[1]), max(a[2], b[2]), max(a[3], b[3]))
+
+def analyticImgSizeFromExtent(extent):
+    """ analyticImgSize for an analyticExtent.  Insets are not tracked, so both are 0. """
+    xMin, yMin, xMax, yMax = extent
+    half = int(math.ceil(max(abs(v) for v in extent))) + 2
+    left, right = int(math.floor(xMin + half)), int(math.floor(xMax + half)) + 1
+    top, bottom = int(math.floor(yMin + half)), int(math.floor(yMax + half)) + 1
+    return _imgSizeFromBounds((left, top, right, bottom, 0, 0), half * 2)
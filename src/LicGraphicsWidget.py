@@ -14,6 +14,8 @@
     along with this program.  If not, see http://creativecommons.org/licenses/by-sa/3.0/
 """
 
+import bisect
+
 from PyQt4.QtCore import *
 from PyQt4.QtGui import *
 
@@ -47,11 +49,30 @@ class LicGraphicsView(QGraphicsView):
             else:
                 factor = self.matrix().scale(scaleFactor, scaleFactor).mapRect(QRectF(0, 0, 1, 1)).width()
                 if factor >= 0.15 and factor <= 5:
+                    self.scene().beginInteraction()
                     self.scene().scaleFactor = factor
                     self.scale(scaleFactor, scaleFactor)
+                    self.scene().updateVirtualPages()
 
         return self.scene().scaleFactor
 
+    def paintEvent(self, event):
+        LicLayout.LayoutScheduler.flush()  # Lay out whatever the last edits left pending before drawing it
+        QGraphicsView.paintEvent(self, event)
+
+    def scrollContentsBy(self, dx, dy):
+        if self.scene() and self.scene().pagesToDisplay < 0:  # Only continuous views scroll through many GL pages
+            self.scene().beginInteraction()
+            QGraphicsView.scrollContentsBy(self, dx, dy)
+            self.scene().updateVirtualPages()
+        else:
+            QGraphicsView.scrollContentsBy(self, dx, dy)
+
+    def resizeEvent(self, event):
+        QGraphicsView.resizeEvent(self, event)
+        if self.scene():
+            self.scene().updateVirtualPages()
+
     def scaleToFit(self):
         vw, vh = self.geometry().size() - QSize(20, 20)
         pw, ph = Page.PageSize * self.scene().scaleFactor
@@ -86,10 +107,21 @@ class LicGraphicsScene(QGraphicsScene):
     
     _assist = None
     _catchTheMouse = False
+
+    PreviewIdleTimeout = 250  # Milliseconds without zoom or scroll before full quality rendering resumes
+    PreviewScale = 0.25  # Size of cached page previews, relative to the page size
+
+    VirtualShowBand = 1.0  # In continuous views, pages within this many viewport heights of the view are shown
+    VirtualReleaseBand = 4.0  # Pages further away than this many viewport heights release their GL display lists
         
     def __init__(self, parent):
         QGraphicsScene.__init__(self, parent)
         self.setBackgroundBrush(Qt.gray)
+
+        self.idleTimer = QTimer(self)
+        self.idleTimer.setSingleShot(True)
+        self.connect(self.idleTimer, SIGNAL("timeout()"), self.endInteraction)
+
         self.reset()
         
     def __getCatchTheMouse(self):
@@ -116,6 +148,12 @@ class LicGraphicsScene(QGraphicsScene):
         self.snapToGuides = True
         self.snapToItems = True
         self.renderMode = 'full' # Or "background" or "foreground"
+        self.interacting = False  # True while zooming or scrolling; GL items are then drawn as cheap previews
+        self.previewCache = {}  # {page: QImage}
+        self.renderQueue = []
+        self.pageIndex = []  # [(top, page)] sorted by top, built by continuous views only
+        self.pageTops = []
+        self.livePages = set()  # Pages near enough to the view to hold their GL display lists
 
         self.guide1v = None
         self.guide2v = None
@@ -207,16 +245,20 @@ class LicGraphicsScene(QGraphicsScene):
         if widget and self.renderMode == 'full':
 
             # Build list of pages to be drawn (if any)
-            rect = QRectF(self.views()[0].mapToScene(QPoint()), QSizeF(widget.size()) / self.scaleFactor)
-            pagesToDraw = []
-            for page in self.pages:
-                if page.isVisible() and rect.intersects(page.rect().translated(page.pos())):
-                    pagesToDraw.append(page)
+            rect = self.visibleSceneRect(widget)
+            pagesToDraw = [p for p in self.pagesInRect(rect) if p.isVisible()]
+
+            # While interacting, pages with a cached preview are drawn from that image instead of GL
+            if self.interacting:
+                for page in list(pagesToDraw):
+                    if page in self.previewCache:
+                        painter.drawImage(page.rect().translated(page.pos()), self.previewCache[page])
+                        pagesToDraw.remove(page)
 
             if pagesToDraw:
                 # Setup the GL items to be drawn & the necessary context
                 painter.beginNativePainting()
-                LicGLHelpers.initFreshContext(False)
+                LicGLHelpers.initFreshContext(False, self.interacting)
     
                 # Draw all GL items
                 for page in pagesToDraw:
@@ -231,6 +273,112 @@ class LicGraphicsScene(QGraphicsScene):
                 if item.isVisible() and (hasattr(item, 'isAnnotation') and item.isAnnotation):
                     self.drawOneItem(painter, item, options[i], widget)
 
+    def visibleSceneRect(self, widget = None):
+        view = self.views()[0]
+        widget = widget if widget else view.viewport()
+        return QRectF(view.mapToScene(QPoint()), QSizeF(widget.size()) / self.scaleFactor)
+
+    def pagesInRect(self, rect):
+        """ Pages overlapping rect.  Continuous views look pages up in pageIndex, so cost does not grow with book length. """
+        if not self.pageIndex:
+            return [p for p in self.pages if rect.intersects(p.rect().translated(p.pos()))]
+
+        first = bisect.bisect_left(self.pageTops, rect.top() - Page.PageSize.height())
+        last = bisect.bisect_right(self.pageTops, rect.bottom())
+        return [p for unused, p in self.pageIndex[first:last] if rect.intersects(p.rect().translated(p.pos()))]
+
+    def buildPageIndex(self):
+        """ Index the current page positions, hide every page, and let updateVirtualPages show the ones in view. """
+        self.pageIndex = [(page.pos().y(), page) for page in self.pages]
+        self.pageIndex.sort(key = lambda x: x[0])
+        self.pageTops = [top for top, unused in self.pageIndex]
+        self.livePages &= set(self.pages)
+        for page in self.pages:
+            page.hide()
+
+    def clearPageIndex(self):
+        self.pageIndex = []
+        self.pageTops = []
+
+    def updateVirtualPages(self):
+        """
+        In continuous views, show only pages near the viewport.  Pages that scroll far away also release
+        their GL display lists, which are rebuilt when the page comes back into view.
+        """
+        if not self.pageIndex or not self.views():
+            return
+
+        rect = self.visibleSceneRect()
+        h = rect.height()
+        showPages = self.pagesInRect(rect.adjusted(0, -h * self.VirtualShowBand, 0, h * self.VirtualShowBand))
+        livePages = set(self.pagesInRect(rect.adjusted(0, -h * self.VirtualReleaseBand, 0, h * self.VirtualReleaseBand)))
+
+        farPages = self.livePages - livePages
+        if farPages:
+            self.views()[0].viewport().makeCurrent()
+            for page in farPages:
+                page.hide()
+                page.releaseGLItems()
+                self.previewCache.pop(page, None)
+
+        showPages = set(showPages)
+        for page in livePages:
+            if page in showPages:
+                page.catchUpNumbers()
+            page.setVisible(page in showPages)
+        self.livePages = livePages
+
+    def catchUpNumbers(self):
+        """ Apply pending renumbering to the pages on display; the rest catch up when shown or exported. """
+        pages = self.livePages if self.pageIndex else self.pages
+        for page in pages:
+            if page.isVisible():
+                page.catchUpNumbers()
+
+    def beginInteraction(self):
+        """ Draw cheap previews until the view has been left alone for PreviewIdleTimeout ms """
+        self.interacting = True
+        self.cancelRenderJobs()
+        self.idleTimer.start(self.PreviewIdleTimeout)
+
+    def endInteraction(self):
+        self.interacting = False
+        self.update()  # Full quality redraw of the visible pages
+        self.scheduleRenderJobs()
+
+    def scheduleRenderJobs(self):
+        """
+        Queue a preview render for each visible page that does not have one yet.  Jobs run one page
+        per event loop pass, so any zoom or scroll in between cancels the remaining ones.
+        """
+        if not self.views():
+            return
+        rect = self.visibleSceneRect()
+        self.renderQueue = [p for p in self.pagesInRect(rect) if p.isVisible() and p not in self.previewCache]
+        if self.renderQueue:
+            QTimer.singleShot(0, self.runNextRenderJob)
+
+    def cancelRenderJobs(self):
+        self.renderQueue = []
+
+    def runNextRenderJob(self):
+        if self.interacting or not self.renderQueue:
+            return
+
+        page = self.renderQueue.pop(0)
+        
+        # Dirty CSIs regenerate their display lists while painting - leave those to the regular draw
+        if page.scene() is self and not [i for i in page.glItemIterator() if getattr(i, 'isDirty', False)]:
+            self.views()[0].viewport().makeCurrent()
+            self.previewCache[page] = page.createPreviewImage(self.PreviewScale)
+
+        if self.renderQueue:
+            QTimer.singleShot(0, self.runNextRenderJob)
+
+    def clearPreviewCache(self):
+        self.cancelRenderJobs()
+        self.previewCache = {}
+
     def pageUp(self):
         self.clearSelection()
         if self.pages and self.currentPage:
@@ -340,6 +488,7 @@ class LicGraphicsScene(QGraphicsScene):
                 page.hide()
                 page.setPos(0, 0)
 
+        self.catchUpNumbers()
         self.scrollToPage(self.currentPage)
 
     def selectionChangedHandler(self):
@@ -365,6 +514,7 @@ class LicGraphicsScene(QGraphicsScene):
         
     def showOnePage(self):
         self.pagesToDisplay = 1
+        self.clearPageIndex()
         self.setSceneRect(0, 0, Page.PageSize.width(), Page.PageSize.height())
         self.maximizeGuides(Page.PageSize.width(), Page.PageSize.height())
         for page in self.pages:
@@ -377,6 +527,7 @@ class LicGraphicsScene(QGraphicsScene):
             return self.showOnePage()
 
         self.pagesToDisplay = 2
+        self.clearPageIndex()
         self.setSceneRect(0, 0, (Page.PageSize.width() * 2) + 30, Page.PageSize.height() + 20)
         self.maximizeGuides(Page.PageSize.width() * 2, Page.PageSize.height())
 
@@ -400,39 +551,82 @@ class LicGraphicsScene(QGraphicsScene):
 
     def continuous(self):
         self.pagesToDisplay = self.PageViewContinuous
-        pc = max(len(self.pages), 1)
-        ph = Page.PageSize.height()
-        height = (10 * (pc + 1)) + (ph * pc)
-        self.setSceneRect(0, 0, Page.PageSize.width() + 20, height)
-        self.maximizeGuides(0, height)
-                
+        self.__setContinuousSceneRect()
         for i, page in enumerate(self.pages):
-            page.setPos(10, (10 * (i + 1)) + (ph * i))
-            page.show()
+            page.setPos(self.__continuousPagePos(i))
+        self.buildPageIndex()
         self.selectCurrentPage()
+        self.updateVirtualPages()
 
     def continuousFacing(self):
         if len(self.pages) < 3:
             return self.continuous()
         self.pagesToDisplay = self.PageViewContinuousFacing
-        pw = Page.PageSize.width()
+        self.__setContinuousSceneRect()
+        for i, page in enumerate(self.pages):
+            page.setPos(self.__continuousPagePos(i))
+        self.buildPageIndex()
+        self.selectCurrentPage()
+        self.updateVirtualPages()
+
+    def __continuousPagePos(self, i):
+        """ Where the i-th page goes in the current continuous view. """
         ph = Page.PageSize.height()
-        rows = sum(divmod(len(self.pages) - 1, 2)) + 1
-        width = pw + pw + 30
+        if self.pagesToDisplay == self.PageViewContinuous:
+            return QPointF(10, (10 * (i + 1)) + (ph * i))
+        if i == 0:
+            return QPointF(10, 10)  # Template page first
+        i += 1
+        return QPointF(10 + ((Page.PageSize.width() + 10) * (i % 2)), (10 * ((i // 2) + 1)) + (ph * (i // 2)))
+
+    def __setContinuousSceneRect(self):
+        pw, ph = Page.PageSize.width(), Page.PageSize.height()
+        if self.pagesToDisplay == self.PageViewContinuous:
+            rows, width, guideWidth = max(len(self.pages), 1), pw + 20, 0
+        else:
+            rows, width = sum(divmod(len(self.pages) - 1, 2)) + 1, pw + pw + 30
+            guideWidth = width
         height = (10 * (rows + 1)) + (ph * rows)
         self.setSceneRect(0, 0, width, height)
-        self.maximizeGuides(width, height)
-            
-        self.pages[0].setPos(10, 10)  # Template page first
-        self.pages[0].show()
-        
-        for i, page in enumerate(self.pages[1:]):
-            i += 2
-            x = 10 + ((pw + 10) * (i % 2))
-            y = (10 * ((i // 2) + 1)) + (ph * (i // 2))
-            page.setPos(x, y)
-            page.show()
-        self.selectCurrentPage()
+        self.maximizeGuides(guideWidth, height)
+
+    def __insertContinuousPage(self, page):
+        """
+        Add page to a continuous view without rebuilding it: only pages after the new one move, and
+        only the pages in view are shown.  Appending a page, as import does, touches no other page.
+        """
+        i = len(self.pages)
+        while i > 0 and self.pages[i - 1]._number > page._number:
+            i -= 1
+        self.pages.insert(i, page)
+
+        self.__setContinuousSceneRect()
+        for j in range(i, len(self.pages)):
+            self.pages[j].setPos(self.__continuousPagePos(j))
+
+        # Pages are positioned in page order, so the index stays in page order too
+        self.pageIndex[i:] = [(p.pos().y(), p) for p in self.pages[i:]]
+        self.pageTops[i:] = [top for top, unused in self.pageIndex[i:]]
+        page.hide()
+        self.updateVirtualPages()
+
+    def __removeContinuousPage(self, page):
+        """ Take page out of a continuous view without rebuilding it: only pages after it move up. """
+        i = self.pages.index(page)
+        del self.pages[i]
+        self.livePages.discard(page)
+        if self.pagesToDisplay == self.PageViewContinuousFacing and len(self.pages) < 3:
+            return self.continuous()  # Too few pages left to face each other
+
+        self.__setContinuousSceneRect()
+        for j in range(i, len(self.pages)):
+            self.pages[j].setPos(self.__continuousPagePos(j))
+
+        self.pageIndex[i:] = [(p.pos().y(), p) for p in self.pages[i:]]
+        self.pageTops[i:] = [top for top, unused in self.pageIndex[i:]]
+        if self.currentPage is page and self.pages:
+            self.currentPage = self.pages[min(i, len(self.pages) - 1)]
+        self.updateVirtualPages()
 
     def setPagesToDisplay(self, pagesToDisplay):
         if pagesToDisplay == self.PageViewContinuous:
@@ -446,6 +640,8 @@ class LicGraphicsScene(QGraphicsScene):
     def addItem(self, item):
         QGraphicsScene.addItem(self, item)
         if isinstance(item, Page):
+            if self.pageIndex:  # Continuous views
+                return self.__insertContinuousPage(item)
             self.pages.append(item)
             self.pages.sort(key = lambda x: x._number)
             self.setPagesToDisplay(self.pagesToDisplay)
@@ -458,12 +654,11 @@ class LicGraphicsScene(QGraphicsScene):
         QGraphicsScene.removeItem(self, item)
         if not isinstance(item, Page):
             return
+        self.previewCache.pop(item, None)
         if isinstance(item, Page) and item in self.pages:
+            if self.pageIndex:  # Continuous views
+                return self.__removeContinuousPage(item)
             self.pages.remove(item)
-            if self.pagesToDisplay == self.PageViewContinuous:
-                self.continuous()
-            elif self.pagesToDisplay == self.PageViewContinuousFacing:
-                self.continuousFacing()
 
     def removeBlankPages(self):
         stack = self.undoStack
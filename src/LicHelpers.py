@@ -15,6 +15,7 @@
 """
 
 import collections
+import itertools
 import logging
 
 from PyQt4.QtCore import Qt, QPointF, QString, QSettings
@@ -111,6 +112,72 @@ class LicColorDict(dict):
         print color_error
         return black
 
+class NumberShiftLog(object):
+    """
+    Pending "add increment to every number >= threshold" shifts for a set of numbered items.  Logging a shift
+    is O(1); each item replays only the shifts logged since it last looked, the next time its number is read.
+    """
+
+    def __init__(self):
+        self.base = 0  # Stamp of shifts[0]; anything older has been compacted away
+        self.shifts = []
+
+    def stamp(self):
+        return self.base + len(self.shifts)
+
+    def shift(self, threshold, increment):
+        if increment:
+            self.shifts.append((threshold, increment))
+
+    def replay(self, number, stamp):
+        if stamp < self.base:
+            return number  # Item was detached before the last compact; nothing here applies to it
+        for threshold, increment in itertools.islice(self.shifts, stamp - self.base, None):
+            if number >= threshold:
+                number += increment
+        return number
+
+    def compact(self):
+        """ Forget every logged shift.  Only call this once every attached item has had its number set. """
+        self.base = self.stamp()
+        self.shifts = []
+
+class ShiftNumbered(object):
+    """
+    Mixin for items whose _number follows a NumberShiftLog while attached to one.  Reading _number catches it
+    up with the log and calls numberShifted if it moved; setting _number just stores it.
+    """
+
+    _shiftLog = None
+    _shiftStamp = 0
+    _shiftedNumber = 0
+
+    def attachNumbering(self, shiftLog):
+        """ Start following shiftLog from now on (or stop following any log, if shiftLog is None). """
+        self._number  # Catch up with the current log first
+        self._shiftLog = shiftLog
+        self._shiftStamp = shiftLog.stamp() if shiftLog else 0
+
+    def numberShifted(self):
+        pass
+
+    def __getShiftedNumber(self):
+        shiftLog = self._shiftLog
+        if shiftLog is not None and self._shiftStamp != shiftLog.stamp():
+            number = shiftLog.replay(self._shiftedNumber, self._shiftStamp)
+            self._shiftStamp = shiftLog.stamp()
+            if number != self._shiftedNumber:
+                self._shiftedNumber = number
+                self.numberShifted()
+        return self._shiftedNumber
+
+    def __setShiftedNumber(self, number):
+        self._shiftedNumber = number
+        if self._shiftLog is not None:
+            self._shiftStamp = self._shiftLog.stamp()
+
+    _number = property(__getShiftedNumber, __setShiftedNumber)
+
 def writeLogEntry(message ,sender="UnknownDeliverer"):
     logging.warning('------------------------------------------------------\n {0} => {1}'.format(sender ,message))
 
@@ -14,6 +14,7 @@
     along with this program.  If not, see http://creativecommons.org/licenses/by-sa/3.0/
 """
 
+import itertools
 import sys
 
 from PyQt4.QtCore import *
@@ -73,6 +74,7 @@ class Instructions(QObject):
         SubmodelPreview.defaultRotation = [20.0, 45.0, 0.0]
         LicGLHelpers.resetLightParameters()
         self.glContext.makeCurrent()
+        LicGLHelpers.renderTargetPool.clear()
 
     def importModel(self, filename):
 
@@ -179,7 +181,8 @@ class Instructions(QObject):
     def initPartDimensions(self, reset = False):
         """
         Calculates each uninitialized part's display width and height.
-        Creates GL buffer to render a temp copy of each part, then uses those raw pixels to determine size.
+        With numpy, sizes come straight from each part's projected geometry.  Otherwise, renders a
+        temp copy of each part to a GL buffer, then uses those raw pixels to determine size.
         """
 
         partList, partStepCount, partDivCount = self.getPartDimensionListAndCount(reset)
@@ -188,33 +191,105 @@ class Instructions(QObject):
         if not partList:
             return    # If there's no parts to initialize, we're done here
 
-        partList2 = []
-        # Frame buffer sizes to try - could make configurable by user, if they've got lots of big submodels
-        sizes = [128, 256, 512, 1024, 2048] 
+        # Parts sized in an earlier session or book need no sizing at all
+        method = AbstractPart.getSizingMethod()
+        cachedList, uncachedList = [], []
+        for abstractPart in partList:
+            (cachedList if partDimensionCache.load(abstractPart, method) else uncachedList).append(abstractPart)
 
-        for size in sizes:
+        for unused in itertools.chain(cachedList, self.__initPartSizes(uncachedList, method)):
+            currentPartCount += 1
+            if not currentPartCount % partDivCount:
+                currentPartCount = 0
+                currentCount +=1
+                yield "Initializing Part Dimensions (%d/%d)" % (currentCount, partStepCount)
 
-            # Create a new buffer tied to the existing GLWidget, to get access to its display lists
-            pBuffer = QGLPixelBuffer(size, size, LicGLHelpers.getGLFormat(), self.glContext)
-            pBuffer.makeCurrent()
+        partDimensionCache.sync()
 
-            # Render each image and calculate their sizes
+    def __initPartSizes(self, partList, method):
+        """ Size each part in partList, storing each new size in the part dimension cache.  Yields each sized part. """
+
+        if method == "analytic":
+            # Size each part from its projected geometry - no GL context, buffers or size ladder needed
             for abstractPart in partList:
+                if abstractPart.initAnalyticSize():
+                    partDimensionCache.store(abstractPart, method)
+                yield abstractPart
+            return
+
+        # Render parts in batches, each tiled into one atlas buffer and read back once
+        for abstractPart, unused in self.__initAtlasSizes([(part, part.predictSize()) for part in partList]):
+            partDimensionCache.store(abstractPart, method)
+            yield abstractPart
+
+    def __initCSISizes(self, csiList):
+        """ Size each CSI in csiList.  Yields (csi, what initSize would return) as each is sized. """
 
-                if abstractPart.initSize(size, pBuffer):  # Draw image and calculate its size:                    
-                    currentPartCount += 1
-                    if not currentPartCount % partDivCount:
-                        currentPartCount = 0
-                        currentCount +=1
-                        yield "Initializing Part Dimensions (%d/%d)" % (currentCount, partStepCount)
-                else:
-                    partList2.append(abstractPart)
-
-            if len(partList2) < 1:
-                break  # All images initialized successfully
+        if LicGLHelpers.analyticSizingAvailable():
+            # csiList runs in step order, so each CSI builds on the extent its previous step just found
+            for csi in csiList:
+                yield csi, csi.initAnalyticSize()
+            return
+
+        # CSIs with nothing to draw need no buffer; initSize sorts those out on its own
+        emptyList = [csi for csi in csiList if not csi.parts]
+        csiList = [csi for csi in csiList if csi.parts]
+        for csi in emptyList:
+            yield csi, csi.initSize(LicGLHelpers.AtlasSize, None)
+
+        # Predict each CSI's size in one pass: a CSI draws every previous step too, so
+        # its size builds on the previous step's whenever both are drawn the same way
+        csiSizeList = []
+        prevCSI = prevHalfSize = None
+        for csi in csiList:
+            if prevCSI and csi.getPrevCSI() is prevCSI and (prevCSI.scaling, prevCSI.rotation) == (csi.scaling, csi.rotation):
+                prevHalfSize = csi.getSizingHalfSize(prevHalfSize)
             else:
-                partList = partList2  # Some images rendered out of frame - loop and try bigger frame
-                partList2 = []
+                prevHalfSize = csi.getSizingHalfSize()
+            prevCSI = csi
+            csiSizeList.append((csi, LicGLHelpers.predictImgSize(prevHalfSize, 512)))
+
+        for csi, result in self.__initAtlasSizes(csiSizeList):
+            yield csi, result
+
+    def __initAtlasSizes(self, itemSizeList):
+        """
+        Size each AbstractPart or CSI in itemSizeList, a list of (item, predicted buffer size) pairs.
+        Items predicted the same size are tiled into shared atlas buffers, as many per atlas as fit;
+        items predicted bigger than an atlas get a tiled render of their own.  Items that drew past
+        their tile's edge anyway are retried at twice the size, up to MaxTiledSize.
+        Yields (item, setSize result) as each is sized; nothing stays bound across a yield.
+        """
+        pending = {}
+        for item, size in itemSizeList:
+            pending.setdefault(size, []).append(item)
+
+        while pending:
+
+            tileSize = min(pending)
+            itemList = pending.pop(tileSize)
+            resultList = []
+            self.glContext.makeCurrent()
+            target = LicGLHelpers.beginOffscreenSizing(LicGLHelpers.AtlasSize)
+
+            if tileSize > LicGLHelpers.AtlasSize:
+                for item in itemList:
+                    resultList.append((item, LicGLHelpers.initTiledImgSize(tileSize, *item.getSizingView())))
+            else:
+                readback = target.getReadback("RGBA")
+                tileCount = LicGLHelpers.atlasTileCount(tileSize)
+                for i in range(0, len(itemList), tileCount):
+                    chunk = itemList[i:i + tileCount]
+                    viewList = [item.getSizingView() for item in chunk]
+                    LicGLHelpers.queueAtlasImgSizes(readback, tileSize, viewList, lambda paramList, chunk = chunk: resultList.extend(zip(chunk, paramList)))
+                readback.flush()
+            LicGLHelpers.endOffscreenSizing(target)
+
+            for item, params in resultList:
+                if params is not None:
+                    yield item, item.setSize(params)
+                elif tileSize < LicGLHelpers.MaxTiledSize:
+                    pending.setdefault(tileSize * 2, []).append(item)  # Rendered out of frame - try bigger
 
     def setAllCSIDirty(self):
         csiList = self.mainModel.getCSIList()
@@ -240,37 +315,16 @@ class Instructions(QObject):
         if not csiList:
             return  # All CSIs initialized - nothing to do here
 
-        csiList2 = []
-        # Frame buffer sizes to try - could make configurable by user, 
-        # if they've got lots of big submodels or steps
-        sizes = [512, 1024, 2048] 
-
-        for size in sizes:
-
-            # Create a new buffer tied to the existing GLWidget, to get access to its display lists
-            pBuffer = QGLPixelBuffer(size, size, LicGLHelpers.getGLFormat(), self.glContext)
-
-            # Render each CSI and calculate its size
-            for csi in csiList:
-                pBuffer.makeCurrent()
-                oldRect = csi.rect()
-                result = csi.initSize(size, pBuffer)
-                if result:
-                    yield result
-                    if repositionCSI:
-                        newRect = csi.rect()
-                        dx = oldRect.width() - newRect.width()
-                        dy = oldRect.height() - newRect.height()
-                        csi.moveBy(dx / 2.0, dy / 2.0)
-                else:
-                    csiList2.append(csi)
-
-            if len(csiList2) < 1:
-                break  # All images initialized successfully
-            else:
-                # Some images rendered out of frame - loop and try bigger frame
-                csiList = csiList2  
-                csiList2 = []
+        oldRects = dict((csi, csi.rect()) for csi in csiList)
+        for csi, result in self.__initCSISizes(csiList):
+            if not result:
+                continue
+            yield result
+            if repositionCSI:
+                oldRect, newRect = oldRects[csi], csi.rect()
+                dx = oldRect.width() - newRect.width()
+                dy = oldRect.height() - newRect.height()
+                csi.moveBy(dx / 2.0, dy / 2.0)
 
         self.glContext.makeCurrent()
 
@@ -284,8 +338,39 @@ class Instructions(QObject):
         self.mainModel.createPng()
         self.mainModel.exportImagesToPov()
         
+    def __saveExportedPage(self, page, glImage, w, h):
+        """ Save page's rendered GL image, then paint all its other items around it and save the full page image. """
+
+        exportedFilename = page.getGLImageFilename()
+        glImage.save(exportedFilename)
+
+        # Create new blank image
+        image = QImage(w, h, QImage.Format_ARGB32)
+        painter = QPainter()
+        painter.begin(image)
+
+        self.scene.selectPage(page._number)
+        self.scene.renderMode = 'background'
+        self.scene.render(painter, QRectF(0, 0, w, h))
+
+        glImage = QImage(exportedFilename)
+        painter.drawImage(QPoint(0, 0), glImage)
+
+        self.scene.selectPage(page._number)
+        self.scene.renderMode = 'foreground'
+        self.scene.render(painter, QRectF(0, 0, w, h))
+
+        painter.end()
+        newName = page.getExportFilename()
+        image.save(newName)
+        page.lockIcon.show()
+        return newName
+
     def exportImages(self, scaleFactor = 1.0):
         
+        LayoutScheduler.flush()  # Export renders the scene directly, so lay out whatever is still pending first
+        self.mainModel.catchUpNumbers()
+
         pagesToDisplay = self.scene.pagesToDisplay
         self.scene.clearSelection()
         self.scene.showOnePage()
@@ -305,52 +390,35 @@ class Instructions(QObject):
 
         try:
             w, h = int(Page.PageSize.width() * scaleFactor), int(Page.PageSize.height() * scaleFactor)
-            bufferManager = LicGLHelpers.FrameBufferManager(w, h)
+            bufferManager = LicGLHelpers.renderTargetPool.acquire(w, h)
 
-            # Render & save each page as an image
+            # Render & save each page as an image.  Pages are read back asynchronously: page N is
+            # saved and composited while page N+1's pixels are still on their way.
+            exportedNames = []
+            readback = bufferManager.getReadback()
             for page in pageList:
 
                 page.lockIcon.hide()
-                exportedFilename = page.getGLImageFilename()
 
                 bufferManager.bindMSFB()
                 LicGLHelpers.initFreshContext(True)
 
                 page.drawGLItemsOffscreen(QRectF(0, 0, w, h), scaleFactor)
                 bufferManager.blitMSFB()
-                data = bufferManager.readFB()
-
-                # Create an image from raw pixels and save to disk - would be nice to create QImage directly here
-                image = Image.fromstring("RGBA", (w, h), data)
-                image = image.transpose(Image.FLIP_TOP_BOTTOM)
-                image.save(exportedFilename)
+                bufferManager.queueReadFB(lambda glImage, page = page: exportedNames.append(self.__saveExportedPage(page, glImage, w, h)))
+                readback.flush(1)
 
-                # Create new blank image
-                image = QImage(w, h, QImage.Format_ARGB32)
-                painter = QPainter()
-                painter.begin(image)
-
-                self.scene.selectPage(page._number)
-                self.scene.renderMode = 'background'
-                self.scene.render(painter, QRectF(0, 0, w, h))
-
-                glImage = QImage(exportedFilename)
-                painter.drawImage(QPoint(0, 0), glImage)
-
-                self.scene.selectPage(page._number)
-                self.scene.renderMode = 'foreground'
-                self.scene.render(painter, QRectF(0, 0, w, h))
-    
-                painter.end()
-                newName = page.getExportFilename()
-                image.save(newName)
+                for newName in exportedNames:
+                    yield newName
+                del exportedNames[:]
 
+            readback.flush()
+            for newName in exportedNames:
                 yield newName
-                page.lockIcon.show()    
 
         finally:
             if bufferManager is not None:
-                bufferManager.cleanup()
+                LicGLHelpers.renderTargetPool.release(bufferManager)
             self.scene.renderMode = 'full'
             self.scene.setPagesToDisplay(pagesToDisplay)
             self.scene.selectPage(currentPageNumber)
@@ -452,6 +520,7 @@ class InstructionsProxy(object):
             parent = self.__instructions.mainModel
 
         parent.parts.append(part)
+        ModelIndex.partsChanged()
 
         if parent.isSubmodel:
             parent.pages[-1].steps[-1].addPart(part)
@@ -463,6 +532,7 @@ class InstructionsProxy(object):
                 p.used = True
                 parent.pages[-1]._row += 1
                 parent.submodels.append(p)
+                ModelIndex.pagesChanged()
 
     def addPrimitive(self, shape, colorCode, points, parent = None):
         if parent is None:
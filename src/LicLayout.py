@@ -14,6 +14,8 @@
     along with this program.  If not, see http://creativecommons.org/licenses/by-sa/3.0/
 """
 
+import collections
+import logging
 import math
 
 from PyQt4.QtCore import *
@@ -33,6 +35,11 @@ class GridLayout(object):
     # Stores a set of separators that separate each member.
     
     margin = 15
+
+    # Grid rects already worked out, shared by every layout; see getGridRects
+    gridMemo = {}
+    gridMemoLimit = 2000
+    gridMemoHits = gridMemoMisses = 0
     
     def __init__(self, rowCount = -1, colCount = -1, orientation = Vertical):
         self.colCount = rowCount
@@ -155,14 +162,15 @@ class GridLayout(object):
             if dx > 0 or dy > 0:
                 member.moveBy(dx, dy)
     
-    def _adjustRow(self, rowMembers, length, size, startPoint):
+    def _getRowRects(self, fixedRects, length, size, startPoint):
+        # fixedRects holds each row member's rect() if it's fixedSize, None otherwise
 
         fixedCount = 0
-        for member in [m for m in rowMembers if m.fixedSize]:
-            length -= member.rect().getOrientedSize(self.orientation) + (self.margin * 2)
+        for rect in [r for r in fixedRects if r is not None]:
+            length -= rect.getOrientedSize(self.orientation) + (self.margin * 2)
             fixedCount += 1;
 
-        length = length / (len(rowMembers) - fixedCount)
+        length = length / (len(fixedRects) - fixedCount)
 
         if self.orientation == Vertical:
             length, size = size, length
@@ -170,31 +178,29 @@ class GridLayout(object):
         destRects = []
 
         # First, set each member's width & height and position it in top left corner of destRect
-        for member in rowMembers:
-            if member.fixedSize:
-                destRects.append(member.rect().adjusted(0, 0, self.margin * 2, self.margin * 2))
+        for rect in fixedRects:
+            if rect is not None:
+                destRects.append(rect.adjusted(0, 0, self.margin * 2, self.margin * 2))
                 destRects[-1].setTopLeft(startPoint)
             else:
                 destRects.append(QRectF(startPoint.x(), startPoint.y(), length, size))
 
         # Move each rect over so it's beside its predecessor
-        for i, member in enumerate(rowMembers[1:]):
+        for i in range(1, len(destRects)):
             if self.orientation == Horizontal:
-                destRects[i+1].moveLeft(destRects[i].right())
+                destRects[i].moveLeft(destRects[i - 1].right())
             else:
-                destRects[i+1].moveTop(destRects[i].bottom())
+                destRects[i].moveTop(destRects[i - 1].bottom())
 
-        # Now, shrink each member by margin, then do layout
-        for i, member in enumerate(rowMembers):
-            rect = destRects[i].adjusted(self.margin, self.margin, -self.margin, -self.margin)
-            member.initLayout(rect)
+        # Now, shrink each member by margin
+        return [r.adjusted(self.margin, self.margin, -self.margin, -self.margin) for r in destRects]
 
-    def _getSizeList(self, memberList, interval, intervalCount, maxRect):
+    def _getSizeList(self, fixedRects, interval, intervalCount, maxRect):
         sizeList = []
         oID = not self.orientation
-        for i in range(0, len(memberList), interval):
-            rowMembers = memberList[i : i + interval]
-            maxFixedSize = maxSafe([(m.rect().getOrientedSize(oID) + self.margin * 2) for m in rowMembers if m.fixedSize])
+        for i in range(0, len(fixedRects), interval):
+            rowRects = fixedRects[i : i + interval]
+            maxFixedSize = maxSafe([(r.getOrientedSize(oID) + self.margin * 2) for r in rowRects if r is not None])
             sizeList.append(maxFixedSize)
 
         eachRowHeight = maxRect.getOrientedSize(oID) / intervalCount  # size if no members are fixed
@@ -207,30 +213,239 @@ class GridLayout(object):
 
         return sizeList
 
-    def initGridLayout(self, rect, memberList):
-        # Divides rect into equally sized rows & columns, and sizes each member to fit inside.
-        # If row / col count are -1 (unset), will be set to something appropriate.
-        # MemberList is a list of any objects that have an initLayout(rect) method
+    def getGridRects(self, rect, fixedRects):
+        """
+        The arithmetic half of initGridLayout: the rect each member would be laid out in, without
+        touching any member.  fixedRects holds each member's rect() if it's fixedSize, None otherwise.
+        Returns a list of rows, each a (member rect list, separator start point) pair; the last row's point is None.
+        Results are memoized on the orientation, grid counts, margin, rect and each member's size, all rounded to
+        whole pixels, so pages with the same shape share one layout.
+        """
+
+        rect = QRectF(*[round(v) for v in rect.getRect()])
+        sizes = tuple(None if r is None else (round(r.width()), round(r.height())) for r in fixedRects)
+        key = (self.orientation, self.rowCount, self.colCount, self.margin, rect.getRect(), sizes)
+
+        rowList = GridLayout.gridMemo.get(key)
+        if rowList is None:
+            GridLayout.gridMemoMisses += 1
+            if len(GridLayout.gridMemo) >= GridLayout.gridMemoLimit:
+                GridLayout.gridMemo.clear()
+            fixedRects = [None if s is None else QRectF(0, 0, s[0], s[1]) for s in sizes]
+            rowList = []
+            for rowRects, point in self.__getGridRects(rect, fixedRects):
+                rowList.append(([r.getRect() for r in rowRects], None if point is None else (point.x(), point.y())))
+            GridLayout.gridMemo[key] = rowList
+        else:
+            GridLayout.gridMemoHits += 1
 
-        rows, cols = self.getRowColCount(memberList)
+        # Hand out fresh copies, since callers are free to change the rects they get
+        return [([QRectF(*r) for r in rowRects], None if point is None else QPointF(*point)) for rowRects, point in rowList]
+
+    def __getGridRects(self, rect, fixedRects):
+
+        rows, cols = self.getRowColCount(fixedRects)
         startPoint = rect.topLeft()
-        self.separators = []
 
         oID = self.orientation
         if oID == Vertical:
             cols, rows = rows, cols
 
-        sizeList = self._getSizeList(memberList, cols, rows, rect)
+        sizeList = self._getSizeList(fixedRects, cols, rows, rect)
+        rowList = []
 
-        for i in range(0, len(memberList), cols):  # Adjust each row
+        for i in range(0, len(fixedRects), cols):  # Adjust each row
 
-            rowMembers = memberList[i : i + cols]
             size = sizeList[i // cols]
+            rowRects = self._getRowRects(fixedRects[i : i + cols], rect.getOrientedSize(oID), size, startPoint)
+            startPoint = QPointF(rect.left(), startPoint.y() + size) if oID == Horizontal else QPointF(startPoint.x() + size, rect.top())
 
-            self._adjustRow(rowMembers, rect.getOrientedSize(oID), size, startPoint)  # Position each member in this row
-            childRow = rowMembers[-1].row() + len(self.separators) + 1  # Figure out where step separator should be inserted in tree
+            separatorPoint = startPoint if i + cols < len(fixedRects) else None
+            rowList.append((rowRects, separatorPoint))
 
-            startPoint = QPointF(rect.left(), startPoint.y() + size) if oID == Horizontal else QPointF(startPoint.x() + size, rect.top())
+        return rowList
 
-            if rowMembers[-1] != memberList[-1]:
-                self.addSeparator(startPoint.x(), startPoint.y(), rect.getOrientedSize(oID), childRow)
+    def initGridLayout(self, rect, memberList):
+        # Divides rect into equally sized rows & columns, and sizes each member to fit inside.
+        # If row / col count are -1 (unset), will be set to something appropriate.
+        # MemberList is a list of any objects that have an initLayout(rect) method
+
+        self.separators = []
+        fixedRects = [m.rect() if m.fixedSize else None for m in memberList]
+
+        i = 0
+        for rowRects, separatorPoint in self.getGridRects(rect, fixedRects):  # Adjust each row
+
+            rowMembers = memberList[i : i + len(rowRects)]
+            i += len(rowRects)
+            for member, memberRect in zip(rowMembers, rowRects):  # Position each member in this row
+                member.initLayout(memberRect)
+
+            if separatorPoint is not None:
+                childRow = rowMembers[-1].row() + len(self.separators) + 1  # Figure out where step separator should be inserted in tree
+                self.addSeparator(separatorPoint.x(), separatorPoint.y(), rect.getOrientedSize(self.orientation), childRow)
+
+def greedyPageBreaks(count, fits, startsPage, badness = None):
+    """
+    Fill each page with steps until the next one won't fit, like Lic's old merge did, but judged by the same
+    plan-only fits() as optimalPageBreaks rather than by laying out real pages.
+    fits(i, j) returns the orientation that fits units i to j - 1 on one page, or None.  startsPage(i) is
+    True if unit i must start a new page.  badness is ignored; it's there so both solvers are interchangeable.
+    Returns a list of (first unit, end unit, orientation) pages.
+    """
+    pages = []
+    for i in range(count):
+        if pages and not startsPage(i):
+            start = pages[-1][0]
+            orientation = fits(start, i + 1)
+            if orientation is not None:
+                pages[-1] = (start, i + 1, orientation)
+                continue
+        pages.append((i, i + 1, fits(i, i + 1)))
+    return pages
+
+def optimalPageBreaks(count, fits, startsPage, badness, lookahead = 2):
+    """
+    Choose page breaks like Knuth & Plass choose line breaks: fewest pages first, then the least total
+    badness(i, j, orientation), which should grow with the square of the page's unused space so steps spread
+    evenly instead of leaving a lopsided last page.  Each run of units between forced breaks is solved on its
+    own.  Once units i to j - 1 don't fit on a page, up to lookahead more units are still tried, since a grid
+    can take one more step than a single row did (three steps in a row may overlap where a 2 x 2 grid doesn't).
+    Same arguments and return value as greedyPageBreaks.
+    """
+    pages = []
+    segmentStarts = [i for i in range(count) if i == 0 or startsPage(i)] + [count]
+
+    for a, b in zip(segmentStarts, segmentStarts[1:]):
+
+        # best[j] = (page count, badness, page start, orientation) of the best way to lay out units a to j - 1
+        best = {a: (0, 0.0, None, None)}
+        for i in range(a, b):
+            pageCount, total = best[i][:2]
+            misses = 0
+            for j in range(i + 1, b + 1):
+                orientation = fits(i, j)
+                if orientation is None:
+                    misses += 1
+                    if misses > lookahead:
+                        break
+                    continue
+                cost = (pageCount + 1, total + badness(i, j, orientation), i, orientation)
+                if j not in best or cost[:2] < best[j][:2]:
+                    best[j] = cost
+
+        segment = []
+        j = b
+        while j > a:
+            unused, unused, i, orientation = best[j]
+            segment.append((i, j, orientation))
+            j = i
+        pages += reversed(segment)
+
+    return pages
+
+class LayoutScheduler(object):
+    """
+    Defers layout work asked for while the scene is being edited, so one edit lays each item out once.
+    Requests are coalesced: each (item, action) runs at most once per flush, and an item's initLayout is
+    skipped if an ancestor on an unlocked page is being laid out anyway.  flush() runs in dependency order:
+    pixmaps first, then layouts outermost first, then rect resets innermost first.  Requests made while
+    flushing join the same flush, and are skipped if something it already laid out covers them; items that
+    reset their own rect mark any pending request for it done.  Items no longer in a scene are dropped.  The undo stack flushes after every command or macro, the view flushes before every
+    paint, and export and template changes made outside the undo stack flush explicitly.
+    """
+
+    Actions = ['resetPixmap', 'initLayout', 'resetRect']  # In flush order
+
+    pending = {}  # {action: OrderedDict {item: None}}
+    requested = 0  # Requests made
+    performed = 0  # Requests actually run
+    flushCount = 0
+    __flushing = False
+
+    @classmethod
+    def schedule(cls, item, action = 'initLayout'):
+        cls.requested += 1
+        cls.pending.setdefault(action, collections.OrderedDict())[item] = None
+
+    @classmethod
+    def avoided(cls):
+        return cls.requested - cls.performed - sum(len(items) for items in cls.pending.values())
+
+    @classmethod
+    def summary(cls):
+        return "%d layout requests, %d run, %d avoided, in %d flushes" % (cls.requested, cls.performed, cls.avoided(), cls.flushCount)
+
+    @staticmethod
+    def __getDepth(item):
+        depth = 0
+        while item.parentItem() is not None:
+            item = item.parentItem()
+            depth += 1
+        return depth
+
+    @staticmethod
+    def __isCovered(item, laidOut):
+        """ True if an ancestor of item is in laidOut, and will lay item out as part of its own layout. """
+        page = item.getPage() if hasattr(item, 'getPage') else None
+        if page is not None and page.isLocked():
+            return False  # Locked pages skip their own layout, so nothing on them gets laid out for free
+        parent = item.parentItem()
+        while parent is not None:
+            if parent in laidOut:
+                return True
+            parent = parent.parentItem()
+        return False
+
+    @classmethod
+    def flush(cls):
+        if cls.__flushing or not cls.pending:
+            return
+
+        cls.__flushing = True
+        laidOut = set()  # Everything laid out in this flush, so follow-up requests it covers are skipped too
+        try:
+            cls.flushCount += 1
+            while cls.pending:
+                pending = cls.__takePending()
+
+                # Pixmap resets ask for layouts of their own; gather those before laying anything out
+                while pending.get('resetPixmap'):
+                    for item in pending.pop('resetPixmap'):
+                        item.resetPixmap()
+                        cls.performed += 1
+                    for action, items in cls.__takePending().items():
+                        known = set(pending.get(action, []))
+                        pending[action] = pending.get(action, []) + [x for x in items if x not in known]
+
+                layoutList = sorted(pending.get('initLayout', []), key = cls.__getDepth)
+                alreadyLaidOut = set(laidOut)
+                laidOut.update(layoutList)
+                for item in layoutList:
+                    if item not in alreadyLaidOut and not cls.__isCovered(item, laidOut):
+                        item.initLayout()
+                        cls.performed += 1
+
+                for item in sorted(pending.get('resetRect', []), key = cls.__getDepth, reverse = True):
+                    if item not in laidOut and not cls.__isCovered(item, laidOut):
+                        item.resetRect()
+                        cls.performed += 1
+        finally:
+            cls.__flushing = False
+
+        logging.debug("LayoutScheduler: " + cls.summary())
+
+    @classmethod
+    def __takePending(cls):
+        """ Pop every pending request, as {action: [item]}, dropping items removed from the scene since, like a step a later command deleted. """
+        pending, cls.pending = cls.pending, {}
+        return dict((action, [item for item in items if item.scene() is not None]) for action, items in pending.items())
+
+    @classmethod
+    def done(cls, item, action):
+        """ item just ran action itself, so any pending request for it is already satisfied. """
+        items = cls.pending.get(action)
+        if items and item in items:
+            del items[item]
+            if not items:
+                del cls.pending[action]
@@ -15,6 +15,9 @@
 """
 
 import collections
+import copy
+import csv
+import hashlib
 import math  # for sqrt
 import os  # for output path creation
 import config  # For user path info
@@ -40,7 +43,7 @@ from LicQtWrapper import *
 from LicTreeModel import *
 from LicUndoActions import *
 from LicImporters import LDrawImporter
-from LicDialogs import MessageDlg
+from RectanglePacker import CygonRectanglePacker
 
 
 #import OpenGL
@@ -299,12 +302,14 @@ class Callout(CalloutTreeManager, GraphicsRoundRectItem):
 
     def insertStep(self, newStep):
         self.steps.insert(newStep._number - 1, newStep)
+        ModelIndex.calloutsChanged()
         newStep.setParentItem(self)
         self.syncStepNumbers()
 
     def removeStep(self, step):
         self.scene().removeItem(step)
         self.steps.remove(step)
+        ModelIndex.calloutsChanged()
         self.syncStepNumbers()
 
     def syncStepNumbers(self):
@@ -511,6 +516,11 @@ class Callout(CalloutTreeManager, GraphicsRoundRectItem):
         self.mergedCallouts = calloutList
         self.setMergedQuantity()
 
+    def getSignature(self):
+        """ This callout's parts as a sorted tuple of ((filename, color), count); matching callouts share one. """
+        counts = collections.Counter(BillOfMaterials.getKey(part.abstractPart, part.color) for part in self.getPartList())
+        return tuple(sorted(counts.items()))
+
     def calloutMatches(self, callout):
         if self is callout:
             return True
@@ -518,26 +528,8 @@ class Callout(CalloutTreeManager, GraphicsRoundRectItem):
         if self.parentItem() != callout.parentItem():
             return False
 
-        c1Parts = self.getPartList()
-        c2Parts = callout.getPartList()
-        
-        if len(c1Parts) != len(c2Parts):
-            return False
-        
-        # Add a temporary equality check to Parts, to make the next step easier
-        Part.__eq__ = lambda self, other: self.color == other.color and self.filename == other.filename
-        
-        # Check if two callout part lists have basically the same parts
-        # Two parts are similar if they have the same filename & color (matrix is irrelevant here (__eq__ above))
-        for p1 in c1Parts:
-            if p1 in c2Parts:
-                c2Parts.remove(p1)
-            else:
-                del(Part.__eq__)
-                return False
-
-        del(Part.__eq__)
-        return True
+        # Two callouts match if they have the same parts by filename & color (matrix is irrelevant here)
+        return self.getSignature() == callout.getSignature()
     
     def mergeCalloutContextMenu(self, event):
         menu = QMenu(self.scene().views()[0])
@@ -719,7 +711,7 @@ class Callout(CalloutTreeManager, GraphicsRoundRectItem):
         stack.endMacro()
         self.scene().emit(SIGNAL("layoutChanged()"))
 
-class Step(StepTreeManager, QGraphicsRectItem):
+class Step(LicHelpers.ShiftNumbered, StepTreeManager, QGraphicsRectItem):
     """ A single step in an Instruction book.  Contains one optional PLI and exactly one CSI. """
     itemClassName = "Step"
 
@@ -748,7 +740,14 @@ class Step(StepTreeManager, QGraphicsRectItem):
         self.setFlags(AllFlags)
         
     def _setNumber(self, number):
+        if number == self._number:
+            return
         self._number = number
+        ModelIndex.stepsChanged()
+        if self.numberItem:
+            self.numberItem.setText("%d" % self._number)
+
+    def numberShifted(self):
         if self.numberItem:
             self.numberItem.setText("%d" % self._number)
 
@@ -773,65 +772,51 @@ class Step(StepTreeManager, QGraphicsRectItem):
         return len(self.csi.parts) == 0
 
     def addPart(self, part):
-        self.csi.addPart(part)
-        if self.pli and not part.isSubmodel():  # Visibility here is irrelevant
-            self.pli.addPart(part)
+        self.addParts([part])
+
+    def addParts(self, partList):
+        self.csi.addParts(partList)
+        if self.pli:  # Visibility here is irrelevant
+            self.pli.addParts([part for part in partList if not part.isSubmodel()])
 
     def removePart(self, part):
-        self.csi.removePart(part)
+        self.removeParts([part])
+
+    def removeParts(self, partList):
+        self.csi.removeParts(partList)
         if self.pli:  # Visibility here is irrelevant
-            self.pli.removePart(part)
+            self.pli.removeParts(partList)
             if self.pli.isEmpty():
                 self.pli.setRect(0, 0, 0, 0)
                 self.pli.setPos(0, 0)
                 
     def splitParts(self, maxParts):
-        cnt = self.csi.partCount()
-        lst = self.csi.getPartList()
-        stack = self.scene().undoStack
+        """ Move every part past the first maxParts onto new Steps of maxParts each, one new Page per Step, as one undo step. """
+        partList = self.csi.getPartList()
+        if len(partList) <= maxParts:
+            return
+
+        page = self.parentItem()
+        instructions = page.instructions
+        stepPartLists = []
+        for i, n in enumerate(range(maxParts, len(partList), maxParts)):
+            newPage = instructions.spawnNewPage(page.submodel, page.number + i + 1, page._row + i + 1)
+            newStep = Step(newPage, self.number + i + 1)
+            stepPartLists.append((newStep, partList[n : n + maxParts]))
+
         scene = self.scene()
-        if cnt > maxParts:
-            dialog = MessageDlg(self.scene().views()[0])
-            dialog.setText("Operation in progress...")
-            dialog.show()
-            
-            m = 1
-            partList = []
-            page = self.parentItem()
-            startNumber = page.number
-            scene.saveSelection()
-            
-            for n in range(maxParts,cnt):
-                partList.append(lst[n])
-                m += 1
-                lst[n].setSelected(True)
-                if m > maxParts:
-                    stack.beginMacro("add Page and blank Step")
-                    page.addPageSignal(page.number + 1, page._row + 1)
-                    page = page.nextPage()
-                    page.addBlankStepSignal()
-                    stack.endMacro()
-                    
-                    scene.selectPage(startNumber)
-                    scene.clearSelectedParts()
-                    for p in partList:
-                        p.setSelected(True)
-                    
-                    p.moveToStepSignal(page.steps[0])
-                    m = 1
-                    partList = []
-                    
-            dialog.close()
-            scene.restoreSelection()
-            scene.emit(SIGNAL("sceneClick"))
+        scene.undoStack.push(SplitStepCommand(self, stepPartLists))
+        scene.emit(SIGNAL("sceneClick"))
 
     def addCallout(self, callout):
         callout.setParentItem(self)
         self.callouts.append(callout)
+        ModelIndex.calloutsChanged()
     
     def removeCallout(self, callout):
         self.scene().removeItem(callout)
         self.callouts.remove(callout)
+        ModelIndex.calloutsChanged()
 
     def addRotateIcon(self):
 
@@ -892,6 +877,7 @@ class Step(StepTreeManager, QGraphicsRectItem):
 
         self.setRect(r)
         self.normalizePosition()
+        LayoutScheduler.done(self, 'resetRect')
         if self.isInCallout():
             self.parentItem().resetRect()
 
@@ -1205,6 +1191,97 @@ class Step(StepTreeManager, QGraphicsRectItem):
     def swapWithStepSignal(self, step):
         self.scene().undoStack.push(SwapStepsCommand(self, step))
 
+class StepLayoutPlan(object):
+    """
+    The sizes of everything Step.initLayout positions, captured once, so a step can be tried in any
+    destination rect with plain arithmetic.  fits() follows initLayout, resetRect & checkForLayoutOverlaps
+    exactly, but never touches the step.  Steps with callouts can't be planned.
+    """
+
+    def __init__(self, step):
+        self.canPlan = not step.callouts
+        self.hasPLI = step.hasPLI()
+        self.pliItems = list(step.pli.pliItems) if self.hasPLI else []
+        self.pliRect = step.pli.rect() if step.pli else QRectF()
+        self.csiRect = step.csi.rect()
+        self.numberRect = step.numberItem.rect() if step.numberItem else None
+        self.rotateIconRect = step.rotateIcon.rect() if step.rotateIcon else None
+        self.margin = step.getPage().margin
+
+        # Anything else hanging off the step keeps its place
+        known = [step.csi, step.pli, step.numberItem, step.rotateIcon]
+        self.otherRects = [c.rect().translated(c.pos()) for c in step.childItems() if c not in known]
+        self._fitCache = {}
+
+    def area(self):
+        """ The area this step's CSI and PLI cover, however they end up laid out. """
+        pliArea = self.pliRect.width() * self.pliRect.height() if self.hasPLI else 0.0
+        return self.csiRect.width() * self.csiRect.height() + pliArea
+
+    def minimumRect(self):
+        """ The smallest rect this step's PLI and CSI fit in, stacked the way initLayout stacks them. """
+        pliHeight = self.pliRect.height() if self.hasPLI else 0.0
+        pliWidth = self.pliRect.width() if self.hasPLI else 0.0
+        return QRectF(0.0, 0.0, max(self.csiRect.width(), pliWidth), pliHeight + self.csiRect.height())
+
+    def fits(self, destRect, pageRect):
+        """ True if this step, laid out in destRect on a page of pageRect, would pass checkForLayoutOverlaps. """
+        key = (destRect.x(), destRect.y(), destRect.width(), destRect.height())
+        if key not in self._fitCache:
+            self._fitCache[key] = self._fits(destRect, pageRect)
+        return self._fitCache[key]
+
+    def _fits(self, destRect, pageRect):
+        w, h = destRect.width(), destRect.height()
+        childRects = list(self.otherRects)
+
+        # Step.initLayout: PLI in the top left corner, number label beneath it
+        pliRect = self.pliRect
+        if self.hasPLI:
+            unused, pliRect = PLI.packItems(self.pliItems, w)
+            childRects.append(pliRect)
+        pliHeight = pliRect.height() if self.hasPLI else 0.0
+
+        if self.numberRect is not None:
+            childRects.append(self.numberRect.translated(0, pliHeight + self.margin.y()))
+
+        # positionInternalBits: CSI centered in what's left
+        csiW, csiH = self.csiRect.width(), self.csiRect.height()
+        csiX = (w - csiW) / 2.0
+        csiY = pliHeight + (h - pliHeight - csiH) / 2.0
+        childRects.append(QRectF(csiX, csiY, csiW, csiH))
+
+        if self.rotateIconRect is not None:
+            x = csiX - self.rotateIconRect.width() - self.margin.x()
+            y = csiY - self.rotateIconRect.height() - self.margin.y()
+            if self.hasPLI and y < pliRect.bottom():
+                y = csiY
+                x -= self.margin.x()
+            childRects.append(self.rotateIconRect.translated(x, y))
+
+        # resetRect & normalizePosition: grow to hold every child, then shift so the rect starts at 0, 0
+        r = QRectF(0.0, 0.0, max(1, w), max(1, h))
+        for childRect in childRects:
+            r |= childRect
+        dx, dy = r.left(), r.top()
+        csiX, csiY = csiX - dx, csiY - dy
+
+        # checkForLayoutOverlaps
+        if csiY < pliRect.bottom() and csiX < pliRect.right():
+            return False
+        if csiY < pliRect.top():
+            return False
+        if csiW > r.width() or pliRect.width() > r.width():
+            return False
+        if csiY + csiH > r.height():
+            return False
+        left, top = destRect.left() + dx, destRect.top() + dy
+        if left < 0 or top < 0:
+            return False
+        if left + r.width() > pageRect.width() or top + r.height() > pageRect.height():
+            return False
+        return True
+
 class RotateScaleSignalItem(object):
 
     def rotateSignal(self):
@@ -1275,6 +1352,25 @@ class SubmodelPreview(SubmodelPreviewTreeManager, RotateScaleSignalItem, Graphic
                 numRect.adjust(0, 0, PLI.margin.x(), PLI.margin.y())
                 self.setRect(self.rect() | numRect)
     
+    def getScaledRect(self, scale):
+        """
+        The rect this preview would get from initLayout if it were rendered at scale.  Worked out from the
+        current image size, since a rendered part's extent grows linearly with its scale.
+        """
+        if self.isSubAssembly:
+            return self.rect()
+
+        f = scale / self.scaling
+        w, h = self.abstractPart.width * f, self.abstractPart.height * f
+        rect = QRectF(0, 0, w + (PLI.margin.x() * 2), h + (PLI.margin.y() * 2))
+        if self.numberItem:
+            numRect = self.numberItem.rect().translated(w + PLI.margin.x(), h + PLI.margin.y())
+            numRect.adjust(0, 0, PLI.margin.x(), PLI.margin.y())
+            rect |= numRect
+        if rect.width() < 50 or rect.height() < 50:
+            rect = QRectF(rect.topLeft(), self.defaultSize)
+        return rect
+
     def adjustRectSignal(self):
         parentWidget = self.scene().views()[0]
         dialog = LicDialogs.AdjustAreaDialog(parentWidget, self.rect().toRect() ,self.scenePos())
@@ -1480,7 +1576,7 @@ class PLIItem(PLIItemTreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         glRect = QRectF(0.0, 0.0, self.abstractPart.width, self.abstractPart.height +lblHeight)
         self.setRect(self.childrenBoundingRect() | glRect)
         #self.normalizePosition()  # Don't want to normalize PLIItem positions, otherwise we end up with GLItem in top left always.
-        self.parentItem().resetRect()
+        LayoutScheduler.schedule(self.parentItem(), 'resetRect')
 
     def initLayout(self):
 
@@ -1519,7 +1615,7 @@ class PLIItem(PLIItemTreeManager, RotateScaleSignalItem, QGraphicsRectItem):
     def resetPixmap(self):
         glContext = self.getPage().instructions.glContext
         self.abstractPart.resetPixmap(glContext)
-        self.parentItem().initLayout()
+        LayoutScheduler.schedule(self.parentItem())
         
     def normalizeView(self):
         self.initLayout()
@@ -1569,10 +1665,12 @@ class PLI(PLITreeManager, GraphicsRoundRectItem):
     defaultScale = 1.0
     defaultRotation = [20.0, -45.0, 0.0]
     margin = QPointF(15, 15)
+    packMode = 'stepWidth'  # One of 'stepWidth', 'minArea'
 
     def __init__(self, parent):
         GraphicsRoundRectItem.__init__(self, parent)
-        self.pliItems = []  # {(part filename, color): PLIItem instance}
+        self.pliItems = []
+        self._pliItemDict = {}  # {(part filename, color): PLIItem instance}
         self.data = lambda index: "PLI"
         self.setPos(0.0, 0.0)
         self.setFlags(AllFlags)
@@ -1584,30 +1682,58 @@ class PLI(PLITreeManager, GraphicsRoundRectItem):
         rect = self.childrenBoundingRect().adjusted(-PLI.margin.x(), -PLI.margin.y(), PLI.margin.x(), PLI.margin.y())
         self.setRect(rect)
         self.normalizePosition()
-        self.parentItem().resetRect()
+        LayoutScheduler.done(self, 'resetRect')
+        LayoutScheduler.schedule(self.parentItem(), 'resetRect')
         
+    def getPLIItem(self, abstractPart, color):
+        """ The PLIItem for this part & colour, or None. """
+
+        # pliItems is sometimes filled or emptied directly; re-index when it no longer matches
+        if len(self._pliItemDict) != len(self.pliItems):
+            self._pliItemDict = dict((BillOfMaterials.getKey(i.abstractPart, i.color), i) for i in self.pliItems)
+
+        key = BillOfMaterials.getKey(abstractPart, color)
+        pliItem = self._pliItemDict.get(key)
+        if pliItem is not None and (pliItem.parentItem() is not self or BillOfMaterials.getKey(pliItem.abstractPart, pliItem.color) != key):
+            self._pliItemDict = dict((BillOfMaterials.getKey(i.abstractPart, i.color), i) for i in self.pliItems)
+            pliItem = self._pliItemDict.get(key)
+        return pliItem
+
     def addPart(self, part):
+        self.addParts([part])
 
-        for pliItem in self.pliItems:
-            if pliItem.color == part.color and pliItem.abstractPart.filename == part.abstractPart.filename:
-                return pliItem.addPart()
+    def addParts(self, partList):
+
+        countDict = collections.OrderedDict()  # {PLIItem: number of parts to add}
+        for part in partList:
+            pliItem = self.getPLIItem(part.abstractPart, part.color)
+            if pliItem is None:  # Did not find an existing PLI, so create a new one
+                pliItem = PLIItem(self, part.abstractPart, part.color)
+                self.pliItems.append(pliItem)
+                self._pliItemDict[BillOfMaterials.getKey(part.abstractPart, part.color)] = pliItem
+            countDict[pliItem] = countDict.get(pliItem, 0) + 1
+
+        for pliItem, count in countDict.items():
+            pliItem.setQuantity(pliItem.quantity + count)
 
-        # If we're here, did not find an existing PLI, so create a new one
-        pliItem = PLIItem(self, part.abstractPart, part.color)
-        pliItem.addPart()
-        self.pliItems.append(pliItem)
-        
     def removePart(self, part):
-        
-        for pliItem in self.pliItems:
-            if pliItem.color == part.color and pliItem.abstractPart.filename == part.abstractPart.filename:
-                pliItem.removePart()
-                break
+        self.removeParts([part])
 
-        for pliItem in [i for i in self.pliItems if i.quantity <= 0]: # Check for & delete empty PLIItems
-            self.scene().removeItem(pliItem)
-            self.pliItems.remove(pliItem)
-            pliItem.setParentItem(None)
+    def removeParts(self, partList):
+
+        countDict = {}  # {PLIItem: number of parts to remove}
+        for part in partList:
+            pliItem = self.getPLIItem(part.abstractPart, part.color)
+            if pliItem is not None:
+                countDict[pliItem] = countDict.get(pliItem, 0) + 1
+
+        for pliItem, count in countDict.items():
+            pliItem.setQuantity(pliItem.quantity - count)
+            if pliItem.quantity <= 0:  # Delete empty PLIItems
+                self.scene().removeItem(pliItem)
+                self.pliItems.remove(pliItem)
+                del self._pliItemDict[BillOfMaterials.getKey(pliItem.abstractPart, pliItem.color)]
+                pliItem.setParentItem(None)
 
     def removeAllParts(self):
         scene = self.scene()
@@ -1630,6 +1756,68 @@ class PLI(PLITreeManager, GraphicsRoundRectItem):
             part.resetPixmap(glContext)
         self.initLayout()
     
+    @staticmethod
+    def packItems(pliItems, maxWidth, packMode = None):
+        """
+        The arithmetic half of initLayout: choose where each laid out PLIItem goes, without moving anything.
+        Items are packed with the skyline packer, either into maxWidth ('stepWidth') or into whichever width
+        up to maxWidth gives the smallest PLI ('minArea').  Returns ([(item, x, y)], PLI rect).
+        """
+        xMargin, yMargin = PLI.margin.x(), PLI.margin.y()
+
+        # Each item's rect, with room for its length indicator above it and a margin right of & below it
+        sizeList = []
+        for item in pliItems:
+            indicator = item.lengthIndicator.rect().height() if item.lengthIndicator else 0.0
+            sizeList.append((item, item.rect().width() + xMargin, item.rect().height() + indicator + yMargin, indicator))
+
+        if not sizeList:
+            return [], QRectF()
+
+        # The skyline packer leaves the fewest gaps when fed tallest first or widest first; try both
+        orderList = [sorted(sizeList, key = lambda s: (s[2], s[1]), reverse = True),
+                     sorted(sizeList, key = lambda s: (s[1], s[2]), reverse = True)]
+
+        widest = max(s[1] for s in sizeList)
+        width = max(widest, maxWidth - xMargin)  # Parts wider than the step widen the PLI, as before
+        packList = [PLI.__skylinePack(orderedList, width) + (orderedList,) for orderedList in orderList]
+        positions, pliBox, orderedList = min(packList, key = lambda p: (p[1].height(), p[1].width()))
+
+        # Then narrow the packing width as far as it goes without making the PLI taller, or for 'minArea',
+        # while the PLI keeps getting smaller.  The first try is the width the parts would need if they
+        # filled the PLI's height with no gaps.
+        minArea = (packMode or PLI.packMode) == 'minArea'
+        area = sum(s[1] * s[2] for s in sizeList)
+        low, high = widest, pliBox.width() - xMargin
+        width = min(high, max(low, area / max(1.0, pliBox.height() - yMargin)))
+        for i in range(3):
+            newPositions, newBox = PLI.__skylinePack(orderedList, width)
+            if minArea:
+                fits = newBox.width() * newBox.height() < pliBox.width() * pliBox.height()
+            else:
+                fits = newBox.height() <= pliBox.height()
+            if fits:
+                high, positions, pliBox = width, newPositions, newBox
+            else:
+                low = width
+            width = (low + high) / 2.0
+        return positions, pliBox
+
+    @staticmethod
+    def __skylinePack(sizeList, width):
+        xMargin, yMargin = PLI.margin.x(), PLI.margin.y()
+        packer = CygonRectanglePacker(width, sum(s[2] for s in sizeList) + 1.0)  # Tall enough to never run out
+
+        positions = []
+        right = bottom = 0.0
+        for item, w, h, indicator in sizeList:
+            point = packer.TryPack(w, h)
+            positions.append((item, xMargin + point.x, yMargin + point.y + indicator))
+            right = max(right, point.x + w)
+            bottom = max(bottom, point.y + h)
+
+        return positions, QRectF(0, 0, xMargin + right, yMargin + bottom)
+
     def initLayout(self):
         """
         Allocate space for all parts in this PLI, and choose a decent layout.
@@ -1647,81 +1835,14 @@ class PLI(PLITreeManager, GraphicsRoundRectItem):
         for item in self.pliItems:
             item.initLayout()
 
-        # Sort list of parts to lay out first by color (in reverse order) 
-        # ,then by width (narrowest first) 
-        # ,then remove tallest part, to be added first
-        partList = list(self.pliItems)
-        # Sort by color, reversed 
-        partList.sort(key = lambda i: i.color.sortKey() if (i.color) else LicHelpers.LicColor.red().sortKey(), reverse = True)  
-        # Sort by width (then height, for ties)
-        partList.sort(key = lambda i: (i.rect().width(), i.rect().height()))  
-        # reverse list so we choose last part if two+ parts equally tall
-        tallestPart = max(reversed(partList), key = lambda x: x.abstractPart.height)
-        partList.remove(tallestPart)
-        partList.append(tallestPart)
-    
-        # This rect will be enlarged as needed
-        pliBox = QRectF(0, 0, -1, -1)
-
-        overallX = maxX = xMargin = PLI.margin.x()
-        overallY = maxY = yMargin = PLI.margin.y()
-
-        prevItem = None
-        remainingHeight = 0.0
-        
-        while partList:
-            
-            item = None
-            
-            if prevItem:
-                remainingHeight = pliBox.height() - prevItem.pos().y() - prevItem.rect().height() - yMargin - yMargin 
-                
-            # Check if we can fit any parts under the last part without extending the PLI box vertically
-            if remainingHeight > 0:
-                for pliItem in partList:
-                    if pliItem.rect().height() < remainingHeight:
-                        item = pliItem
-                        break
-
-            # Found an item that fits below the previous - put it there
-            if item:
-                partList.remove(pliItem)
-                overallX = prevItem.pos().x()
-                newWidth = prevItem.rect().width()
-                y = prevItem.pos().y() + prevItem.rect().height() + yMargin
-                item.setPos(overallX, y)
-            
-            # Use last item in list (widest)
-            if not item:
-                item = partList.pop()
-                item.setPos(overallX, overallY)
-                newWidth = item.rect().width()
-
-            # Increase overall x, to make PLI box big enough for this part
-            overallX += newWidth + xMargin
- 
-            # If this part pushes this PLI beyond the step's right edge, wrap to new line           
-            if overallX > self.parentItem().rect().width():
-                overallX = xMargin
-                overallY = pliBox.height()
-                item.setPos(overallX, overallY)
-                overallX += newWidth + xMargin
-            
-            maxX = max(maxX, overallX)
-            maxY = max(maxY, overallY + item.rect().height() + yMargin)
-            pliBox.setWidth(maxX)
-            pliBox.setHeight(maxY)
-            self.setRect(pliBox)
-            prevItem = item
+        positions, pliBox = PLI.packItems(self.pliItems, self.parentItem().rect().width())
+        for item, x, y in positions:
+            item.setPos(x, y)
+        self.setRect(pliBox)
         
         # Sort pliITems so tree Model list roughly matches item paint order (left to right)
         self.pliItems.sort(key = lambda i: i.pos().x())  
 
-        # Need to nudge any PLIItems that have length indicators down, to accommodate placing indicators above part        
-        for item in self.pliItems:
-            if item.lengthIndicator:
-                item.moveBy(0, item.lengthIndicator.rect().height())
-
 class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
     """ Construction Step Image.  Includes border and positional info. """
     itemClassName = "CSI"
@@ -1741,10 +1862,50 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         self.rotation = [0.0, 0.0, 0.0]
         self.scaling = 1.0
 
-        self.parts = []
+        self._partItemDict = {}  # {part name: PartTreeItem}
+        self._sortedParts = None
         self.isDirty = True
         self.nextCSIIsDirty = False
 
+    def _setDirty(self, isDirty):
+        self._isDirty = isDirty
+        if isDirty:
+            self._sizingExtent = None  # Whatever changed may have changed what later steps draw, too
+
+    def _getDirty(self):
+        return self._isDirty
+
+    isDirty = property(_getDirty, _setDirty)
+
+    def __getNeighbours(self):
+        submodel = self.getPage().submodel
+        modelIndex = submodel.getModelIndex() if isinstance(submodel, Submodel) else None
+        return modelIndex.getCSINeighbours(self) if modelIndex else None
+
+    def getPrevCSI(self):
+        """ The CSI of the step before this one, in the same submodel or callout. """
+        neighbours = self.__getNeighbours()
+        if neighbours is not None:
+            return neighbours[0]
+        prevStep = self.parentItem().getPrevStep()
+        return prevStep.csi if prevStep else None
+
+    def getNextCSI(self):
+        """ The CSI of the step after this one, in the same submodel or callout. """
+        neighbours = self.__getNeighbours()
+        if neighbours is not None:
+            return neighbours[1]
+        nextStep = self.parentItem().getNextStep()
+        return nextStep.csi if nextStep else None
+
+    def _getParts(self):
+        """ This CSI's PartTreeItems, sorted by name.  Only sorted when something asks for them. """
+        if self._sortedParts is None:
+            self._sortedParts = sorted(self._partItemDict.values(), key = lambda partItem: partItem.name)
+        return self._sortedParts
+
+    parts = property(_getParts)
+
     def getPartList(self):
         partList = []
         for partItem in self.parts:
@@ -1772,10 +1933,12 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         if self.isDirty:
             self.resetPixmap()
             if self.nextCSIIsDirty:
-                nextStep = self.parentItem().getNextStep()
-                if nextStep:
-                    nextStep.csi.isDirty = nextStep.csi.nextCSIIsDirty = True
+                nextCSI = self.getNextCSI()
+                if nextCSI:
+                    nextCSI.isDirty = nextCSI.nextCSIIsDirty = True
                 self.nextCSIIsDirty = False
+        elif self.glDispID == LicGLHelpers.UNINIT_GL_DISPID and self.parts:
+            self.createGLDisplayList()  # Display list was released while this page was scrolled far away
 
         LicGLHelpers.pushAllGLMatrices()
 
@@ -1789,27 +1952,39 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         LicGLHelpers.popAllGLMatrices()
 
     def addPart(self, part):
-        for p in self.parts:
-            if p.name == part.abstractPart.name:
-                p.addPart(part)
-                return
-            
-        p = PartTreeItem(self, part.abstractPart.name)
-        p.addPart(part)
-        self.parts.append(p)
-        self.parts.sort(key = lambda partItem: partItem.name)
+        self.addParts([part])
+
+    def addParts(self, partList):
+        ModelIndex.csiChanged()
+        for part in partList:
+            name = part.abstractPart.name
+            partItem = self._partItemDict.get(name)
+            if partItem is None:
+                partItem = self._partItemDict[name] = PartTreeItem(self, name)
+                self._sortedParts = None
+            partItem.addPart(part)
 
     def removePart(self, part):
+        self.removeParts([part])
 
-        for p in self.parts:
-            if part in p.parts:
-                p.removePart(part)
-                break
+    def removeParts(self, partList):
 
-        for p in [x for x in self.parts if not x.parts]:  # Delete empty part item groups
-            self.scene().removeItem(p)
-            self.parts.remove(p)
-            p.setParentItem(None)
+        ModelIndex.csiChanged()
+        removeDict = {}  # {PartTreeItem: [parts to remove from it]}
+        for part in partList:
+            partItem = self._partItemDict.get(part.abstractPart.name)
+            if partItem is None or part not in partItem.parts:  # Part was renamed since it was added
+                partItem = next((p for p in self._partItemDict.values() if part in p.parts), None)
+            if partItem is not None:
+                removeDict.setdefault(partItem, []).append(part)
+
+        for partItem, parts in removeDict.items():
+            partItem.removeParts(parts)
+            if not partItem.parts:  # Delete empty part item groups
+                self.scene().removeItem(partItem)
+                del self._partItemDict[partItem.name]
+                self._sortedParts = None
+                partItem.setParentItem(None)
 
     def containsSubmodel(self):
         return any(part.isSubmodel() for part in self.getPartList())
@@ -1842,6 +2017,12 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         self.__callPreviousGLDisplayLists(True)
         GL.glEndList()
 
+    def releaseGLDisplayList(self):
+        """ Free this CSI's display list.  Size & center are kept, and paintGL rebuilds the list on demand. """
+        if self.glDispID != LicGLHelpers.UNINIT_GL_DISPID:
+            GL.glDeleteLists(self.glDispID, 1)
+            self.glDispID = LicGLHelpers.UNINIT_GL_DISPID
+
     def resetPixmap(self):
 
         if not self.parts:
@@ -1857,16 +2038,18 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         glContext = self.getPage().instructions.glContext
         glContext.makeCurrent()
         self.createGLDisplayList()
-        sizes = [512, 1024, 2048]
 
-        for size in sizes:
-
-            # Create a new buffer tied to the existing GLWidget, to get access to its display lists
-            pBuffer = QGLPixelBuffer(size, size, LicGLHelpers.getGLFormat(), glContext)
-            pBuffer.makeCurrent()
+        if LicGLHelpers.analyticSizingAvailable():
+            self.initAnalyticSize()  # No render needed: previous steps' extent is kept, so only this step's parts get projected
+        else:
+            for size in LicGLHelpers.sizeLadder(self.predictSize()):
 
-            if self.initSize(size, pBuffer):
-                break
+                # Render into a pooled buffer of the GLWidget's own context, which has all display lists
+                target = LicGLHelpers.beginOffscreenSizing(size)
+                result = self.initSize(size, target)
+                LicGLHelpers.endOffscreenSizing(target)
+                if result:
+                    break
 
         # Move CSI so its new center matches its old
         dx = (self.rect().width() - oldWidth) / 2.0
@@ -1876,7 +2059,7 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
 
         glContext.makeCurrent()
         
-    def initSize(self, size, pBuffer):
+    def initSize(self, size, target):
         """
         Initialize this CSI's display width, height and center point. To do
         this, draw this CSI to the already initialized GL Frame Buffer Object.
@@ -1885,11 +2068,15 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
 
         Parameters:
             size: Width & height of FBO to render to, in pixels.  Note that FBO is assumed square.
+            target: The bound render target, from LicGLHelpers.beginOffscreenSizing.
 
         Returns:
             True if CSI rendered successfully.
             False if the CSI has been rendered partially or wholly out of frame.
         """
+        if self.glDispID == LicGLHelpers.UNINIT_GL_DISPID and self.parts:
+            self.createGLDisplayList()  # Display list was released while this page was scrolled far away
+
         if self.glDispID == LicGLHelpers.UNINIT_GL_DISPID:
             print "ERROR: Trying to init a CSI size that has no display list"
             LicHelpers.writeLogEntry("Trying to initialize a CSI size that has no display list", self.__class__.__name__)
@@ -1905,11 +2092,107 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
         params = LicGLHelpers.initImgSize(size, self.glDispID, filename, CSI.defaultScale * self.scaling, CSI.defaultRotation, self.rotation)
         if params is None:
             return False
+        return self.setSize(params)
+
+    def getSizingView(self):
+        """ The (glDispID, scale, rotation, partRotation) initSize draws this CSI with, for batched sizing. """
+        if self.glDispID == LicGLHelpers.UNINIT_GL_DISPID and self.parts:
+            self.createGLDisplayList()
+        return (self.glDispID, CSI.defaultScale * self.scaling, CSI.defaultRotation, self.rotation)
+
+    def initAnalyticSize(self):
+        """
+        Same as initSize, but calculated from projected geometry; needs numpy, but no GL context.
+        A CSI draws every previous step as well, so its extent is the previous step's extent plus
+        this step's parts.  Each CSI keeps that extent until it is next made dirty, so sizing
+        a run of dirty CSIs in order only ever projects each step's own parts.
+        """
+        view = (CSI.defaultScale * self.scaling, CSI.defaultRotation, self.rotation)
+        previousExtent = self.getPreviousExtent(view)
+
+        # Later steps draw this step's parts without displacement, arrows or highlights
+        partList = self.getPartList()
+        ownExtent = self.__getOwnExtent(partList, False, view)
+        self._sizingExtent = (view, LicGLHelpers.unionExtents(previousExtent, ownExtent))
+
+        pageNumber, stepNumber = self.getPageStepNumberPair()
+        if not self.parts:
+            return "Rendering CSI Page %d Step %d" % (pageNumber, stepNumber)  # A CSI with no parts is already initialized
+
+        if CSI.highlightNewParts or any(part.displacement or part.arrows or part.isSelected() for part in partList):
+            ownExtent = self.__getOwnExtent(partList, True, view)
+        extent = LicGLHelpers.unionExtents(previousExtent, ownExtent)
+        if extent is None:
+            return False
+        return self.setSize(LicGLHelpers.analyticImgSizeFromExtent(extent))
+
+    def getPreviousExtent(self, view):
+        """ analyticExtent of everything previous steps draw into this CSI, under the given (scale, rotation, partRotation) view. """
+        
+        # Walk back to the nearest step that still knows its extent, then build forward from there
+        extent, csiList = None, []
+        prevStep = self.parentItem().getPrevStep()
+        while prevStep:
+            csi = prevStep.csi
+            if csi._sizingExtent is not None and csi._sizingExtent[0] == view:
+                extent = csi._sizingExtent[1]
+                break
+            csiList.append(csi)
+            prevStep = csi.parentItem().getPrevStep()
 
+        for csi in reversed(csiList):
+            extent = LicGLHelpers.unionExtents(extent, csi.__getOwnExtent(csi.getPartList(), False, view))
+        return extent
+
+    def __getOwnExtent(self, partList, isCurrent, view):
+        if not partList:
+            return None
+        points = LicGLHelpers.numpy.concatenate([part.getSizingPoints(isCurrent) for part in partList])
+        return LicGLHelpers.analyticExtent(points, *view)
+
+    def predictSize(self):
+        """ The buffer size initSize should first try, predicted from the bounding boxes of everything drawn. """
+        return LicGLHelpers.predictImgSize(self.getSizingHalfSize(), 512)
+
+    def getSizingHalfSize(self, previousHalfSize = None):
+        """
+        projectedHalfSize of this CSI's parts and of every previous step's, which its display list also draws.
+        previousHalfSize is the same value for the previous step's CSI, if known and drawn under the same
+        scale & rotation; passing it saves walking back through every previous step.
+        """
+        scale = CSI.defaultScale * self.scaling
+        halfSize, csi = 0.0, self
+        while csi:
+            vertices = csi.__getSizingVertices(csi is self)
+            halfSize = max(halfSize, LicGLHelpers.projectedHalfSize(vertices, scale, CSI.defaultRotation, self.rotation))
+            prevStep = csi.parentItem().getPrevStep()
+            if prevStep and previousHalfSize is not None:
+                return max(halfSize, previousHalfSize)
+            csi = prevStep.csi if prevStep else None
+        return halfSize
+
+    def __getSizingVertices(self, isCurrent):
+        # Bounding box corners of each part, placed like callGLDisplayList places them
+        vertices = []
+        for part in self.getPartList():
+            box = part.abstractPart.getBoundingBox()
+            if box is None:
+                continue
+            matrix = list(part.matrix) if part.matrix else None
+            if matrix and isCurrent and part.displacement:
+                matrix[12] += part.displacement[0]
+                matrix[13] += part.displacement[1]
+                matrix[14] += part.displacement[2]
+            vertices += [box.transformPoint(matrix, *v) for v in box.vertices()] if matrix else list(box.vertices())
+        return vertices
+
+    def setSize(self, params):
+        """ Apply an initImgSize result to this CSI.  Returns what a successful initSize does. """
         w, h, self.center, unused1, unused2 = params
         self.setRect(0.0, 0.0, w, h)
         self.isDirty = False
-        return result
+        pageNumber, stepNumber = self.getPageStepNumberPair()
+        return "Rendering CSI Page %d Step %d" % (pageNumber, stepNumber)
 
     def createPng(self):
 
@@ -2065,6 +2348,46 @@ class CSI(CSITreeManager, RotateScaleSignalItem, QGraphicsRectItem):
 
         self.scene().undoStack.endMacro()
 
+class PartDimensionCache(object):
+    """
+    Persistent record of part sizes, shared by every book and session.  Entries are keyed on a hash of
+    everything a part draws plus the scale & rotations it was sized with, so edited parts, submodels
+    and changed PLI or SubmodelPreview defaults simply miss.  Stored in config.rootCachePath().
+    """
+
+    version = 1  # Bump whenever sizing itself changes, to drop every stored size
+
+    def __init__(self):
+        self.settings = None
+
+    def __getSettings(self):
+        if self.settings is None:
+            self.settings = QSettings(os.path.join(config.rootCachePath(), 'partdimensions.ini'), QSettings.IniFormat)
+        return self.settings
+
+    def __getKey(self, part, method, extraRotation, extraScale):
+        view = (PartDimensionCache.version, method) + part.getSizingView(extraRotation, extraScale)[1:]
+        return "PartDimensions/%s_%s" % (part.getContentHash(), hashlib.sha1(repr(view)).hexdigest())
+
+    def load(self, part, method, extraRotation = [0.0, 0.0, 0.0], extraScale = 1.0):
+        """ Apply part's stored size, if any.  Returns True if part was sized. """
+        value = str(self.__getSettings().value(self.__getKey(part, method, extraRotation, extraScale)).toString())
+        if not value:
+            return False
+        w, h, x, y, leftInset, bottomInset = [float(v) for v in value.split()]
+        return part.setSize((int(w), int(h), QPointF(x, y), int(leftInset), int(bottomInset)))
+
+    def store(self, part, method, extraRotation = [0.0, 0.0, 0.0], extraScale = 1.0):
+        """ Record part's current size, as sized by method with the given view. """
+        value = "%d %d %f %f %d %d" % (part.width, part.height, part.center.x(), part.center.y(), part.leftInset, part.bottomInset)
+        self.__getSettings().setValue(self.__getKey(part, method, extraRotation, extraScale), QVariant(value))
+
+    def sync(self):
+        if self.settings is not None:
+            self.settings.sync()
+
+partDimensionCache = PartDimensionCache()
+
 class AbstractPart(object):
     """
     Represents one 'abstract' part.  Could be regular part, like 2x4 brick, could be a 
@@ -2085,6 +2408,8 @@ class AbstractPart(object):
         self.isPrimitive = False  # primitive here means sub-part or part that's internal to another part
         self.isSubmodel = False
         self._boundingBox = None
+        self._edgeArray = None
+        self._contentHash = None
         
         self.pliScale = 1.0
         self.pliRotation = [0.0, 0.0, 0.0]
@@ -2106,6 +2431,8 @@ class AbstractPart(object):
         newPart.isPrimitive = self.isPrimitive
         newPart.isSubmodel = self.isSubmodel
         newPart._boundingBox = self._boundingBox.duplicate() if self._boundingBox else None
+        newPart._edgeArray = self._edgeArray
+        newPart._contentHash = self._contentHash
         newPart.pliScale, newPart.pliRotation = self.pliScale, list(self.pliRotation)
         newPart.width, newPart.height = self.width, self.height
         newPart.leftInset, newPart.bottomInset = self.leftInset, self.bottomInset
@@ -2151,23 +2478,55 @@ class AbstractPart(object):
 
         glContext.makeCurrent()
         self.createGLDisplayList(skipPartInit)
-        sizes = [128, 256, 512, 1024, 2048]
         self.width, self.height, self.center, self.leftInset, self.bottomInset = [0] * 5
 
-        for size in sizes:
+        rotation = extraRotation if extraRotation else self.pliRotation
+        scaling = extraScale if extraScale else self.pliScale
 
-            # Create a new buffer tied to the existing GLWidget, to get access to its display lists
-            pBuffer = QGLPixelBuffer(size, size, LicGLHelpers.getGLFormat(), glContext)
-            pBuffer.makeCurrent()
+        method = AbstractPart.getSizingMethod()
+        if partDimensionCache.load(self, method, rotation, scaling):
+            return
 
-            rotation = extraRotation if extraRotation else self.pliRotation
-            scaling = extraScale if extraScale else self.pliScale
-            if self.initSize(size, pBuffer, rotation, scaling):
+        if method == "analytic":
+            if self.initAnalyticSize(rotation, scaling):
+                partDimensionCache.store(self, method, rotation, scaling)
+            return
+
+        for size in LicGLHelpers.sizeLadder(self.predictSize(rotation, scaling)):
+
+            # Render into a pooled buffer of the GLWidget's own context, which has all display lists
+            target = LicGLHelpers.beginOffscreenSizing(size)
+            result = self.initSize(size, target, rotation, scaling)
+            LicGLHelpers.endOffscreenSizing(target)
+            if result:
+                partDimensionCache.store(self, method, rotation, scaling)
                 break
 
-        glContext.makeCurrent()
+    @staticmethod
+    def getSizingMethod():
+        """ How parts get sized here: "analytic" (see initAnalyticSize) or "gl" (see initSize).  Each keeps its own cached sizes. """
+        return "analytic" if LicGLHelpers.analyticSizingAvailable() else "gl"
 
-    def initSize(self, size, pBuffer, extraRotation = [0.0, 0.0, 0.0], extraScale = 1.0):
+    def getContentHash(self):
+        """
+        Hash of everything this part draws: its own primitives, plus its sub parts and where they go.
+        Cached, except for submodels, whose content can change.
+        """
+        if self._contentHash is not None:
+            return self._contentHash
+
+        h = hashlib.sha1()
+        for primitive in self.primitives:
+            h.update(repr((primitive.type, primitive.points)))
+        for part in self.parts:
+            h.update(repr((part.abstractPart.getContentHash(), part.matrix)))
+        contentHash = h.hexdigest()
+
+        if not self.isSubmodel:
+            self._contentHash = contentHash
+        return contentHash
+
+    def initSize(self, size, target, extraRotation = [0.0, 0.0, 0.0], extraScale = 1.0):
         """
         Initialize this part's display width, height, empty corner insets and center point.
         To do this, draw this part to the already initialized GL buffer.
@@ -2175,6 +2534,7 @@ class AbstractPart(object):
 
         Parameters:
             size: Width & height of GL buffer to render to, in pixels.  Note that buffer is assumed square
+            target: The bound render target, from LicGLHelpers.beginOffscreenSizing.
 
         Returns:
             True if part rendered successfully.
@@ -2183,15 +2543,65 @@ class AbstractPart(object):
 
         #TODO: If a part is rendered at a size > 256, draw it smaller in the PLI
         # - this sounds like a great way to know when to shrink a PLI image...
-        rotation = SubmodelPreview.defaultRotation if self.isSubmodel else PLI.defaultRotation
-        scaling = SubmodelPreview.defaultScale if self.isSubmodel else PLI.defaultScale
-        params = LicGLHelpers.initImgSize(size, self.glDispID, self.filename, scaling * extraScale, rotation, extraRotation)
+        glDispID, scaling, rotation, extraRotation = self.getSizingView(extraRotation, extraScale)
+        params = LicGLHelpers.initImgSize(size, glDispID, self.filename, scaling, rotation, extraRotation)
         if params is None:
             return False
+        return self.setSize(params)
 
+    def getSizingView(self, extraRotation = [0.0, 0.0, 0.0], extraScale = 1.0):
+        """ The (glDispID, scale, rotation, partRotation) initSize draws this part with, for batched sizing. """
+        rotation = SubmodelPreview.defaultRotation if self.isSubmodel else PLI.defaultRotation
+        scaling = SubmodelPreview.defaultScale if self.isSubmodel else PLI.defaultScale
+        return (self.glDispID, scaling * extraScale, rotation, extraRotation)
+
+    def predictSize(self, extraRotation = [0.0, 0.0, 0.0], extraScale = 1.0):
+        """ The buffer size initSize should first try, predicted from this part's bounding box. """
+        box = self.getBoundingBox()
+        if box is None:
+            return 128
+        unused, scaling, rotation, extraRotation = self.getSizingView(extraRotation, extraScale)
+        return LicGLHelpers.predictImgSize(LicGLHelpers.projectedHalfSize(box.vertices(), scaling, rotation, extraRotation), 128)
+
+    def setSize(self, params):
+        """ Apply an initImgSize or analyticImgSize result to this part. """
         self.width, self.height, self.center, self.leftInset, self.bottomInset = params
         return True
 
+    def initAnalyticSize(self, extraRotation = [0.0, 0.0, 0.0], extraScale = 1.0):
+        """
+        Same as initSize, but calculated from this part's projected geometry; needs numpy, but no GL context.
+
+        Returns:
+            True if part was sized, False if it has nothing to draw.
+        """
+        unused, scaling, rotation, extraRotation = self.getSizingView(extraRotation, extraScale)
+        params = LicGLHelpers.analyticImgSize(self.getEdgeArray(), scaling, rotation, extraRotation)
+        if params is None:
+            return False
+        return self.setSize(params)
+
+    def getEdgeArray(self):
+        """
+        Every line and polygon side in this part, flattened into this part's coordinates as an (n, 2, 3) numpy array.
+        Cached, except for submodels, whose content can change.
+        """
+        if self._edgeArray is not None:
+            return self._edgeArray
+
+        edgeList = []
+        for primitive in self.primitives:
+            edgeList += primitive.getEdges()
+
+        arrays = [LicGLHelpers.createEdgeArray(edgeList)]
+        for part in self.parts:
+            arrays.append(LicGLHelpers.transformEdges(part.abstractPart.getEdgeArray(), part.matrix))
+        edgeArray = LicGLHelpers.numpy.concatenate(arrays)
+
+        if not self.isSubmodel:
+            self._edgeArray = edgeArray
+        return edgeArray
+
     def paintGL(self, dx, dy, rotation = [0.0, 0.0, 0.0], scaling = 1.0, color = None):
 
         LicGLHelpers.pushAllGLMatrices()
@@ -2243,6 +2653,8 @@ class AbstractPart(object):
         return box
 
     def resetBoundingBox(self):
+        self._edgeArray = None
+        self._contentHash = None
         for primitive in self.primitives:
             primitive.resetBoundingBox()
         for part in self.parts:
@@ -2328,6 +2740,8 @@ class Submodel(SubmodelTreeManager, AbstractPart):
 
         self.pages = []
         self.submodels = []
+        self.pageShifts = LicHelpers.NumberShiftLog()  # Pending renumbering of self.pages
+        self.stepShifts = LicHelpers.NumberShiftLog()  # Pending renumbering of the steps on self.pages
 
         self._row = 0
         self._parent = parent
@@ -2462,11 +2876,12 @@ class Submodel(SubmodelTreeManager, AbstractPart):
             
             # Here, partList is all parts not yet allocated to a Step, and currentPartIndex is an index into  
             # that list; parts before currentPartIndex stay in this Step, parts after get bumped to next Step
-            for part in partList[currentPartIndex: ]:  # Move all but the first x parts to next step
-                currentStep = part.getStep()
+            movedParts = partList[currentPartIndex: ]  # Move all but the first x parts to next step
+            currentStep = sourceCSI.parentItem()
+            for part in movedParts:
                 part.setParentItem(newPage)
-                currentStep.removePart(part)
-                newPage.steps[-1].addPart(part)
+            currentStep.removeParts(movedParts)
+            newPage.steps[-1].addParts(movedParts)
 
             sourceCSI = newPage.steps[-1].csi
             
@@ -2478,48 +2893,91 @@ class Submodel(SubmodelTreeManager, AbstractPart):
         if len(self.pages) < 2:
             return
         
-        currentPage = self.pages[0]
-        nextPage = self.pages[1]
-        
-        while True:   # yeah yeah, nested infinite loops of nastiness
-            while True:
-
-                nextStep = nextPage.steps[0]
-                partList = nextStep.csi.getPartList()
-                submodelList = [p for p in partList if p.isSubmodel()]
-                if submodelList:  # Check if next Step has any Submodels
-
-                    if len(submodelList) == len(partList):  # Check if next Step is full of Submodels
-                        nextStep.disablePLI()  # Leave Submodel steps as first on page, and hide their PLI.
-
-                    nextPage.initLayout()
-                    break
-
-                nextStep.moveToPage(currentPage) # Move step on next page to current page
-
-                currentLayout = currentPage.layout.orientation
-                currentPage.useHorizontalLayout()  # Try horizontal layout
-                if currentPage.checkForLayoutOverlaps(): 
-
-                    currentPage.useVerticalLayout()  # Try vertical layout
-                    if currentPage.checkForLayoutOverlaps():
+        noPLIPages = []
+        for page in self.pages[1:]:
+            if page.steps:
+                step = page.steps[0]
+                partList = step.csi.getPartList()
+                if partList and all(p.isSubmodel() for p in partList):  # Check if Step is full of Submodels
+                    step.disablePLI()  # Leave Submodel steps as first on page, and hide their PLI.
+                    noPLIPages.append(page)
+
+        # Plan every page break from cached step sizes first, then move steps & lay out each page just once
+        pages = list(self.pages)
+        for first, end, orientation in self.planPageBreaks():
+            currentPage = pages[first]
+            if end - first < 2:
+                if currentPage in noPLIPages:
+                    currentPage.initLayout()
+                continue
+            for page in pages[first + 1 : end]:
+                for step in list(page.steps):
+                    step.moveToPage(currentPage)
+                self.deletePage(page)
+            currentPage.layout.orientation = orientation
+            currentPage.initLayout()
 
-                        currentPage.steps[-1].moveToPage(nextPage)  # move Step back & redo layouts
-                        currentPage.layout.orientation = currentLayout
-                        currentPage.initLayout()
-                        nextPage.initLayout()
-                        break  # This page is full: move on to the next
-                    
-                tmp = nextPage.nextPage()  # No overlap - delete empty page & move on
-                self.deletePage(nextPage)
-                if tmp is None:  # At last page - all done
-                    return
-                nextPage = tmp
-                    
-            currentPage = nextPage
-            nextPage = nextPage.nextPage()
-            if nextPage is None:  # At last page - all done
-                return
+    def planPageBreaks(self, solver = optimalPageBreaks):
+        """
+        Decide which of this submodel's pages to merge, without moving anything.  solver is
+        optimalPageBreaks or greedyPageBreaks.  Returns a list of (first page index, end page index, orientation).
+        """
+        pages = self.pages
+        plans = {}
+
+        def startsPage(i):
+            # Steps with Submodels always start a new page
+            return not pages[i].steps or any(p.isSubmodel() for p in pages[i].steps[0].csi.getPartList())
+
+        def stepList(i, j):
+            return [step for page in pages[i:j] for step in page.steps]
+
+        fitCache = {}
+        def fits(i, j):
+            if j - i == 1:
+                return pages[i].layout.orientation  # A page on its own stays as it is
+            if (i, j) not in fitCache:
+                locked = any(page.lockIcon.isLocked or not page.steps for page in pages[i:j])
+                fitCache[i, j] = None if locked else self.__planMergedPage(pages[i], stepList(i, j), plans)
+            return fitCache[i, j]
+
+        def badness(i, j, orientation):
+            steps = stepList(i, j)
+            for step in steps:
+                if step not in plans:
+                    plans[step] = StepLayoutPlan(step)
+            pageRect = pages[i].insetRect()
+            usedArea = sum(plans[step].area() for step in steps)
+            unused = max(0.0, 1.0 - usedArea / max(1.0, pageRect.width() * pageRect.height()))
+            return unused * unused
+
+        return solver(len(pages), fits, startsPage, badness)
+
+    def __planMergedPage(self, page, stepList, plans):
+        """
+        Check if every step in stepList would fit on page, trying a horizontal layout and then a vertical one.
+        Returns the orientation that fits, or None.  Only StepLayoutPlans are used; nothing is moved.
+        """
+        for step in stepList:
+            if step not in plans:
+                plans[step] = StepLayoutPlan(step)
+            if not plans[step].canPlan:
+                return None
+
+        pageRect = page.rect()
+        members = [page.submodelItem] if page.submodelItem else []
+        fixedRects = [m.rect() if m.fixedSize else None for m in members] + [None] * len(stepList)
+
+        layout = copy.copy(page.layout)
+        for orientation in [Horizontal, Vertical]:
+            layout.orientation = orientation
+            destRects = []
+            for rowRects, unused in layout.getGridRects(page.insetRect(), fixedRects):
+                destRects += rowRects
+            destRects = destRects[len(members):]
+            if all(plans[step].fits(destRect, pageRect) for step, destRect in zip(stepList, destRects)):
+                return orientation
+        return None
 
     def reOrderSubmodelPages(self):
         """ Reorder the tree so a submodel is right before the page it's used on """
@@ -2561,6 +3019,7 @@ class Submodel(SubmodelTreeManager, AbstractPart):
             submodel._parent = self
             submodel._row = self.rowCount()
             self.submodels.append(submodel)
+            ModelIndex.pagesChanged()
             self.reOrderSubmodelPages()
             self.instructions.mainModel.syncPageNumbers()
             for page in submodel.pages:
@@ -2570,12 +3029,26 @@ class Submodel(SubmodelTreeManager, AbstractPart):
     def removeSubmodel(self, submodel):
         self.removeRow(submodel._row)
         self.submodels.remove(submodel)
+        ModelIndex.pagesChanged()
         for page in submodel.pages:
             page.scene().removeItem(page)
         self.instructions.mainModel.syncPageNumbers()
         submodel._parent = None
 
+    def getModelIndex(self):
+        """ The main model's ModelIndex, if it covers this submodel yet, otherwise None. """
+        mainModel = self.instructions.mainModel if self.instructions else None
+        modelIndex = mainModel.modelIndex if isinstance(mainModel, Mainmodel) else None
+        return modelIndex if modelIndex and modelIndex.contains(self) else None
+
     def findSubmodelStep(self, submodel):
+        modelIndex = self.getModelIndex()
+        if modelIndex:
+            for step in modelIndex.getUsingSteps(submodel):
+                if step.parentItem().submodel is self:
+                    return step
+            return None
+
         for page in self.pages:
             for step in page.steps:
                 if submodel in [part.abstractPart for part in step.csi.getPartList()]:
@@ -2589,6 +3062,7 @@ class Submodel(SubmodelTreeManager, AbstractPart):
             for step in l:
                 step.number = stepNumber
                 stepNumber += 1
+        self.stepShifts.compact()
                 
         for page in self.pages:
             page.steps.sort(key = lambda x: x._number)
@@ -2605,6 +3079,7 @@ class Submodel(SubmodelTreeManager, AbstractPart):
             else: # have a Page
                 item.number = pageNumber
                 pageNumber += 1
+        self.pageShifts.compact()
 
         return pageNumber
     
@@ -2620,6 +3095,8 @@ class Submodel(SubmodelTreeManager, AbstractPart):
         for p in self.pages[page._row : ]:
             p._row += 1
         self.pages.insert(page._row, page)
+        page.attachNumbering(self.pageShifts)
+        ModelIndex.pagesChanged()
         page.addBlankStep()
         return page
 
@@ -2638,6 +3115,10 @@ class Submodel(SubmodelTreeManager, AbstractPart):
 
         index = len([p for p in self.pages if p._row < page._row])
         self.pages.insert(index, page)
+        page.attachNumbering(self.pageShifts)
+        for step in page.steps:
+            step.attachNumbering(self.stepShifts)
+        ModelIndex.pagesChanged()
 
         if page in self.instructions.scene.items():
             self.instructions.scene.removeItem(page)  # Need to re-add page to trigger scene page layout
@@ -2658,6 +3139,10 @@ class Submodel(SubmodelTreeManager, AbstractPart):
             self.pages.remove(page)
         except ValueError:
             pass
+        page.attachNumbering(None)
+        for step in page.steps:
+            step.attachNumbering(None)
+        ModelIndex.pagesChanged()
             
         self.instructions.updatePageNumbers(page.number, -1)
 
@@ -2680,16 +3165,13 @@ class Submodel(SubmodelTreeManager, AbstractPart):
                 step.parentItem().initLayout()
 
     def updateStepNumbers(self, newNumber, increment = 1):
-        for p in self.pages:
-            for s in p.steps:
-                if s.number >= newNumber:
-                    s.number += increment
+        self.stepShifts.shift(newNumber, increment)
+        ModelIndex.stepsChanged()
 
     def updatePageNumbers(self, newNumber, increment = 1):
         
-        for p in self.pages:
-            if p.number >= newNumber:
-                p.number += increment
+        self.pageShifts.shift(newNumber, increment)
+        ModelIndex.pagesChanged()
                 
         for submodel in self.submodels:
             submodel.updatePageNumbers(newNumber, increment)
@@ -2702,10 +3184,16 @@ class Submodel(SubmodelTreeManager, AbstractPart):
             submodel.deleteAllPages(scene)
 
     def getStepByNumber(self, stepNumber):
-        for page in self.pages:
-            for step in page.steps:
-                if step.number == stepNumber:
-                    return step
+        modelIndex = self.getModelIndex()
+        if modelIndex:
+            step = modelIndex.getStep(self, stepNumber)
+            if step:
+                return step
+        else:
+            for page in self.pages:
+                for step in page.steps:
+                    if step.number == stepNumber:
+                        return step
                 
         for submodel in self.submodels:
             step = submodel.getStepByNumber(stepNumber)
@@ -2714,9 +3202,15 @@ class Submodel(SubmodelTreeManager, AbstractPart):
         return None
 
     def getPage(self, pageNumber):
-        for page in self.pages:
-            if page.number == pageNumber:
+        modelIndex = self.getModelIndex()
+        if modelIndex:
+            page = modelIndex.getPage(self, pageNumber)
+            if page:
                 return page
+        else:
+            for page in self.pages:
+                if page.number == pageNumber:
+                    return page
         for submodel in self.submodels:
             page = submodel.getPage(pageNumber)
             if page:
@@ -2739,7 +3233,36 @@ class Submodel(SubmodelTreeManager, AbstractPart):
     def createBlankPart(self):
         return Part(self.filename, matrix = LicGLHelpers.IdentityMatrix())
 
+    def mergeIdenticalCallouts(self):
+        """
+        Merge every set of matching callouts on the same step, across this submodel & its children, as one undo
+        action.  Returns the number of sets merged.
+        """
+        groupList = []
+        for page in self.getPageList():
+            for step in page.steps:
+                if len(step.callouts) < 2:
+                    continue
+                signatureDict = collections.OrderedDict()  # {signature: [callouts]}
+                for callout in step.callouts:
+                    signature = callout.getSignature()
+                    if signature:  # Leave empty callouts alone
+                        signatureDict.setdefault(signature, []).append(callout)
+                groupList += [calloutList for calloutList in signatureDict.values() if len(calloutList) > 1]
+
+        if groupList:
+            stack = self.instructions.scene.undoStack
+            stack.beginMacro("Merge identical Callouts")
+            for calloutList in groupList:
+                stack.push(MergeCalloutsCommand(calloutList[0], calloutList[1:], True))
+            stack.endMacro()
+        return len(groupList)
+
     def getCSIList(self):
+        modelIndex = self.getModelIndex()
+        if modelIndex:
+            return modelIndex.getCSIList(self)
+
         csiList = []
         for page in self.pages:
             for step in page.steps:
@@ -2787,7 +3310,11 @@ class Submodel(SubmodelTreeManager, AbstractPart):
         return res
 
     def submodelInstanceCount(self, submodelName):
-        count = len([p for p in self.parts if p.filename == submodelName])
+        modelIndex = self.getModelIndex()
+        if modelIndex:
+            count = len(modelIndex.getParts(self, submodelName))
+        else:
+            count = len([p for p in self.parts if p.filename == submodelName])
         for submodel in self.submodels:
             count += submodel.submodelInstanceCount(submodelName)
         return count
@@ -2796,9 +3323,12 @@ class Submodel(SubmodelTreeManager, AbstractPart):
         return self._genericIterator('submodels', len)
 
     def pageCount(self):
-        return self._genericIterator('pages', len)
+        return len(self.getPageList())
 
     def getPageList(self):
+        modelIndex = self.getModelIndex()
+        if modelIndex and modelIndex.model is self:
+            return modelIndex.getPageList()
         return self._genericIterator('pages', list)
 
     def getFullPartList(self):
@@ -2895,6 +3425,271 @@ class Submodel(SubmodelTreeManager, AbstractPart):
     def convertFromSubAssemblySignal(self):
         self.pages[0].scene().undoStack.push(SubmodelToFromSubAssembly(self, False))
 
+class BillOfMaterials(object):
+    """
+    Part counts for a whole model, keyed by (part filename, colour), with each submodel's parts multiplied by
+    the number of times it's used.  Each submodel's own counts are tallied once from its parts, then kept up to
+    date by partAdded, partRemoved & partColorChanged; totals are re-summed from those only when asked for.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.ownCounts = {}    # {submodel: {key: count}}
+        self.childCounts = {}  # {submodel: {child submodel: instance count}}
+        self.partDict = {}     # {key: (abstractPart, color)}
+        self._totals = None
+
+    @staticmethod
+    def getKey(abstractPart, color):
+        return (abstractPart.filename, (tuple(color.rgba), color.name) if color else None)
+
+    def invalidate(self, submodel = None):
+        """ Forget the counts for submodel, or for every submodel; they're re-tallied when next needed. """
+        ModelIndex.partsChanged()
+        if submodel is None:
+            self.ownCounts, self.childCounts = {}, {}
+        else:
+            self.ownCounts.pop(submodel, None)
+            self.childCounts.pop(submodel, None)
+        self._totals = None
+
+    def __tally(self, submodel):
+        self.ownCounts[submodel], self.childCounts[submodel] = {}, {}
+        for part in submodel.parts:
+            self.__count(submodel, part, part.color, 1)
+
+    def __count(self, submodel, part, color, increment):
+        if part.isSubmodel():
+            counts, key = self.childCounts[submodel], part.abstractPart
+        else:
+            counts, key = self.ownCounts[submodel], BillOfMaterials.getKey(part.abstractPart, color)
+            self.partDict.setdefault(key, (part.abstractPart, color))
+        counts[key] = counts.get(key, 0) + increment
+        if counts[key] <= 0:
+            del counts[key]
+        self._totals = None
+
+    def partAdded(self, submodel, part):
+        ModelIndex.partsChanged()
+        if submodel in self.ownCounts:
+            self.__count(submodel, part, part.color, 1)
+
+    def partRemoved(self, submodel, part):
+        ModelIndex.partsChanged()
+        if submodel in self.ownCounts:
+            self.__count(submodel, part, part.color, -1)
+
+    def partColorChanged(self, submodel, part, oldColor, newColor):
+        if submodel in self.ownCounts and not part.isSubmodel():
+            self.__count(submodel, part, oldColor, -1)
+            self.__count(submodel, part, newColor, 1)
+
+    def __getSubmodelTotals(self, submodel, memo):
+        if submodel not in memo:
+            if submodel not in self.ownCounts:
+                self.__tally(submodel)
+            totals = dict(self.ownCounts[submodel])
+            for child, instanceCount in self.childCounts[submodel].items():
+                for key, count in self.__getSubmodelTotals(child, memo).items():
+                    totals[key] = totals.get(key, 0) + (count * instanceCount)
+            memo[submodel] = totals
+        return memo[submodel]
+
+    def getTotals(self):
+        """ Returns {key: count} for every part in the model, submodels expanded. """
+        if self._totals is None:
+            self._totals = self.__getSubmodelTotals(self.model, {})
+        return self._totals
+
+    def getItemList(self):
+        """ Returns a list of (abstractPart, color, count), one for each part & colour in the model. """
+        return [self.partDict[key] + (count,) for key, count in self.getTotals().items()]
+
+    def exportToCSV(self, filename):
+        """ Write this bill of materials to filename, one line per part & colour. """
+        itemList = sorted(self.getItemList(), key = lambda i: (i[0].filename, i[1].name if i[1] else ""))
+        with open(filename, 'wb') as fh:
+            writer = csv.writer(fh)
+            writer.writerow(["Part", "Name", "Color", "LDraw Color", "Quantity"])
+            for abstractPart, color, count in itemList:
+                name = abstractPart.name if abstractPart.name != abstractPart.filename else ""
+                writer.writerow([abstractPart.filename, name, color.name if color else "", color.ldrawCode if color else "", count])
+
+class ModelIndex(object):
+    """
+    Lookup tables over a whole model: page number -> Page, step number -> Step, Page -> neighbouring Pages,
+    submodel -> Steps that use it, filename -> Parts, and every CSI in order, callouts included.  Anything that
+    adds, removes or renumbers pages, steps, callouts or parts bumps one of the edit counters below; a table is
+    rebuilt, in one pass, the next time it's read.
+    """
+
+    pageEdits = 0  # Pages or submodels added, removed or renumbered
+    stepEdits = 0  # Steps added, removed or renumbered
+    partEdits = 0  # Parts added to or removed from a submodel
+    csiEdits = 0   # Parts added to or removed from a CSI
+    calloutEdits = 0  # Callouts, or steps in callouts, added or removed
+
+    @classmethod
+    def pagesChanged(cls):
+        cls.pageEdits += 1
+
+    @classmethod
+    def stepsChanged(cls):
+        cls.stepEdits += 1
+
+    @classmethod
+    def partsChanged(cls):
+        cls.partEdits += 1
+
+    @classmethod
+    def csiChanged(cls):
+        cls.csiEdits += 1
+
+    @classmethod
+    def calloutsChanged(cls):
+        cls.calloutEdits += 1
+
+    def __init__(self, model):
+        self.model = model
+        self._tables = {}  # {table name: (edit counts when built, table)}
+
+    def __getTable(self, name, edits, build):
+        built = self._tables.get(name)
+        if built is None or built[0] != edits:
+            built = self._tables[name] = (edits, build())
+        return built[1]
+
+    def __getPageTable(self):
+        return self.__getTable('pages', ModelIndex.pageEdits, self.__buildPageTable)
+
+    def __buildPageTable(self):
+        """ Walks submodels in the same order as Submodel._genericIterator. """
+        submodelList, pageList, pageDict, neighbourDict = [], [], {}, {}
+        stack = [self.model]
+        while stack:
+            submodel = stack.pop()
+            submodelList.append(submodel)
+            stack += reversed(submodel.submodels)
+            pages = submodel.pages
+            numberDict = pageDict[submodel] = {}
+            for i, page in enumerate(pages):
+                numberDict.setdefault(page._number, page)
+                neighbourDict[page] = (pages[i - 1] if i > 0 else None, pages[i + 1] if i < len(pages) - 1 else None)
+            pageList += pages
+        return submodelList, pageList, pageDict, neighbourDict
+
+    def __getStepTable(self):
+        return self.__getTable('steps', (ModelIndex.pageEdits, ModelIndex.stepEdits), self.__buildStepTable)
+
+    def __buildStepTable(self):
+        stepDict = {}  # {submodel: {step number: Step}}
+        for submodel in self.__getPageTable()[0]:
+            numberDict = stepDict[submodel] = {}
+            for page in submodel.pages:
+                for step in page.steps:
+                    numberDict.setdefault(step._number, step)
+        return stepDict
+
+    def __getUsageTable(self):
+        edits = (ModelIndex.pageEdits, ModelIndex.stepEdits, ModelIndex.csiEdits)
+        return self.__getTable('usage', edits, self.__buildUsageTable)
+
+    def __buildUsageTable(self):
+        usageDict = {}  # {submodel: [Steps whose CSI holds an instance of it, in page order]}
+        for page in self.__getPageTable()[1]:
+            for step in page.steps:
+                for abstractPart in set(part.abstractPart for part in step.csi.getPartList() if part.isSubmodel()):
+                    usageDict.setdefault(abstractPart, []).append(step)
+        return usageDict
+
+    def __getPartTable(self):
+        return self.__getTable('parts', (ModelIndex.pageEdits, ModelIndex.partEdits), self.__buildPartTable)
+
+    def __buildPartTable(self):
+        partDict = {}  # {submodel: {filename: [Parts]}}
+        for submodel in self.__getPageTable()[0]:
+            filenameDict = partDict[submodel] = {}
+            for part in submodel.parts:
+                filenameDict.setdefault(part.filename, []).append(part)
+        return partDict
+
+    def __getCSITable(self):
+        edits = (ModelIndex.pageEdits, ModelIndex.stepEdits, ModelIndex.calloutEdits)
+        return self.__getTable('csis', edits, self.__buildCSITable)
+
+    def __buildCSITable(self):
+        csiList = []        # Every CSI, in the order Submodel.getCSIList has always returned them
+        rangeDict = {}      # {submodel: (start, end)} - slice of csiList covering submodel & its children
+        neighbourDict = {}  # {CSI: (CSI of previous step, CSI of next step)}, within one submodel or callout
+        self.__addSubmodelCSIs(self.model, csiList, rangeDict, neighbourDict)
+        return csiList, rangeDict, neighbourDict
+
+    def __addSubmodelCSIs(self, submodel, csiList, rangeDict, neighbourDict):
+        start = len(csiList)
+        stepCSIs = []
+        for page in submodel.pages:
+            for step in page.steps:
+                csiList.append(step.csi)
+                stepCSIs.append(step.csi)
+                for callout in step.callouts:
+                    calloutCSIs = [calloutStep.csi for calloutStep in callout.steps]
+                    csiList += calloutCSIs
+                    ModelIndex.__linkCSIs(calloutCSIs, neighbourDict)
+        ModelIndex.__linkCSIs(stepCSIs, neighbourDict)
+
+        for child in submodel.submodels:
+            self.__addSubmodelCSIs(child, csiList, rangeDict, neighbourDict)
+        rangeDict[submodel] = (start, len(csiList))
+
+    @staticmethod
+    def __linkCSIs(csiList, neighbourDict):
+        for i, csi in enumerate(csiList):
+            neighbourDict[csi] = (csiList[i - 1] if i > 0 else None, csiList[i + 1] if i < len(csiList) - 1 else None)
+
+    def contains(self, submodel):
+        return submodel in self.__getPageTable()[2]
+
+    def getPageList(self):
+        return list(self.__getPageTable()[1])
+
+    def getPage(self, submodel, number):
+        """ Returns the Page numbered number among submodel's own pages, or None. """
+        page = self.__getPageTable()[2][submodel].get(number)
+        if page is not None and page._number != number:  # Renumbered behind our back
+            self._tables.pop('pages')
+            page = self.__getPageTable()[2][submodel].get(number)
+        return page
+
+    def getNeighbours(self, page):
+        """ Returns (previous page, next page) within page's submodel, or None if page isn't indexed. """
+        return self.__getPageTable()[3].get(page)
+
+    def getStep(self, submodel, number):
+        """ Returns the Step numbered number on submodel's own pages, or None. """
+        step = self.__getStepTable()[submodel].get(number)
+        if step is not None and step._number != number:
+            self._tables.pop('steps')
+            step = self.__getStepTable()[submodel].get(number)
+        return step
+
+    def getUsingSteps(self, submodel):
+        """ Returns every page Step whose CSI holds an instance of submodel, in page order. """
+        return self.__getUsageTable().get(submodel, [])
+
+    def getParts(self, submodel, filename):
+        """ Returns submodel's own Parts (not its children's) with this filename. """
+        return self.__getPartTable()[submodel].get(filename, [])
+
+    def getCSIList(self, submodel):
+        """ Returns every CSI in submodel and its children, callout CSIs included. """
+        csiList, rangeDict, unused = self.__getCSITable()
+        start, end = rangeDict[submodel]
+        return csiList[start:end]
+
+    def getCSINeighbours(self, csi):
+        """ Returns (previous step's CSI, next step's CSI) for csi, or None if csi isn't indexed. """
+        return self.__getCSITable()[2].get(csi)
+
 class Mainmodel(MainModelTreeManager, Submodel):
     """ A MainModel is a Submodel plus a template, title & part list pages. It's used as the root of a tree model. """
     itemClassName = "Mainmodel"
@@ -2910,6 +3705,8 @@ class Mainmodel(MainModelTreeManager, Submodel):
         #TODO: Implement mainModel.hasPartListPages so user can show / hide part list pages, like title pages
         self.hasPartListPages = False  
         self.partListPages = []
+        self.bom = BillOfMaterials(self)
+        self.modelIndex = ModelIndex(self)
 
     def hasTitlePage(self):
         return self._hasTitlePage and self.titlePage is not None
@@ -2933,6 +3730,11 @@ class Mainmodel(MainModelTreeManager, Submodel):
         pages = [self.titlePage] if self.titlePage else []
         return pages + Submodel.getPageList(self) + self.partListPages
 
+    def catchUpNumbers(self):
+        """ Bring every page & step number label up to date, for code that reads the labels themselves, like export. """
+        for page in self.getFullPageList():
+            page.catchUpNumbers()
+
     def addPage(self, page):
         for p in self.partListPages:
             if p._row >= page._row: 
@@ -2960,11 +3762,7 @@ class Mainmodel(MainModelTreeManager, Submodel):
         p1 = self.partListPages[0]
         scene = p1.scene()
         scene.emit(SIGNAL("layoutAboutToBeChanged()"))
-        if len(self.partListPages) > 1:
-            for page in self.partListPages[1:]:
-                scene.removeItem(page)
-                del(page)
-        self.partListPages = p1.updatePartList()
+        self.partListPages = p1.updatePartList(self.partListPages)
         scene.emit(SIGNAL("layoutChanged()"))
         
     def syncPageNumbers(self, firstPageNumber = 1):
@@ -2981,6 +3779,7 @@ class Mainmodel(MainModelTreeManager, Submodel):
             else:  # have a Page
                 item.number = pageNumber
                 pageNumber += 1
+        self.pageShifts.compact()
 
         self.instructions.scene.sortPages()
         return pageNumber
@@ -3009,6 +3808,11 @@ class PartTreeItem(PartTreeItemTreeManager, QGraphicsRectItem):
             self.parts.remove(part)
             self._dataString = None
 
+    def removeParts(self, partList):
+        idSet = set(id(part) for part in partList)
+        self.parts = [part for part in self.parts if id(part) not in idSet]
+        self._dataString = None
+
     def getStep(self):
         return self.parentItem().parentItem()
 
@@ -3249,6 +4053,32 @@ class Part(PartTreeManager, QGraphicsRectItem):
         for arrow in self.arrows:
             arrow.callGLDisplayList(useDisplacement)
 
+    def getSizingPoints(self, isCurrent = False):
+        """
+        Every point callGLDisplayList draws, as an (n, 3) numpy array in CSI coordinates.
+        isCurrent matches useDisplacement: include displacement, arrows & highlight box.
+        """
+        points = self.abstractPart.getEdgeArray().reshape(-1, 3)
+        if isCurrent and (self.isSelected() or CSI.highlightNewParts):
+            points = LicGLHelpers.numpy.concatenate([points, self._getBoundingBoxPoints()])
+
+        pointList = [LicGLHelpers.transformEdges(points, self._getSizingMatrix(isCurrent))]
+        if isCurrent:
+            pointList += [arrow.getSizingPoints(True) for arrow in self.arrows]
+        return LicGLHelpers.numpy.concatenate(pointList)
+
+    def _getSizingMatrix(self, isCurrent):
+        matrix = list(self.matrix)
+        if isCurrent and self.displacement:
+            matrix[12] += self.displacement[0]
+            matrix[13] += self.displacement[1]
+            matrix[14] += self.displacement[2]
+        return matrix
+
+    def _getBoundingBoxPoints(self):
+        box = self.abstractPart.getBoundingBox()
+        return LicGLHelpers.createEdgeArray(list(box.vertices()) if box else []).reshape(-1, 3)
+
     def drawGLBoundingBox(self):
         b = self.abstractPart.getBoundingBox()
         GL.glBegin(GL.GL_LINE_LOOP)
@@ -3492,6 +4322,9 @@ class Part(PartTreeManager, QGraphicsRectItem):
         dialog.exec_()
 
     def changeColor(self, newColor):
+        if not self.originalPart:  # Callout copies aren't in the bill of materials
+            page = self.getPage()
+            page.instructions.mainModel.bom.partColorChanged(page.submodel, self, self.color, newColor)
         self.color = newColor
         self.getCSI().isDirty = True
         self.getCSI().nextCSIIsDirty = True
@@ -3507,12 +4340,18 @@ class Part(PartTreeManager, QGraphicsRectItem):
     def changeAbstractPart(self, filename):
 
         step = self.getStep()
+        page = step.getPage()
+        bom = page.instructions.mainModel.bom
 
         self.setParentItem(None) # Temporarily set part's parent, so it doesn't get deleted by Qt
         step.removePart(self)
+        if not self.originalPart:
+            bom.partRemoved(page.submodel, self)
 
         self.filename = filename
-        self.initializeAbstractPart(step.getPage().instructions)
+        self.initializeAbstractPart(page.instructions)
+        if not self.originalPart:
+            bom.partAdded(page.submodel, self)
 
         if self.abstractPart.glDispID == LicGLHelpers.UNINIT_GL_DISPID:
             glContext = step.getPage().instructions.glContext
@@ -3638,31 +4477,44 @@ class Arrow(Part):
         self.matrix[13] = y
         self.matrix[14] = z
         
-    def doGLRotation(self):
+    def getGLRotations(self):
+        """ The glRotatef (angle, x, y, z) calls that point this arrow along its displacement direction, in call order. """
         
         d = self.displaceDirection
         if d == Qt.Key_PageUp:  # Up
-            GL.glRotatef(-90, 0.0, 0.0, 1.0)
-            GL.glRotatef(45, 1.0, 0.0, 0.0)
+            rotations = [(-90, 0.0, 0.0, 1.0), (45, 1.0, 0.0, 0.0)]
         elif d == Qt.Key_PageDown:  # Down
-            GL.glRotatef(90, 0.0, 0.0, 1.0)
-            GL.glRotatef(-45, 1.0, 0.0, 0.0)
+            rotations = [(90, 0.0, 0.0, 1.0), (-45, 1.0, 0.0, 0.0)]
 
         elif d == Qt.Key_Left:  # Left
-            GL.glRotatef(90, 0.0, 1.0, 0.0)
-            GL.glRotatef(225, 1.0, 0.0, 0.0)
+            rotations = [(90, 0.0, 1.0, 0.0), (225, 1.0, 0.0, 0.0)]
         elif d == Qt.Key_Right:  # Right
-            GL.glRotatef(-90, 0.0, 1.0, 0.0)
-            GL.glRotatef(-45, 1.0, 0.0, 0.0)
+            rotations = [(-90, 0.0, 1.0, 0.0), (-45, 1.0, 0.0, 0.0)]
 
         elif d == Qt.Key_Up:  # Back
-            GL.glRotatef(180, 0.0, 0.0, 1.0)
-            GL.glRotatef(45, 1.0, 0.0, 0.0)
+            rotations = [(180, 0.0, 0.0, 1.0), (45, 1.0, 0.0, 0.0)]
         elif d == Qt.Key_Down:  # Forward
-            GL.glRotatef(-45, 1.0, 0.0, 0.0)
+            rotations = [(-45, 1.0, 0.0, 0.0)]
+        else:
+            rotations = []
 
         if self.axisRotation:
-            GL.glRotatef(self.axisRotation, 1.0, 0.0, 0.0)
+            rotations.append((self.axisRotation, 1.0, 0.0, 0.0))
+        return rotations
+
+    def doGLRotation(self):
+        for rotation in self.getGLRotations():
+            GL.glRotatef(*rotation)
+
+    def getSizingPoints(self, isCurrent = False):
+        if not isCurrent:
+            return LicGLHelpers.createEdgeArray([]).reshape(-1, 3)  # Arrows only show up in their own step
+
+        points = self.abstractPart.getEdgeArray().reshape(-1, 3)
+        if self.isSelected():
+            points = LicGLHelpers.numpy.concatenate([points, self._getBoundingBoxPoints()])
+        points = LicGLHelpers.rotateEdges(points, self.getGLRotations())
+        return LicGLHelpers.transformEdges(points, self._getSizingMatrix(True))
 
     def callGLDisplayList(self, useDisplacement = False):
         if not useDisplacement:
@@ -3806,6 +4658,14 @@ class Primitive(object):
     def resetBoundingBox(self):
         self._boundingBox = None
 
+    def getEdges(self):
+        """ This primitive's drawn outline as a list of ((x, y, z), (x, y, z)) edges.  Conditional lines are never drawn. """
+        p = self.points
+        if self.type == GL.GL_LINES:
+            return [] if len(p) > 6 else [(p[0:3], p[3:6])]
+        corners = [p[0:3], p[3:6], p[6:9]] + ([p[9:12]] if self.type == GL.GL_QUADS else [])
+        return [(corners[i - 1], corners[i]) for i in range(len(corners))]
+
     def addNormal(self, p1, p2, p3):
         Bx = p2[0] - p1[0]
         By = p2[1] - p1[1]
@@ -261,15 +261,13 @@ class TemplatePage(TemplateRectItem, Page):
     def initGLDimension(self, part, glContext):
 
         glContext.makeCurrent()
-        for size in [512, 1024, 2048]:
-            # Create a new buffer tied to the existing GLWidget, to get access to its display lists
-            pBuffer = QGLPixelBuffer(size, size, LicGLHelpers.getGLFormat(), glContext)
-            pBuffer.makeCurrent()
-
-            # Render CSI and calculate its size
-            if part.initSize(size, pBuffer):
+        for size in LicGLHelpers.sizeLadder(part.predictSize()):
+            # Render CSI into a pooled buffer of the GLWidget's own context and calculate its size
+            target = LicGLHelpers.beginOffscreenSizing(size)
+            result = part.initSize(size, target)
+            LicGLHelpers.endOffscreenSizing(target)
+            if result:
                 break
-        glContext.makeCurrent()
 
     def applyFullTemplate(self, useUndo):
         
@@ -357,6 +355,8 @@ class TemplatePage(TemplateRectItem, Page):
         
         if useUndo:
             stack.endMacro()
+        else:
+            LayoutScheduler.flush()  # No undo stack to flush the layouts these commands asked for
 
     def getStepByNumber(self, number):
         return self.steps[0] if number == 0 else None
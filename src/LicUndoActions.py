@@ -14,6 +14,8 @@
     along with this program.  If not, see http://creativecommons.org/licenses/by-sa/3.0/
 """
 
+import collections
+
 from PyQt4.QtCore import SIGNAL, QSizeF , QPointF ,Qt
 from PyQt4.QtGui import QUndoCommand, QPixmap
 
@@ -78,7 +80,7 @@ class MoveCommand(QUndoCommand):
             if hasattr(item, "resetArrow"):
                 item.resetArrow()
             if hasattr(item.parentItem(), "resetRect"):
-                item.parentItem().resetRect()
+                LicLayout.LayoutScheduler.schedule(item.parentItem(), 'resetRect')
 
 class ResizeCommand(QUndoCommand):
 
@@ -165,14 +167,14 @@ class SetDefaultDiameterCommand(QUndoCommand):
         self.circle.setDiameter(diameter)
         self.circle.update()
         if self.doLayout:
-            template.initLayout()
+            LicLayout.LayoutScheduler.schedule(template)
         for page in template.instructions.getPageList():
             for child in page.getAllChildItems():
                 if self.circle.itemClassName == child.itemClassName:
                     child.setDiameter(diameter)
                     child.update()
                     if self.doLayout:
-                        child.getPage().initLayout()
+                        LicLayout.LayoutScheduler.schedule(child.getPage())
 
 class DisplacePartCommand(QUndoCommand):
 
@@ -184,7 +186,7 @@ class DisplacePartCommand(QUndoCommand):
 
     def doAction(self, redo):
         self.part.displacement = list(self.newDisp if redo else self.oldDisp)
-        self.part.getCSI().resetPixmap()
+        LicLayout.LayoutScheduler.schedule(self.part.getCSI(), 'resetPixmap')
 
 class BeginEndDisplacementCommand(QUndoCommand):
     
@@ -267,8 +269,8 @@ class MoveStepToPageCommand(QUndoCommand):
                 model = newPage.instructions.mainModel 
                 model.reOrderSubmodelPages()
                 model.syncPageNumbers()
-            newPage.initLayout()
-            oldPage.initLayout()
+            LicLayout.LayoutScheduler.schedule(newPage)
+            LicLayout.LayoutScheduler.schedule(oldPage)
         self.stepSet[0][0].scene().emit(SIGNAL("layoutChanged()"))
 
 class SwapStepsCommand(QUndoCommand):
@@ -304,9 +306,8 @@ class SwapStepsCommand(QUndoCommand):
             model.reOrderSubmodelPages()
             model.syncPageNumbers()
 
-        p1.initLayout()
-        if p1 != p2:
-            p2.initLayout()
+        LicLayout.LayoutScheduler.schedule(p1)
+        LicLayout.LayoutScheduler.schedule(p2)
         p1.scene().emit(SIGNAL("layoutChanged()"))
 
 class AddRemovePartCommand(QUndoCommand):
@@ -325,13 +326,16 @@ class AddRemovePartCommand(QUndoCommand):
         step.scene().clearSelection()
         step.scene().emit(SIGNAL("layoutAboutToBeChanged()"))
 
+        bom = page.instructions.mainModel.bom
         if (redo and self.addPart) or (not redo and not self.addPart):
             step.addPart(self.part)
             submodel.parts.append(self.part)
+            bom.partAdded(submodel, self.part)
         else:
             self.part.setParentItem(None)
             step.removePart(self.part)
             submodel.parts.remove(self.part)
+            bom.partRemoved(submodel, self.part)
 
         step.scene().emit(SIGNAL("layoutChanged()"))
 
@@ -339,7 +343,7 @@ class AddRemovePartCommand(QUndoCommand):
         page.updateSubmodel()
 
         step.csi.isDirty = True
-        page.initLayout()
+        LicLayout.LayoutScheduler.schedule(page)
 
 class AddRemoveArrowCommand(QUndoCommand):
 
@@ -432,7 +436,7 @@ class AddRemoveStepCommand(QUndoCommand):
             parent.insertStep(self.step)
             parent.scene().emit(SIGNAL("layoutChanged()"))
             self.step.setSelected(True)
-            parent.initLayout()
+            LicLayout.LayoutScheduler.schedule(parent)
         else:
             self.step.setSelected(False)
             parent.scene().emit(SIGNAL("layoutAboutToBeChanged()"))
@@ -461,7 +465,7 @@ class AddRemoveCalloutCommand(QUndoCommand):
             parent.scene().emit(SIGNAL("layoutAboutToBeChanged()"))
             parent.removeCallout(self.callout)
             parent.scene().emit(SIGNAL("layoutChanged()"))
-        parent.initLayout()
+        LicLayout.LayoutScheduler.schedule(parent)
 
 class AddRemovePageCommand(QUndoCommand):
 
@@ -595,7 +599,7 @@ class AddRemovePartToPLICommand(QUndoCommand):
                 step.disablePLI()
             part.isInPLI = False
 
-        step.initLayout()
+        LicLayout.LayoutScheduler.schedule(step)
         part.scene().emit(SIGNAL("layoutChanged()"))
 
 class MovePartsToStepCommand(QUndoCommand):
@@ -614,6 +618,7 @@ class MovePartsToStepCommand(QUndoCommand):
 
         redoSubmodelOrder = False
         stepsToReset = set([step.number])
+        moveDict = collections.OrderedDict()  # {(startStep, endStep): [parts]}, so each step is updated once
         
         for part, oldStep in self.partListStepPairs:
             if part.filename == 'arrow':
@@ -622,13 +627,16 @@ class MovePartsToStepCommand(QUndoCommand):
             endStep = step if redo else oldStep
             
             part.setParentItem(None) # Temporarily set part's parent, so it doesn't get deleted by Qt
-            startStep.removePart(part)
-            endStep.addPart(part)
+            moveDict.setdefault((startStep, endStep), []).append(part)
                 
             if part.isSubmodel():
                 redoSubmodelOrder = True
             stepsToReset.add(oldStep.number)
 
+        for (startStep, endStep), partList in moveDict.items():
+            startStep.removeParts(partList)
+            endStep.addParts(partList)
+
         if redoSubmodelOrder:
             mainModel = step.getPage().instructions.mainModel
             mainModel.reOrderSubmodelPages()
@@ -642,6 +650,61 @@ class MovePartsToStepCommand(QUndoCommand):
         else:
             step.getPage().submodel.resetStepSet(min(stepsToReset), max(stepsToReset))
 
+class SplitStepCommand(QUndoCommand):
+
+    """
+    Moves chunks of one Step's parts onto new Steps, each on its own new Page, in one go:
+    stepPartLists[0] = (newStep, partList)
+    Every page is added and every part moved before any CSI is reset, so the reset runs once.
+    """
+
+    _id = getNewCommandID()
+
+    def __init__(self, step, stepPartLists):
+        QUndoCommand.__init__(self, "split Step")
+        self.step, self.stepPartLists = step, stepPartLists
+        self.pages = [newStep.parentItem() for newStep, partList in stepPartLists]
+        self.submodel = step.getPage().submodel
+
+    def doAction(self, redo):
+        step = self.step
+        scene = step.scene()
+        scene.clearSelection()
+        scene.emit(SIGNAL("layoutAboutToBeChanged()"))
+
+        redoSubmodelOrder = False
+        if redo:
+            for newPage, (newStep, partList) in zip(self.pages, self.stepPartLists):
+                self.submodel.addPage(newPage)
+                newPage.insertStep(newStep)
+                for part in partList:
+                    part.setParentItem(None)  # Temporarily set part's parent, so it doesn't get deleted by Qt
+                    redoSubmodelOrder = redoSubmodelOrder or part.isSubmodel()
+                step.removeParts(partList)
+                newStep.addParts(partList)
+        else:
+            for newPage, (newStep, partList) in reversed(zip(self.pages, self.stepPartLists)):
+                for part in partList:
+                    part.setParentItem(None)
+                    redoSubmodelOrder = redoSubmodelOrder or part.isSubmodel()
+                newStep.removeParts(partList)
+                step.addParts(partList)
+                newPage.removeStep(newStep)
+                self.submodel.deletePage(newPage)
+
+        if redoSubmodelOrder:
+            mainModel = step.getPage().instructions.mainModel
+            mainModel.reOrderSubmodelPages()
+            mainModel.syncPageNumbers()
+
+        scene.emit(SIGNAL("layoutChanged()"))
+
+        lastStep = self.stepPartLists[-1][0]
+        self.submodel.resetStepSet(step.number, lastStep.number if redo else step.number)
+        for page in [step.getPage()] + (self.pages if redo else []):
+            LicLayout.LayoutScheduler.schedule(page)
+        scene.selectPage(step.getPage().number)
+
 class AddPartsToCalloutCommand(QUndoCommand):
 
     _id = getNewCommandID()
@@ -660,8 +723,8 @@ class AddPartsToCalloutCommand(QUndoCommand):
                 self.callout.removePart(part)
 
         self.callout.scene().emit(SIGNAL("layoutChanged()"))
-        self.callout.steps[-1].csi.resetPixmap()
-        self.callout.initLayout()
+        LicLayout.LayoutScheduler.schedule(self.callout.steps[-1].csi, 'resetPixmap')
+        LicLayout.LayoutScheduler.schedule(self.callout)
 
 class RemovePartsFromCalloutCommand(QUndoCommand):
 
@@ -683,8 +746,8 @@ class RemovePartsFromCalloutCommand(QUndoCommand):
 
         self.callout.scene().emit(SIGNAL("layoutChanged()"))
         for step in self.callout.steps:
-            step.csi.resetPixmap()
-        self.callout.initLayout()
+            LicLayout.LayoutScheduler.schedule(step.csi, 'resetPixmap')
+        LicLayout.LayoutScheduler.schedule(self.callout)
 
 class MergeCalloutsCommand(QUndoCommand):
 
@@ -714,7 +777,7 @@ class MergeCalloutsCommand(QUndoCommand):
                 callout.setMergedCallouts(list(mergeList))
             self.mainCallout.setMergedCallouts(list(self.originalMergedCallouts))
 
-        parent.initLayout()
+        LicLayout.LayoutScheduler.schedule(parent)
         parent.scene().emit(SIGNAL("layoutChanged()"))
 
 class SwitchToNextCalloutBase(QUndoCommand):
@@ -742,7 +805,7 @@ class SwitchToNextCalloutBase(QUndoCommand):
         parent.removeCallout(self.callout)
         self.callout.mergedCallouts = []
         self.callout = newCallout
-        parent.initLayout()
+        LicLayout.LayoutScheduler.schedule(parent)
         parent.scene().emit(SIGNAL("layoutChanged()"))
 
 class ChangeAnnotationPixmap(QUndoCommand):
@@ -785,7 +848,7 @@ class ToggleStepNumbersCommand(QUndoCommand):
         else:
             self.callout.disableStepNumbers()
         self.callout.scene().emit(SIGNAL("layoutChanged()"))
-        self.callout.initLayout()
+        LicLayout.LayoutScheduler.schedule(self.callout)
 
 class ToggleCalloutQtyCommand(QUndoCommand):
 
@@ -802,7 +865,7 @@ class ToggleCalloutQtyCommand(QUndoCommand):
         else:
             self.callout.removeQuantityLabel()
         self.callout.scene().emit(SIGNAL("layoutChanged()"))
-        self.callout.initLayout()
+        LicLayout.LayoutScheduler.schedule(self.callout)
 
 class AdjustArrowLength(QUndoCommand):
 
@@ -815,7 +878,7 @@ class AdjustArrowLength(QUndoCommand):
     def doAction(self, redo):
         length = self.newLength if redo else self.oldLength
         self.arrow.setLength(length)
-        self.arrow.getCSI().resetPixmap()
+        LicLayout.LayoutScheduler.schedule(self.arrow.getCSI(), 'resetPixmap')
 
 class AdjustArrowRotation(QUndoCommand):
 
@@ -827,7 +890,7 @@ class AdjustArrowRotation(QUndoCommand):
 
     def doAction(self, redo):
         self.arrow.axisRotation = self.newRotation if redo else self.oldRotation
-        self.arrow.getCSI().resetPixmap()
+        LicLayout.LayoutScheduler.schedule(self.arrow.getCSI(), 'resetPixmap')
 
 class SetFontCommand(QUndoCommand):
 
@@ -854,8 +917,8 @@ class ScaleItemCommand(QUndoCommand):
 
     def doAction(self, redo):
         self.target.scaling = self.oldScale if redo else self.newScale
-        self.target.resetPixmap() 
-        self.target.getPage().initLayout()
+        LicLayout.LayoutScheduler.schedule(self.target, 'resetPixmap')
+        LicLayout.LayoutScheduler.schedule(self.target.getPage())
 
 class RotateItemCommand(QUndoCommand):
 
@@ -869,8 +932,8 @@ class RotateItemCommand(QUndoCommand):
         
     def doAction(self, redo):
         self.target.rotation = list(self.oldRotation) if redo else list(self.newRotation)
-        self.target.resetPixmap() 
-        self.target.getPage().initLayout()
+        LicLayout.LayoutScheduler.schedule(self.target, 'resetPixmap')
+        LicLayout.LayoutScheduler.schedule(self.target.getPage())
 
 class ScaleDefaultItemCommand(QUndoCommand):
 
@@ -1044,7 +1107,7 @@ class TogglePLIs(QUndoCommand):
             self.template.steps[0].disablePLI()
             self.template.instructions.mainModel.showHidePLIs(False, True)
         self.template.scene().emit(SIGNAL("layoutChanged()"))
-        self.template.initLayout()
+        LicLayout.LayoutScheduler.schedule(self.template)
 
 class ToggleCSIPartHighlightCommand(QUndoCommand):
 
@@ -1103,7 +1166,7 @@ class ChangeAbstractPartCommand(QUndoCommand):
 
         scene.emit(SIGNAL("layoutChanged()"))
 
-        page.initLayout()
+        LicLayout.LayoutScheduler.schedule(page)
         scene.update()
 
 class ChangePartPosRotCommand(QUndoCommand):
@@ -1178,9 +1241,9 @@ class SubmodelToCalloutCommand(QUndoCommand):
             self.targetCallout.setQuantity(len(self.submodelInstanceList))
             
         for step in self.targetCallout.steps:
-            step.csi.resetPixmap()
-        self.targetStep.initLayout()
-        self.targetCallout.initLayout()
+            LicLayout.LayoutScheduler.schedule(step.csi, 'resetPixmap')
+        LicLayout.LayoutScheduler.schedule(self.targetStep)
+        LicLayout.LayoutScheduler.schedule(self.targetCallout)
                     
         self.parentModel.removeSubmodel(self.submodel)
         scene.emit(SIGNAL("layoutChanged()"))
@@ -1207,7 +1270,7 @@ class SubmodelToCalloutCommand(QUndoCommand):
         self.parentModel.addSubmodel(self.submodel)
         
         self.targetStep.removeCallout(self.targetCallout)
-        self.targetStep.initLayout()
+        LicLayout.LayoutScheduler.schedule(self.targetStep)
         scene.emit(SIGNAL("layoutChanged()"))
 
         scene.selectPage(self.submodel.pages[0].number)
@@ -1238,6 +1301,7 @@ class CalloutToSubmodelCommand(SubmodelToCalloutCommand):
             submodel.parts.append(part)
             submodel.pages[0].steps[0].addPart(part)
             self.targetStep.removePart(part)
+        callout.getPage().instructions.mainModel.bom.invalidate()
 
         submodel.addInitialPagesAndSteps()
         submodel.mergeInitialPages()
@@ -1252,7 +1316,7 @@ class CalloutToSubmodelCommand(SubmodelToCalloutCommand):
         self.parentModel.addSubmodel(submodel)
 
         self.targetStep.removeCallout(callout)
-        self.targetStep.initLayout()
+        LicLayout.LayoutScheduler.schedule(self.targetStep)
         self.submodel = submodel
 
         scene.emit(SIGNAL("layoutChanged()"))
@@ -1268,12 +1332,13 @@ class CalloutToSubmodelCommand(SubmodelToCalloutCommand):
 
         self.targetStep.removePart(self.newPart)
         self.parentModel.removeSubmodel(self.submodel)
+        self.parentModel.instructions.mainModel.bom.invalidate()
         for part in self.submodel.parts:
             self.targetStep.addPart(part)
 
         self.targetStep.addCallout(self.callout)
-        self.targetStep.initLayout()
-        self.callout.initLayout()
+        LicLayout.LayoutScheduler.schedule(self.targetStep)
+        LicLayout.LayoutScheduler.schedule(self.callout)
 
         scene.emit(SIGNAL("layoutChanged()"))
         scene.selectPage(self.targetStep.parentItem().number)
@@ -1373,7 +1438,7 @@ class ClonePageStepsFromSubmodel(QUndoCommand):
         for page in dest.pages:
             for step in page.steps:
                 step.csi.isDirty = True
-            page.initLayout()
+            LicLayout.LayoutScheduler.schedule(page)
 
         dest.instructions.mainModel.syncPageNumbers()
         scene.emit(SIGNAL("layoutChanged()"))
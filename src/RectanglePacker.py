@@ -24,7 +24,7 @@ class Point(object):
  
     def __cmp__(self, other):
         """Compares the starting position of height slices"""
-        return self.x - other.x
+        return cmp(self.x, other.x)
  
 class RectanglePacker(object):
     """Base class for rectangle packing algorithms
@@ -137,19 +137,26 @@ class CygonRectanglePacker(RectanglePacker):
         # of the location for the placement of the rectangle.
         leftSliceIndex = 0
  
+        # The slice table doesn't change during the search
+        heightSlices = self.heightSlices
+        sliceCount = len(heightSlices)
+
         # Determine the slice in which the right end of the rectangle is located
-        rightSliceIndex = bisect_left(self.heightSlices, Point(rectangleWidth, 0))
+        rightSliceIndex = self.findSlice(rectangleWidth)
         if rightSliceIndex < 0:
             rightSliceIndex = ~rightSliceIndex
  
-        while rightSliceIndex <= len(self.heightSlices):
+        while rightSliceIndex <= sliceCount:
             # Determine the highest slice within the slices covered by the
             # rectangle at its current placement. We cannot put the rectangle
             # any lower than this without overlapping the other rectangles.
-            highest = self.heightSlices[leftSliceIndex].y
+            # Stop looking once it's no better than the best placement so far.
+            highest = heightSlices[leftSliceIndex].y
             for index in xrange(leftSliceIndex + 1, rightSliceIndex):
-                if self.heightSlices[index].y > highest:
-                    highest = self.heightSlices[index].y
+                if highest >= bestScore:
+                    break
+                if heightSlices[index].y > highest:
+                    highest = heightSlices[index].y
  
             # Only process this position if it doesn't leave the packing area
             if highest + rectangleHeight < self.packingAreaHeight:
@@ -162,17 +169,17 @@ class CygonRectanglePacker(RectanglePacker):
  
             # Advance the starting slice to the next slice start
             leftSliceIndex += 1
-            if leftSliceIndex >= len(self.heightSlices):
+            if leftSliceIndex >= sliceCount:
                 break
  
             # Advance the ending slice until we're on the proper slice again,
             # given the new starting position of the rectangle.
-            rightRectangleEnd = self.heightSlices[leftSliceIndex].x + rectangleWidth
-            while rightSliceIndex <= len(self.heightSlices):
-                if rightSliceIndex == len(self.heightSlices):
+            rightRectangleEnd = heightSlices[leftSliceIndex].x + rectangleWidth
+            while rightSliceIndex <= sliceCount:
+                if rightSliceIndex == sliceCount:
                     rightSliceStart = self.packingAreaWidth
                 else:
-                    rightSliceStart = self.heightSlices[rightSliceIndex].x
+                    rightSliceStart = heightSlices[rightSliceIndex].x
  
                 # Is this the slice we're looking for?
                 if rightSliceStart > rightRectangleEnd:
@@ -182,7 +189,7 @@ class CygonRectanglePacker(RectanglePacker):
  
             # If we crossed the end of the slice array, the rectangle's right
             # end has left the packing area, and thus, our search ends.
-            if rightSliceIndex > len(self.heightSlices):
+            if rightSliceIndex > sliceCount:
                 break
  
         # Return the best placement we found for this rectangle. If the
@@ -194,6 +201,17 @@ class CygonRectanglePacker(RectanglePacker):
         else:
             return Point(self.heightSlices[bestSliceIndex].x, bestSliceY)
  
+    def findSlice(self, x, lo = 0):
+        """Binary search for the height slice starting at x
+        x: Horizontal position to look for
+        lo: Index of the first slice to search
+        Returns the slice's index on a direct hit, otherwise the bitwise
+        complement of the index at which a slice starting at x would go"""
+        index = bisect_left(self.heightSlices, Point(x, 0), lo)
+        if index < len(self.heightSlices) and self.heightSlices[index].x == x:
+            return index
+        return ~index
+
     def integrateRectangle(self, left, width, bottom):
         """Integrates a new rectangle into the height slice table
  
@@ -201,7 +219,7 @@ class CygonRectanglePacker(RectanglePacker):
         width: Width of the rectangle
         bottom: Position of the rectangle's lower side"""
         # Find the first slice that is touched by the rectangle
-        startSlice = bisect_left(self.heightSlices, Point(left, 0))
+        startSlice = self.findSlice(left)
  
         # Did we score a direct hit on an existing slice start?
         if startSlice >= 0:
@@ -228,14 +246,13 @@ class CygonRectanglePacker(RectanglePacker):
             if right < self.packingAreaWidth:
                 self.heightSlices.append(Point(right, firstSliceOriginalHeight))
         else: # The rectangle doesn't start on the last slice
-            endSlice = bisect_left(self.heightSlices, Point(right,0), \
-            startSlice, len(self.heightSlices))
+            endSlice = self.findSlice(right, startSlice)
  
             # Another direct hit on the final slice's end?
             if endSlice > 0:
                 del self.heightSlices[startSlice:endSlice]
             else: # No direct hit, rectangle ends inside another slice
-                # Make index from negative bisect_left() result
+                # Make index from negative findSlice() result
                 endSlice = ~endSlice
  
                 # Find out to which height we need to return at the right end of
@@ -0,0 +1,76 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (pagebreakbench.py) is part of LIC.
+
+    LIC is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the Creative Commons License
+    along with this program.  If not, see http://creativecommons.org/licenses/by-sa/3.0/
+"""
+
+# Times greedyPageBreaks and optimalPageBreaks and compares their page counts & badness, on a book of
+# random steps laid out on a real GridLayout.  greedyPageBreaks only models the old fill-until-overlap
+# merge on the same fit test; it is not the old merge, which laid out real pages and checked them with
+# checkForLayoutOverlaps.  So this measures the solvers against each other, not Lic's page breaks before & after.
+# Needs PyQt4, since the fit test runs through GridLayout.getGridRects on QRectFs.
+# Usage: python pagebreakbench.py [step count] [random seed]
+
+import random
+import sys
+import time
+
+from PyQt4.QtCore import *
+
+import LicQtWrapper  # for QRectF.getOrientedSize
+from LicLayout import *
+
+PageRect = QRectF(0, 0, 800, 600)
+InsetRect = PageRect.adjusted(PageDefaultMargin, PageDefaultMargin, -PageDefaultMargin, -PageDefaultMargin)
+
+def randomBook(stepCount, seed):
+    """ Returns a list of (width, height) step sizes, and the set of steps that must start a page """
+    rnd = random.Random(seed)
+    steps = [(rnd.uniform(120, 420), rnd.uniform(100, 320)) for unused in range(stepCount)]
+    submodelSteps = set(rnd.sample(range(1, stepCount), stepCount // 40))
+    return steps, submodelSteps
+
+def run(stepCount = 1000, seed = 0):
+
+    steps, submodelSteps = randomBook(stepCount, seed)
+    layout = GridLayout()
+
+    def fits(i, j):
+        if j - i == 1:
+            return Vertical
+        for orientation in [Horizontal, Vertical]:
+            layout.orientation = orientation
+            destRects = []
+            for rowRects, unused in layout.getGridRects(InsetRect, [None] * (j - i)):
+                destRects += rowRects
+            if all(w <= r.width() and h <= r.height() for (w, h), r in zip(steps[i:j], destRects)):
+                return orientation
+        return None
+
+    def startsPage(i):
+        return i in submodelSteps
+
+    def badness(i, j, orientation):
+        used = sum(w * h for w, h in steps[i:j]) / (InsetRect.width() * InsetRect.height())
+        return max(0.0, 1.0 - used) ** 2
+
+    for solver in [greedyPageBreaks, optimalPageBreaks]:
+        start = time.time()
+        pages = solver(stepCount, fits, startsPage, badness)
+        elapsed = time.time() - start
+        total = sum(badness(i, j, o) for i, j, o in pages)
+        print "%-18s %5d pages   badness %8.2f   %6.3fs" % (solver.__name__, len(pages), total, elapsed)
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    run(*args)
@@ -0,0 +1,167 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (tests/test_imagebounds.py) is part of LIC.
+
+    LIC is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the Creative Commons License
+    along with this program.  If not, see http://creativecommons.org/licenses/by-sa/3.0/
+"""
+
+# Checks that the numpy image bounds & insets (_getArrayBounds, _getMaskBounds, _getAtlasBounds)
+# match the PIL path (_getImageBounds, _getLeftInset, _getBottomInset) exactly, on synthetic
+# RGBA buffers and on Lic's own images flattened onto white like a render.
+# Usage, from src: python -m unittest discover -s tests
+
+import ctypes
+import glob
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import LicGLHelpers
+import numpy
+
+Image = LicGLHelpers.Image
+imageDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'images')
+
+def blank(size):
+    """ An all white, opaque (size, size, 4) buffer, like a freshly cleared sizing buffer. """
+    return numpy.ones((size, size, 4), numpy.uint8) * 255
+
+def drawRect(pixels, left, top, right, bottom, color = (0, 0, 0)):
+    pixels[top:bottom, left:right, :3] = color
+    return pixels
+
+def pilBounds(pixels):
+    size = pixels.shape[0]
+    img = Image.fromstring("RGBA", (size, size), pixels.tostring())
+    return LicGLHelpers._getImageBounds(img, size)
+
+def fixtureBuffers(size):
+    """ Every PNG in images, flattened onto white and cropped or padded into a size x size RGBA buffer. """
+    for filename in sorted(glob.glob(os.path.join(imageDir, '*.png'))):
+        img = Image.open(filename).convert("RGBA")
+        canvas = Image.new("RGBA", (size, size), (255, 255, 255, 255))
+        canvas.paste(img, (0, 0), img)
+        yield os.path.basename(filename), numpy.array(canvas, numpy.uint8)
+
+class ImageBoundsTestCase(unittest.TestCase):
+
+    size = 64
+
+    def assertSameBounds(self, pixels, msg = None):
+        self.assertEqual(LicGLHelpers._getArrayBounds(pixels), pilBounds(pixels), msg)
+
+    def testEmpty(self):
+        pixels = blank(self.size)
+        self.assertEqual(LicGLHelpers._getArrayBounds(pixels), (0, 0, 0, 0, 0, 0))
+        self.assertSameBounds(pixels)
+
+    def testFull(self):
+        pixels = drawRect(blank(self.size), 0, 0, self.size, self.size)
+        self.assertEqual(LicGLHelpers._getArrayBounds(pixels), (0, 0, self.size, self.size, 0, 0))
+        self.assertSameBounds(pixels)
+
+    def testSinglePixel(self):
+        for x, y in [(0, 0), (self.size - 1, 0), (0, self.size - 1), (self.size - 1, self.size - 1), (17, 40)]:
+            self.assertSameBounds(drawRect(blank(self.size), x, y, x + 1, y + 1), (x, y))
+
+    def testEdgeTouching(self):
+        s = self.size
+        for rect in [(0, 10, 5, 20), (50, 0, 60, 3), (s - 4, 30, s, 40), (20, s - 1, 30, s), (0, 0, s, 1), (0, 0, 1, s)]:
+            self.assertSameBounds(drawRect(blank(s), *rect), rect)
+
+    def testInsets(self):
+        # An L shape: the bottom left corner inset is what PLIItem quantity labels are placed by
+        pixels = drawRect(blank(self.size), 30, 10, 50, 20)
+        drawRect(pixels, 10, 20, 20, 50)
+        bounds = LicGLHelpers._getArrayBounds(pixels)
+        self.assertEqual(bounds, (10, 10, 50, 50, 20, 10))
+        self.assertSameBounds(pixels)
+
+    def testColors(self):
+        # Anything but pure white counts as drawn, even a single off-white channel
+        for color in [(0, 0, 0), (254, 255, 255), (255, 254, 255), (255, 255, 254), (128, 64, 200)]:
+            self.assertSameBounds(drawRect(blank(self.size), 5, 6, 7, 8, color), color)
+
+    def testRandom(self):
+        rnd = random.Random(0)
+        for unused in range(200):
+            pixels = blank(self.size)
+            for unused in range(rnd.randint(0, 4)):
+                x, y = rnd.randrange(self.size), rnd.randrange(self.size)
+                drawRect(pixels, x, y, x + rnd.randint(1, 8), y + rnd.randint(1, 8))
+            self.assertSameBounds(pixels)
+
+    def testFixtures(self):
+        for size in [64, 256]:
+            for name, pixels in fixtureBuffers(size):
+                self.assertSameBounds(pixels, name)
+
+    def testPixelArray(self):
+        pixels = drawRect(blank(self.size), 3, 4, 9, 12)
+        data = pixels.tostring()
+        expected = pilBounds(pixels)
+        self.assertEqual(LicGLHelpers._getArrayBounds(LicGLHelpers._pixelArray(data, self.size, self.size)), expected)
+        buf = (ctypes.c_ubyte * len(data)).from_buffer_copy(data)
+        self.assertEqual(LicGLHelpers._getArrayBounds(LicGLHelpers._pixelArray(buf, self.size, self.size)), expected)
+
+class AtlasBoundsTestCase(unittest.TestCase):
+
+    tileSize = 128
+
+    def setUp(self):
+        self.columns = LicGLHelpers.AtlasSize // self.tileSize
+        self.pixels = blank(LicGLHelpers.AtlasSize)
+
+        tiles = [None, (0, 0, self.tileSize, self.tileSize), (0, 40, 10, 50), (100, 0, self.tileSize, 5)]
+        fixtures = [pixels for unused, pixels in fixtureBuffers(self.tileSize)]
+        rnd = random.Random(1)
+        for i in range(self.columns * self.columns):
+            x, y = (i % self.columns) * self.tileSize, (i // self.columns) * self.tileSize
+            tile = self.pixels[y:y + self.tileSize, x:x + self.tileSize]
+            if i < len(tiles):
+                if tiles[i] is not None:
+                    drawRect(tile, *tiles[i])
+            elif fixtures and i % 2:
+                tile[:] = fixtures[i % len(fixtures)]
+            else:
+                left, top = rnd.randrange(self.tileSize), rnd.randrange(self.tileSize)
+                drawRect(tile, left, top, left + rnd.randint(1, 40), top + rnd.randint(1, 40))
+
+    def tearDown(self):
+        LicGLHelpers.numpy = numpy
+
+    def testAtlas(self):
+        count = self.columns * self.columns - 3  # Trailing tiles are left out, like a part full atlas
+        arrayBounds = LicGLHelpers._getAtlasBounds(self.pixels, self.tileSize, count)
+
+        size = LicGLHelpers.AtlasSize
+        img = Image.fromstring("RGBA", (size, size), self.pixels.tostring())
+        LicGLHelpers.numpy = None  # Take the PIL path
+        imageBounds = LicGLHelpers._getAtlasBounds(img, self.tileSize, count)
+
+        self.assertEqual(len(arrayBounds), count)
+        self.assertEqual(arrayBounds, imageBounds)
+
+    def testTiles(self):
+        # Each tile of the atlas is bounded as if it were read on its own
+        count = self.columns * self.columns
+        arrayBounds = LicGLHelpers._getAtlasBounds(self.pixels, self.tileSize, count)
+        for i in range(count):
+            x, y = (i % self.columns) * self.tileSize, (i // self.columns) * self.tileSize
+            tile = numpy.ascontiguousarray(self.pixels[y:y + self.tileSize, x:x + self.tileSize])
+            self.assertEqual(arrayBounds[i], pilBounds(tile), i)
+
+if __name__ == '__main__':
+    unittest.main()
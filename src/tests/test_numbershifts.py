@@ -0,0 +1,150 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (tests/test_numbershifts.py) is part of LIC.
+
+    LIC is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the Creative Commons License
+    along with this program.  If not, see http://creativecommons.org/licenses/by-sa/3.0/
+"""
+
+# Checks that NumberShiftLog & ShiftNumbered, the lazy page & step renumbering, always agree with
+# renumbering every item eagerly.
+# Usage, from src: python -m unittest discover -s tests
+
+import os
+import random
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from LicHelpers import NumberShiftLog, ShiftNumbered
+
+class Numbered(ShiftNumbered):
+
+    def __init__(self, number, shiftLog = None):
+        self._number = number
+        self.shiftCount = 0
+        if shiftLog is not None:
+            self.attachNumbering(shiftLog)
+
+    def numberShifted(self):
+        self.shiftCount += 1
+
+class NumberShiftLogTestCase(unittest.TestCase):
+
+    def testReplay(self):
+        log = NumberShiftLog()
+        stamp = log.stamp()
+        log.shift(5, 1)
+        log.shift(3, -2)
+        self.assertEqual(log.replay(4, stamp), 2)  # Below 5, at or above 3
+        self.assertEqual(log.replay(5, stamp), 4)
+        self.assertEqual(log.replay(2, stamp), 2)
+        self.assertEqual(log.replay(5, log.stamp()), 5)  # Nothing logged since
+
+    def testZeroShiftNotLogged(self):
+        log = NumberShiftLog()
+        log.shift(1, 0)
+        self.assertEqual(log.stamp(), 0)
+
+    def testCompact(self):
+        log = NumberShiftLog()
+        log.shift(1, 1)
+        stamp = log.stamp()
+        log.shift(1, 1)
+        log.compact()
+        self.assertEqual(log.shifts, [])
+        self.assertEqual(log.stamp(), 2)
+        self.assertEqual(log.replay(7, stamp), 7)  # Stamps from before a compact see nothing
+
+class ShiftNumberedTestCase(unittest.TestCase):
+
+    def testInterleavedShiftsAndReads(self):
+        # Lazy items, read at random moments, must match items renumbered eagerly on every shift
+        rnd = random.Random(0)
+        log = NumberShiftLog()
+        items = [Numbered(n, log) for n in range(1, 31)]
+        eager = range(1, 31)
+
+        for unused in range(500):
+            threshold, increment = rnd.randint(1, 40), rnd.choice([-1, 1, 2])
+            log.shift(threshold, increment)
+            eager = [n + increment if n >= threshold else n for n in eager]
+            for i in rnd.sample(range(len(items)), 5):
+                self.assertEqual(items[i]._number, eager[i])
+
+        self.assertEqual([item._number for item in items], eager)
+
+    def testNumberShiftedHook(self):
+        log = NumberShiftLog()
+        item = Numbered(3, log)
+        log.shift(10, 1)  # Doesn't reach item
+        self.assertEqual(item._number, 3)
+        self.assertEqual(item.shiftCount, 0)
+        log.shift(1, 1)
+        log.shift(2, 1)
+        self.assertEqual(item._number, 5)
+        self.assertEqual(item.shiftCount, 1)  # Once per catch up, not once per shift
+        item._number
+        self.assertEqual(item.shiftCount, 1)
+
+    def testSetterResetsStamp(self):
+        log = NumberShiftLog()
+        item = Numbered(3, log)
+        log.shift(1, 5)
+        item._number = 2  # Set directly, like a page number sync: shifts logged so far no longer apply
+        self.assertEqual(item._number, 2)
+        self.assertEqual(item.shiftCount, 0)
+        log.shift(1, 1)
+        self.assertEqual(item._number, 3)
+
+    def testDetachCompactReattach(self):
+        log = NumberShiftLog()
+        kept, moved = Numbered(4, log), Numbered(6, log)
+
+        log.shift(5, 1)
+        moved.attachNumbering(None)  # Catches up first, then stops following
+        self.assertEqual(moved._number, 7)
+
+        kept._number = kept._number  # Every attached item has its number set, so compacting is safe
+        log.compact()
+        log.shift(1, 1)
+        self.assertEqual(moved._number, 7)  # Detached: later shifts don't touch it
+        self.assertEqual(kept._number, 5)
+
+        moved.attachNumbering(log)  # Re-attached: follows only shifts logged from now on
+        self.assertEqual(moved._number, 7)
+        log.shift(6, 10)
+        self.assertEqual((kept._number, moved._number), (5, 17))
+
+    def testCompactTooEarly(self):
+        # The precondition of compact: an attached item that hasn't caught up loses the compacted shifts
+        log = NumberShiftLog()
+        item = Numbered(4, log)
+        log.shift(1, 1)
+        log.compact()
+        self.assertEqual(item._number, 4)
+
+        log.shift(1, 1)  # It still follows shifts logged after the compact
+        self.assertEqual(item._number, 5)
+
+    def testAttachCatchesUpWithOldLog(self):
+        first, second = NumberShiftLog(), NumberShiftLog()
+        item = Numbered(2, first)
+        first.shift(1, 3)
+        item.attachNumbering(second)  # Like a step moved to another submodel's page
+        first.shift(1, 100)
+        self.assertEqual(item._number, 5)
+        second.shift(5, 1)
+        self.assertEqual(item._number, 6)
+
+if __name__ == '__main__':
+    unittest.main()
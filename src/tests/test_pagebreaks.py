@@ -0,0 +1,158 @@
+"""
+    LIC - Instruction Book Creation software
+    Copyright (C) 2010 Remi Gagne
+    Copyright (C) 2015 Jeremy Czajkowski
+
+    This file (tests/test_pagebreaks.py) is part of LIC.
+
+    LIC is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the Creative Commons License
+    along with this program.  If not, see http://creativecommons.org/licenses/by-sa/3.0/
+"""
+
+# Checks the page break solvers on their own, and Submodel.planPageBreaks on stub pages & steps
+# that carry only what StepLayoutPlan and the grid layout read.
+# Usage, from src: python -m unittest discover -s tests
+
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PyQt4.QtCore import QPointF, QRectF
+
+import LicQtWrapper  # for QRectF.getOrientedSize
+from LicLayout import *
+from LicModel import Submodel
+
+class SolverTestCase(unittest.TestCase):
+
+    def run5(self, solver, forced = ()):
+        # Up to 4 units fit on a page; badness is the squared unused quarter count
+        fits = lambda i, j: Horizontal if j - i <= 4 else None
+        startsPage = lambda i: i in forced
+        badness = lambda i, j, orientation: (1.0 - (j - i) / 4.0) ** 2
+        return solver(5, fits, startsPage, badness)
+
+    def testGreedy(self):
+        self.assertEqual(self.run5(greedyPageBreaks), [(0, 4, Horizontal), (4, 5, Horizontal)])
+
+    def testOptimalBalances(self):
+        # Same page count as greedy, but no lopsided last page
+        badness = lambda pages: sum((1.0 - (j - i) / 4.0) ** 2 for i, j, unused in pages)
+        greedy, optimal = self.run5(greedyPageBreaks), self.run5(optimalPageBreaks)
+        self.assertEqual(len(optimal), len(greedy))
+        self.assertEqual(sorted(j - i for i, j, unused in optimal), [2, 3])
+        self.assertTrue(badness(optimal) < badness(greedy))
+
+    def testForcedBreaks(self):
+        for solver in [greedyPageBreaks, optimalPageBreaks]:
+            pages = self.run5(solver, forced = [1, 3])
+            starts = [i for i, unused, unused in pages]
+            self.assertEqual(starts[0], 0, solver.__name__)
+            self.assertEqual([j for unused, j, unused in pages], starts[1:] + [5], solver.__name__)
+            self.assertTrue(1 in starts and 3 in starts, solver.__name__)
+
+class StubPart(object):
+
+    def __init__(self, submodel = False):
+        self.submodel = submodel
+
+    def isSubmodel(self):
+        return self.submodel
+
+class StubCSI(object):
+
+    def __init__(self, width, height, submodel):
+        self._rect = QRectF(0, 0, width, height)
+        self.partList = [StubPart(submodel)]
+
+    def rect(self):
+        return self._rect
+
+    def getPartList(self):
+        return self.partList
+
+class StubLockIcon(object):
+    isLocked = False
+
+class StubPage(object):
+
+    margin = QPointF(15, 15)
+    submodelItem = None
+
+    def __init__(self, step):
+        self.steps = [step]
+        step.page = self
+        self.layout = GridLayout()
+        self.lockIcon = StubLockIcon()
+
+    def rect(self):
+        return QRectF(0, 0, 800, 600)
+
+    def insetRect(self):
+        return self.rect().adjusted(15, 15, -15, -15)
+
+class StubStep(object):
+
+    callouts = []
+    pli = None
+    numberItem = None
+    rotateIcon = None
+
+    def __init__(self, width, height, submodel = False):
+        self.csi = StubCSI(width, height, submodel)
+
+    def hasPLI(self):
+        return False
+
+    def getPage(self):
+        return self.page
+
+    def childItems(self):
+        return [self.csi]
+
+class StubSubmodel(object):
+    planPageBreaks = Submodel.planPageBreaks.im_func
+    _Submodel__planMergedPage = Submodel._Submodel__planMergedPage.im_func
+
+    def __init__(self, stepSizes, submodelSteps = ()):
+        self.pages = [StubPage(StubStep(w, h, i in submodelSteps)) for i, (w, h) in enumerate(stepSizes)]
+
+class PlanPageBreaksTestCase(unittest.TestCase):
+
+    def testSmallStepsShareAPage(self):
+        submodel = StubSubmodel([(100, 100)] * 4)
+        for solver in [greedyPageBreaks, optimalPageBreaks]:
+            self.assertEqual(submodel.planPageBreaks(solver), [(0, 4, Horizontal)], solver.__name__)
+
+    def testBigStepsStayApart(self):
+        submodel = StubSubmodel([(700, 500)] * 3)
+        pages = submodel.planPageBreaks()
+        self.assertEqual([(i, j) for i, j, unused in pages], [(0, 1), (1, 2), (2, 3)])
+
+    def testSubmodelStepStartsPage(self):
+        submodel = StubSubmodel([(100, 100)] * 4, submodelSteps = [2])
+        pages = submodel.planPageBreaks()
+        self.assertEqual([(i, j) for i, j, unused in pages], [(0, 2), (2, 4)])
+
+    def testLockedPageNotMerged(self):
+        submodel = StubSubmodel([(100, 100)] * 3)
+        submodel.pages[1].lockIcon.isLocked = True
+        pages = submodel.planPageBreaks()
+        self.assertFalse(any(i <= 1 < j and j - i > 1 for i, j, unused in pages))
+
+    def testOptimalNeverUsesMorePages(self):
+        sizes = [(100 + (i * 37) % 250, 80 + (i * 53) % 200) for i in range(20)]
+        greedy = StubSubmodel(sizes).planPageBreaks(greedyPageBreaks)
+        optimal = StubSubmodel(sizes).planPageBreaks(optimalPageBreaks)
+        self.assertTrue(len(optimal) <= len(greedy))
+        self.assertEqual(optimal[-1][1], len(sizes))
+
+if __name__ == '__main__':
+    unittest.main()